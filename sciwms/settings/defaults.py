@@ -160,6 +160,79 @@ CACHES = {
     }
 }
 
+# Parsed topologies are kept in memory by each worker, up to this many bytes
+TOPOLOGY_CACHE_BYTES = 512 * 1024 * 1024
+
+# Rendered GetMap tiles are cached in memory (per process) and on disk under TOPOLOGY_PATH/tiles
+TILE_CACHE_ENABLED = True
+TILE_CACHE_DISK = True
+TILE_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+# Tiles of the XYZ endpoint are rendered METATILE_SIZE x METATILE_SIZE at a time and all cached
+METATILE_SIZE = 4
+
+# Default renderer of 'pcolor' tiles, 'matplotlib' or 'numpy' (RENDERER request parameter)
+PCOLOR_RENDERER = 'matplotlib'
+# PNG encoding of map tiles, can be overridden per dataset with a "png" object in the dataset's json.
+#   filter: none, sub, up, average, paeth, adaptive or auto (none for palette images, up otherwise)
+#   strategy: default, filtered, huffman, rle or fixed (zlib strategies)
+#   palette: write 8-bit palette PNGs when a tile has at most 256 colors
+PNG_OPTIONS = {
+    'compress_level': 6,
+    'filter': 'auto',
+    'strategy': 'default',
+    'palette': True
+}
+
+# Most contiguous reads of a UGRID variable for a GetMap tile, the elements of
+# the visible faces are read instead of the whole mesh when they span little of it
+UGRID_READ_RANGES = 32
+
+# UGRID node data tiles are drawn from a decimated mesh when its cells are at most
+# this many pixels wide (0 disables), levels stop below UGRID_LOD_MIN_FACES faces
+UGRID_LOD_PIXELS = 2
+UGRID_LOD_MIN_FACES = 1000
+
+# Reused matplotlib figures, per process: number of image sizes and idle figures per size
+FIGURE_POOL_SIZES = 16
+FIGURE_POOL_DEPTH = 4
+
+# Pixel to grid cell indexes of the numpy renderer, kept per process
+RASTER_INDEX_CACHE_BYTES = 64 * 1024 * 1024
+
+# Open netCDF handles kept by each process (see wms.handles), closed after this many seconds unused
+NETCDF_POOL_SIZE = 32
+NETCDF_POOL_IDLE = 600
+# Threads reading the components of vector layers at once, each with its own handle (0 reads them one by one).
+# Needs a threaded worker class (gunicorn "gthread"): eventlet workers (docker/gunicorn.py) read them one by one.
+READ_WORKERS = 4
+
+# Remote (OPeNDAP) datasets can be read through a local mirror of their chunks in
+# MIRROR_PATH (see wms.mirror), using up to MIRROR_BYTES of disk.  Enabled for all of
+# them here, or per dataset with a "mirror" boolean in its json.  The web workers write
+# the mirror, so MIRROR_PATH must be writable by them.
+MIRROR_ENABLED = False
+MIRROR_PATH = os.environ.get('MIRROR_PATH', os.path.join(TOPOLOGY_PATH, 'mirror'))
+MIRROR_BYTES = 10 * 1024 * 1024 * 1024
+# Values in a mirrored chunk, split evenly between the dimensions after time and elevation
+MIRROR_CHUNK_ELEMENTS = 512 * 512
+
+# Decoded data slices kept per process (see wms.slices)
+SLICE_CACHE_BYTES = 256 * 1024 * 1024
+# Time slices read ahead when a client steps through time (0 disables), by this many threads.
+# Not used by eventlet workers (docker/gunicorn.py), whose threads are green threads.
+PREFETCH_STEPS = 4
+PREFETCH_WORKERS = 2
+# Decoded slices are shared by the workers of a node as memory mapped files in this
+# directory (mount a tmpfs here), up to this many bytes (0 disables).  Smaller slices
+# are only kept per process.
+SLICE_SHARED_PATH = os.environ.get('SLICE_SHARED_PATH', os.path.join(TOPOLOGY_PATH, 'slices'))
+SLICE_SHARED_BYTES = 1024 * 1024 * 1024
+SLICE_SHARED_MIN_BYTES = 64 * 1024
+
+# Most frames of an animated GetMap (FORMAT=image/apng or image/gif with a TIME range),
+# longer ranges are subsampled
+ANIMATION_MAX_FRAMES = 100
+
 db_path = os.environ.get('SQLITE_DB_PATH', os.path.join(PROJECT_ROOT, "db"))
 if not os.path.isdir(db_path):
     os.makedirs(db_path)
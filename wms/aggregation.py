@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Time-to-file index of multi-file (EnhancedMFDataset) datasets.
+
+Every read of an aggregation goes through all of its files.  When its time
+cache is updated, the index of a dataset records for each file its offset
+and length along the aggregated time dimension and the first and last values
+of its time variables, in TOPOLOGY_PATH/<dataset>.files.json.  Reads of time
+steps then open (through the handle pool) only the files holding them.
+"""
+import os
+import json
+import bisect
+
+import numpy as np
+import netCDF4 as nc4
+from django.conf import settings
+
+from wms.utils import LRUCache
+from wms import topology
+from wms import handles
+
+from wms import logger
+
+
+# The dimension aggregated by EnhancedMFDataset(aggdim=...)
+DIMENSION = 'time'
+
+# dataset -> (mtime, index)
+_indexes = LRUCache(maxsize=256)
+
+
+def index_file(dataset):
+    return os.path.join(settings.TOPOLOGY_PATH, '{}.files.json'.format(dataset.safe_filename))
+
+
+def update(dataset, nc):
+    """ Build the index of a dataset from its open aggregation, or remove it if it is a single file """
+    path = index_file(dataset)
+    files = getattr(nc, '_files', None)
+    if not files:
+        if os.path.isfile(path):
+            os.remove(path)
+        return None
+
+    time_vars = [v.name for v in nc.get_variables_by_attributes(standard_name='time') if v.dimensions[:1] == (DIMENSION,)]
+    entries = []
+    offset = 0
+    for filename in files:
+        # The first file of the aggregation holds its aggregated variables, read each file on its own
+        with nc4.Dataset(filename) as cdf:
+            count = len(cdf.dimensions[DIMENSION])
+            times = {}
+            for name in time_vars:
+                values = cdf.variables[name][:]
+                if count:
+                    times[name] = [float(values[0]), float(values[-1])]
+        entries.append(dict(path=filename, offset=offset, count=count, times=times))
+        offset += count
+
+    index = dict(dimension=DIMENSION, size=offset, files=entries)
+    topology.save_json(path, index)
+    logger.info("Indexed the {} files of {}".format(len(entries), dataset.name))
+    return index
+
+
+def load(dataset):
+    """ The index of a dataset, None if it is not an indexed aggregation """
+    path = index_file(dataset)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _indexes.get(dataset.safe_filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path) as f:
+            index = Index(json.load(f))
+    except (OSError, ValueError, KeyError):
+        logger.exception("Could not load the file index of {}".format(dataset.name))
+        return None
+    _indexes.set(dataset.safe_filename, (mtime, index))
+    return index
+
+
+class Index(object):
+
+    def __init__(self, index):
+        self.dimension = index['dimension']
+        self.size = index['size']
+        self.files = [f for f in index['files'] if f['count'] > 0]
+        self.offsets = [f['offset'] for f in self.files]
+
+    def locate(self, time_index):
+        """ Return the file holding a time index and the index in that file """
+        f = self.files[bisect.bisect_right(self.offsets, time_index) - 1]
+        return f['path'], time_index - f['offset']
+
+    def segments(self, start, stop, step):
+        """ [(path, local slice)] of the files holding a range of time indexes, in order """
+        segments = []
+        i = bisect.bisect_right(self.offsets, start) - 1
+        while i < len(self.files) and start < stop:
+            f = self.files[i]
+            end = f['offset'] + f['count']
+            if start < end:
+                local_stop = min(stop, end) - f['offset']
+                segments.append((f['path'], slice(start - f['offset'], local_stop, step)))
+                # First index past this file on the step
+                start += step * -(-(min(stop, end) - start) // step)
+            i += 1
+        return segments
+
+    def has_times(self, time_var, size):
+        """ Whether the index holds the values of a time variable of `size` steps """
+        return size == self.size and bool(self.files) and all(time_var in f['times'] for f in self.files)
+
+    def nearest(self, time_var, value):
+        """
+        Return the first time index whose value is at least `value` (the last
+        one if none is) and its value, reading only the file holding it
+        """
+        lasts = [f['times'][time_var][1] for f in self.files]
+        i = min(bisect.bisect_left(lasts, value), len(self.files) - 1)
+        f = self.files[i]
+        with handles.dataset(f['path']) as nc, handles.reading():
+            times = nc.variables[time_var][:]
+        local = min(np.searchsorted(times, value, side='left'), len(times) - 1)
+        return f['offset'] + local, times[local]
+
+
+class Variable(object):
+    """
+    Proxy of an aggregated variable reading the time steps it is indexed
+    with from the files holding them.  Other reads and attributes are the
+    ones of the aggregation.
+    """
+
+    def __init__(self, name, variable, index):
+        self.name = name
+        self.variable = variable
+        self.index = index
+        self.shape = variable.shape
+
+    def __getattr__(self, name):
+        return getattr(self.variable, name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read(self, path, key):
+        with handles.dataset(path) as nc:
+            if nc is None:
+                raise ValueError('Could not open {}'.format(path))
+            with handles.reading():
+                return nc.variables[self.name][key]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)) and not isinstance(first, bool):
+            t = int(first) + self.index.size if first < 0 else int(first)
+            if 0 <= t < self.index.size:
+                path, local = self.index.locate(t)
+                return self._read(path, (local,) + rest)
+        elif isinstance(first, slice):
+            start, stop, step = first.indices(self.index.size)
+            if step > 0 and start < stop:
+                parts = [self._read(path, (local,) + rest) for path, local in self.index.segments(start, stop, step)]
+                return parts[0] if len(parts) == 1 else np.ma.concatenate(parts)
+        return self.variable[key]
+
+
+def variable(dataset, name, variable):
+    """ The proxy of a variable of an indexed aggregation aggregated along time, else the variable """
+    index = load(dataset)
+    dimensions = getattr(variable, 'dimensions', ())
+    if index is None or not dimensions or dimensions[0] != index.dimension or variable.shape[0] != index.size:
+        return variable
+    return Variable(name, variable, index)
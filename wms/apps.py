@@ -11,6 +11,10 @@ class WmsConfig(AppConfig):
         # Initialize signals
         import wms.signals  # noqa
 
+        # Build the projections of the advertised CRSs before the first request
+        from wms import projections
+        projections.warm()
+
         # Load cmocean colormaps
         # import cmocean
         # import matplotlib.cm
@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 import io
+import itertools
+import threading
+from contextlib import contextmanager
 
 import numpy as np
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-from django.http.response import HttpResponse
+from django.conf import settings
+from django.http.response import HttpResponse, StreamingHttpResponse
+
+from wms.utils import DotDict, LRUCache
+from wms import encoders
+
+
+# Idle (figure, axes) pairs by (width, height, dpi)
+_figures = LRUCache(maxsize=settings.FIGURE_POOL_SIZES)
+_figures_lock = threading.Lock()
+
+# Encoded transparent tiles by (width, height, PNG options)
+_blanks = LRUCache(maxsize=32)
 
 
 def lat_lon_subset_idx(lon, lat, lonmin, latmin, lonmax, latmax, padding=0.18):
@@ -41,28 +56,162 @@ def face_idx_from_node_idx(faces, spatial_idx):
     return faces_idx
 
 
+def read_ranges(variable, prefix, ranges, size):
+    """
+    Read `ranges` (slices, see utils.index_ranges) of the last dimension of a
+    variable, with `prefix` indexing the other dimensions.  Returns a masked
+    array with a last dimension of length `size`, masked outside of the ranges.
+    """
+    chunks = [variable[prefix + (s,)] for s in ranges]
+    if not chunks:
+        return np.ma.masked_all(size, dtype=np.float64)
+    data = np.ma.masked_all(chunks[0].shape[:-1] + (size,), dtype=chunks[0].dtype)
+    for s, chunk in zip(ranges, chunks):
+        data[..., s] = chunk
+    return data
+
+
 def figure_response(fig, request, adjust=None, **kwargs):
-    canvas = FigureCanvasAgg(fig)
+    canvas = fig.canvas if isinstance(fig.canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
     figdata = io.BytesIO()
     canvas.print_png(figdata, bbox_inches='tight', pad_inches=0.1, **kwargs)
     response = HttpResponse(figdata.getvalue(), content_type='image/png')
     return response
 
 
-def blank_figure(width, height, dpi=5):
+def png_options(request):
+    """ PNG encoder options of an enhanced GetMap request, or the server defaults """
+    options = request.GET.get('png_options')
+    if not isinstance(options, DotDict):
+        options = DotDict(**settings.PNG_OPTIONS)
+    return options
+
+
+def image_response(rgba, request):
+    """
+    Encode an (height, width, 4) RGBA array as a PNG response.  Metatile
+    requests (`keep_rgba`) are not encoded, a copy of the array is returned
+    as the `rgba` attribute of the response to be sliced into tiles.
+    """
+    if request.GET.get('keep_rgba') is True:
+        response = HttpResponse(content_type='image/png')
+        response.rgba = np.array(rgba)
+        return response
+
+    options = png_options(request)
+    content = encoders.png(rgba,
+                           compress_level=options.compress_level,
+                           filter=options.filter,
+                           strategy=options.strategy,
+                           palette=options.palette)
+    return HttpResponse(content, content_type='image/png')
+
+
+def animation_response(frames, count, request):
+    """
+    Stream `count` (height, width, 4) RGBA frames as an animated PNG or GIF,
+    the `animation` of an enhanced GetMap request.  The first frame is
+    rendered before the response starts, so its errors are not streamed as a
+    truncated image.
     """
-    return a transparent (blank) response
-    used for tiles with no intersection with the current view or for some other error.
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is not None:
+        frames = itertools.chain([first], frames)
+    delay = 1000. / request.GET['framerate']
+    if request.GET['animation'] == 'gif':
+        return StreamingHttpResponse(encoders.gif(frames, delay), content_type='image/gif')
+
+    options = png_options(request)
+    return StreamingHttpResponse(encoders.apng(frames, count, delay,
+                                               compress_level=options.compress_level,
+                                               filter=options.filter,
+                                               strategy=options.strategy),
+                                 content_type='image/apng')
+
+
+def blank_response(request):
     """
+    Return a transparent PNG of the requested size.  The PNG is encoded once
+    per size and reused, without matplotlib.  The `rgba` of the response is
+    None for requests with `keep_rgba`.
+    """
+    width = int(request.GET['width'])
+    height = int(request.GET['height'])
+    options = png_options(request)
+    key = (width, height, repr(options))
+    content = _blanks.get(key)
+    if content is None:
+        content = encoders.png(np.zeros((height, width, 4), dtype=np.uint8),
+                               compress_level=options.compress_level,
+                               filter=options.filter,
+                               strategy=options.strategy,
+                               palette=options.palette)
+        _blanks.set(key, content)
+    response = HttpResponse(content, content_type='image/png')
+    if request.GET.get('keep_rgba') is True:
+        response.rgba = None
+    return response
+
+
+def tile_response(fig, request):
+    """
+    Encode a map tile figure drawn at exactly its size, unlike figure_response
+    there is no tight bbox layout pass.
+    """
+    canvas = fig.canvas if isinstance(fig.canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    rgba = np.frombuffer(canvas.buffer_rgba(), dtype=np.uint8).reshape(height, width, 4)
+    return image_response(rgba, request)
+
+
+def _new_figure(width, height, dpi):
     fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
     fig.set_alpha(0)
-    ax = fig.add_axes([0, 0, 1, 1])
     fig.set_figheight(height / dpi)
     fig.set_figwidth(width / dpi)
+    FigureCanvasAgg(fig)
+
+    ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
+    ax.set_axis_off()
     ax.set_frame_on(False)
     ax.set_clip_on(False)
-    ax.set_position([0, 0, 1, 1])
-    return fig
+    return fig, ax
+
+
+def _reset_figure(fig, ax):
+    """ Remove everything drawn on the axes, keeping their configuration """
+    for artist in list(ax.collections) + list(ax.patches) + list(ax.lines) + list(ax.images) + list(ax.texts) + list(ax.artists):
+        artist.remove()
+    ax.ignore_existing_data_limits = True
+
+
+@contextmanager
+def pooled_figure(width, height, dpi=80.):
+    """
+    Yield a transparent (figure, axes) pair of the requested size with the
+    axes filling the figure.  Figures are reused by the process: the axes are
+    cleared when the block exits, so nothing drawn may be kept outside of it.
+    """
+    key = (int(width), int(height), float(dpi))
+    with _figures_lock:
+        idle = _figures.get(key)
+        fig_ax = idle.pop() if idle else None
+    if fig_ax is None:
+        fig_ax = _new_figure(width, height, dpi)
+
+    try:
+        yield fig_ax
+    finally:
+        _reset_figure(*fig_ax)
+        with _figures_lock:
+            idle = _figures.get(key)
+            if idle is None:
+                idle = []
+                _figures.set(key, idle)
+            if len(idle) < settings.FIGURE_POOL_DEPTH:
+                idle.append(fig_ax)
 
 
 def ugrid_lat_lon_subset_idx(lon, lat, bbox, padding=None):
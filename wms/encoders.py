@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+PNG encoder for RGBA numpy arrays.
+
+Images with at most 256 distinct colors are written as 8-bit palette PNGs.
+The scanline filter, zlib level and zlib strategy are configurable (see the
+PNG_OPTIONS setting).
+"""
+import zlib
+import struct
+
+import numpy as np
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+FILTERS = ['none', 'sub', 'up', 'average', 'paeth']
+
+STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': getattr(zlib, 'Z_RLE', zlib.Z_DEFAULT_STRATEGY),
+    'fixed': getattr(zlib, 'Z_FIXED', zlib.Z_DEFAULT_STRATEGY),
+}
+
+
+# Pixels sampled by palettize() before counting the colors of a whole image
+PALETTE_SAMPLE = 4096
+
+
+def valid_option(name, value):
+    """ Whether `value` is a valid value of the png() keyword argument `name` """
+    if name == 'compress_level':
+        return isinstance(value, int) and not isinstance(value, bool) and -1 <= value <= 9
+    elif name == 'filter':
+        return isinstance(value, str) and (value in FILTERS or value in ('adaptive', 'auto'))
+    elif name == 'strategy':
+        return isinstance(value, str) and value in STRATEGIES
+    elif name == 'palette':
+        return isinstance(value, bool)
+    return False
+
+
+def _chunk(kind, data):
+    chunk = struct.pack('>I', len(data)) + kind + data
+    return chunk + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def palettize(rgba):
+    """
+    Return the (palette, indexes) of an RGBA image with at most 256 distinct
+    colors, or None.  Fully transparent pixels share a single palette entry.
+    """
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    colors = rgba.view(np.uint32).reshape(rgba.shape[:2])
+    colors = np.where(rgba[:, :, 3] == 0, np.uint32(0), colors)
+    # Smooth (e.g. antialiased) images show too many colors in a sample of their pixels
+    sample = colors.ravel()[::max(1, colors.size // PALETTE_SAMPLE)]
+    if np.unique(sample).size > 256:
+        return None
+    palette, indexes = np.unique(colors, return_inverse=True)
+    if palette.size > 256:
+        return None
+    return palette.view(np.uint8).reshape(-1, 4), indexes.reshape(colors.shape).astype(np.uint8)
+
+
+def _filtered(raw, bpp, method):
+    """ Apply a PNG filter to (height, stride) scanlines, without the filter type byte """
+    if method == 'none':
+        return raw
+
+    current = raw.astype(np.int16)
+    left = np.zeros_like(current)
+    left[:, bpp:] = current[:, :-bpp]
+    up = np.zeros_like(current)
+    up[1:] = current[:-1]
+
+    if method == 'sub':
+        predicted = left
+    elif method == 'up':
+        predicted = up
+    elif method == 'average':
+        predicted = (left + up) // 2
+    else:
+        upleft = np.zeros_like(current)
+        upleft[1:, bpp:] = current[:-1, :-bpp]
+        p = left + up - upleft
+        pa = np.abs(p - left)
+        pb = np.abs(p - up)
+        pc = np.abs(p - upleft)
+        predicted = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+    return (current - predicted).astype(np.uint8)
+
+
+def filter_scanlines(raw, bpp, method='none'):
+    """
+    Return PNG scanlines (a filter type byte followed by the filtered row) of
+    (height, stride) raw image rows.  With the 'adaptive' method every row uses
+    the filter with the smallest sum of absolute differences.
+    """
+    if method == 'adaptive':
+        candidates = np.stack([_filtered(raw, bpp, m) for m in FILTERS])
+        cost = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        types = cost.argmin(axis=0)
+        rows = candidates[types, np.arange(raw.shape[0])]
+    else:
+        types = np.full(raw.shape[0], FILTERS.index(method))
+        rows = _filtered(raw, bpp, method)
+
+    scanlines = np.empty((raw.shape[0], raw.shape[1] + 1), dtype=np.uint8)
+    scanlines[:, 0] = types
+    scanlines[:, 1:] = rows
+    return scanlines
+
+
+def png(rgba, compress_level=6, filter='auto', strategy='default', palette=True):
+    """
+    Encode an (height, width, 4) uint8 RGBA array as PNG bytes.
+
+    `filter` is one of FILTERS, 'adaptive', or 'auto' ('none' for palette
+    images, 'up' otherwise).  `strategy` is a key of STRATEGIES.
+    """
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    height, width = rgba.shape[:2]
+
+    chunks = []
+    indexed = palettize(rgba) if palette is True else None
+    if indexed is not None:
+        colors, indexes = indexed
+        header = struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)
+        chunks.append(_chunk(b'PLTE', colors[:, :3].tobytes()))
+        if (colors[:, 3] < 255).any():
+            chunks.append(_chunk(b'tRNS', colors[:, 3].tobytes()))
+        raw, bpp = indexes, 1
+        if filter == 'auto':
+            filter = 'none'
+    else:
+        header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+        raw, bpp = rgba.reshape(height, width * 4), 4
+        if filter == 'auto':
+            filter = 'up'
+
+    data = _compress(filter_scanlines(raw, bpp, filter), compress_level, strategy)
+
+    return b''.join([PNG_SIGNATURE, _chunk(b'IHDR', header)] + chunks + [
+        _chunk(b'IDAT', data),
+        _chunk(b'IEND', b'')
+    ])
+
+
+def _compress(scanlines, compress_level, strategy):
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 15, 9, STRATEGIES[strategy])
+    return compressor.compress(scanlines.tobytes()) + compressor.flush()
+
+
+def apng(frames, count, delay, compress_level=6, filter='auto', strategy='default'):
+    """
+    Encode `count` (height, width, 4) uint8 RGBA frames as an animated PNG
+    looping forever, showing each frame for `delay` milliseconds.  Yields the
+    bytes as the frames are encoded, frames are written as truecolor images
+    since the palette of later frames is not known up front.
+    """
+    if filter == 'auto':
+        filter = 'up'
+    sequence = 0
+    for i, rgba in enumerate(frames):
+        rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+        height, width = rgba.shape[:2]
+        if i == 0:
+            yield PNG_SIGNATURE + _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            yield _chunk(b'acTL', struct.pack('>II', count, 0))
+
+        # No disposal, frames replace the whole image (APNG_BLEND_OP_SOURCE)
+        yield _chunk(b'fcTL', struct.pack('>IIIIIHHBB', sequence, width, height, 0, 0, int(delay), 1000, 0, 0))
+        sequence += 1
+        data = _compress(filter_scanlines(rgba.reshape(height, width * 4), 4, filter), compress_level, strategy)
+        if i == 0:
+            yield _chunk(b'IDAT', data)
+        else:
+            yield _chunk(b'fdAT', struct.pack('>I', sequence) + data)
+            sequence += 1
+    yield _chunk(b'IEND', b'')
+
+
+def quantize(rgba):
+    """
+    Return the (palette, indexes) of an RGBA image for a GIF: at most 256 RGB
+    colors, index 0 being transparent (alpha < 128).  Images with more than
+    255 opaque colors are mapped onto a 6x7x6 color cube.
+    """
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    opaque = rgba[:, :, 3] >= 128
+    rgb = rgba[:, :, :3].astype(np.uint32)
+    colors = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+    palette, indexes = np.unique(colors[opaque], return_inverse=True)
+    if palette.size > 255:
+        levels = np.array([6, 7, 6])
+        cube = (rgba[:, :, :3][opaque].astype(np.uint32) * (levels - 1) + 127) // 255
+        palette, indexes = np.unique((cube[:, 0] * 7 + cube[:, 1]) * 6 + cube[:, 2], return_inverse=True)
+        cube = np.column_stack((palette // 42, palette // 6 % 7, palette % 6))
+        rgb_palette = (cube * 255 // (levels - 1)).astype(np.uint8)
+    else:
+        rgb_palette = np.column_stack((palette >> 16, (palette >> 8) & 255, palette & 255)).astype(np.uint8)
+
+    image = np.zeros(colors.shape, dtype=np.uint8)
+    image[opaque] = indexes.ravel() + 1
+    return np.vstack(([[0, 0, 0]], rgb_palette)), image
+
+
+def lzw(indexes, min_code_size):
+    """ GIF LZW compression of a flat sequence of color indexes """
+    clear = 1 << min_code_size
+    end = clear + 1
+    out = bytearray()
+    buffer = 0
+    bits = 0
+
+    table = {}
+    next_code = end + 1
+    width = min_code_size + 1
+
+    # Start with a clear code
+    buffer, bits = clear, width
+    indexes = np.asarray(indexes, dtype=np.uint8).tolist()
+    prefix = indexes[0]
+    for k in indexes[1:]:
+        key = (prefix << 8) | k
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+
+        buffer |= prefix << bits
+        bits += width
+        while bits >= 8:
+            out.append(buffer & 255)
+            buffer >>= 8
+            bits -= 8
+
+        if next_code < 4096:
+            table[key] = next_code
+            next_code += 1
+            if next_code > (1 << width) and width < 12:
+                width += 1
+        else:
+            buffer |= clear << bits
+            bits += width
+            table = {}
+            next_code = end + 1
+            width = min_code_size + 1
+        prefix = k
+
+    buffer |= prefix << bits
+    bits += width
+    if next_code == (1 << width) and width < 12:
+        # The decoder adds an entry for the last code before reading the end code
+        width += 1
+    buffer |= end << bits
+    bits += width
+    while bits > 0:
+        out.append(buffer & 255)
+        buffer >>= 8
+        bits -= 8
+    return bytes(out)
+
+
+def gif(frames, delay):
+    """
+    Encode (height, width, 4) uint8 RGBA frames as a GIF looping forever,
+    showing each frame for `delay` milliseconds.  Yields the bytes as the
+    frames are encoded, every frame has its own color table.
+    """
+    for i, rgba in enumerate(frames):
+        height, width = rgba.shape[:2]
+        if i == 0:
+            yield b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0)
+            # Loop forever
+            yield b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', 0) + b'\x00'
+
+        palette, image = quantize(rgba)
+        bits = max(1, int(np.ceil(np.log2(palette.shape[0]))))
+        table = np.zeros((1 << bits, 3), dtype=np.uint8)
+        table[:palette.shape[0]] = palette
+
+        # Graphic control: restore to transparent after the frame, color 0 is transparent
+        yield b'\x21\xf9\x04' + struct.pack('<BHBB', (2 << 2) | 1, int(round(delay / 10.)), 0, 0)
+        yield b'\x2c' + struct.pack('<HHHHB', 0, 0, width, height, 0x80 | (bits - 1)) + table.tobytes()
+
+        min_code_size = max(2, bits)
+        data = lzw(image.ravel(), min_code_size)
+        blocks = [bytes([min_code_size])]
+        for start in range(0, len(data), 255):
+            block = data[start:start + 255]
+            blocks.append(bytes([len(block)]) + block)
+        blocks.append(b'\x00')
+        yield b''.join(blocks)
+    yield b'\x3b'
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Cache generations of datasets.
+
+The caches derived from the data of a dataset (rendered tiles, decoded
+slices, mirrored chunks and open netCDF handles) are keyed by its
+generation.  The time and grid cache update tasks replace the generation
+marker of a dataset, TOPOLOGY_PATH/<dataset>.generation, which invalidates
+those caches in every worker at once.  Reads never write the marker: a
+dataset whose caches were never updated is in INITIAL_GENERATION.
+
+Workers read the marker again when its modification time changes, checked
+at most every CHECK_SECONDS for each dataset.
+"""
+import os
+import time
+import uuid
+import tempfile
+
+from django.conf import settings
+
+from wms import logger
+
+
+# Generation of the datasets whose caches were never updated
+INITIAL_GENERATION = 'initial'
+
+# Seconds between two checks of the marker of a dataset
+CHECK_SECONDS = 1
+
+# dataset -> (checked, mtime, generation)
+_current = {}
+
+
+def marker(dataset):
+    return os.path.join(settings.TOPOLOGY_PATH, '{}.generation'.format(dataset.safe_filename))
+
+
+def current(dataset):
+    """ Return the current cache generation of a dataset """
+    now = time.time()
+    cached = _current.get(dataset.safe_filename)
+    if cached is not None and now - cached[0] < CHECK_SECONDS:
+        return cached[2]
+
+    path = marker(dataset)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    if cached is not None and cached[1] == mtime:
+        generation = cached[2]
+    elif mtime is None:
+        generation = INITIAL_GENERATION
+    else:
+        try:
+            with open(path) as f:
+                generation = f.read().strip() or INITIAL_GENERATION
+        except (IOError, OSError):
+            generation = INITIAL_GENERATION
+    _current[dataset.safe_filename] = (now, mtime, generation)
+    return generation
+
+
+def advance(dataset):
+    """
+    Start a new generation of the caches of a dataset.  Only called by the
+    cache update tasks, returns the current generation if the marker can
+    not be written.
+    """
+    generation = uuid.uuid4().hex
+    path = marker(dataset)
+    try:
+        tmphandle, tmpsave = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            os.write(tmphandle, generation.encode('utf-8'))
+        finally:
+            os.close(tmphandle)
+        os.replace(tmpsave, path)
+    except (IOError, OSError):
+        logger.exception("Could not start a new cache generation for {}".format(dataset.name))
+        return current(dataset)
+    _current.pop(dataset.safe_filename, None)
+    logger.info("Started cache generation {} for {}".format(generation, dataset.name))
+    return generation
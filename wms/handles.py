@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide pool of open netCDF handles.
+
+Opening a dataset, above all an OPeNDAP URL, costs more than most of the
+reads a tile needs, so the EnhancedDataset or EnhancedMFDataset of a path is
+kept open by each worker and shared by the requests it serves.  A handle is
+reopened when its local files were modified or when the `token` it was
+opened with changes (the cache generation of the dataset, which is
+replaced on every time or grid cache update).  Handles unused for
+NETCDF_POOL_IDLE seconds are closed, and at most NETCDF_POOL_SIZE are open
+at once.
+
+netCDF4 is not thread-safe and releases the GIL while it reads data, so
+the data of a handle is read under its lock: inside `reading()` by the
+requests using it, and inside `locked()` by the threads prefetching slices
+from it.  The lock is not held between reads, so the requests for a
+dataset render concurrently.  To read several variables of a path at once,
+`map_lanes` gives each of READ_WORKERS threads its own handle of the path,
+a "lane".  Lanes need OS threads: on green threads (the eventlet workers)
+the reads would run one after another, so they use the one handle instead.
+"""
+import os
+import glob
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from urllib.parse import urlparse
+
+from django.conf import settings
+from pyaxiom.netcdf import EnhancedDataset, EnhancedMFDataset
+
+from wms.utils import green_threads
+
+from wms import logger
+
+
+# Seconds between two checks of the modification time of the files of a handle
+MTIME_CHECK_SECONDS = 5
+
+# (path, lane) -> Handle, least recently used first
+_handles = OrderedDict()
+_lock = threading.Lock()
+_opens = 0
+_reuses = 0
+_executor = None
+_executor_lock = threading.Lock()
+# Handles used by each thread, innermost last
+_local = threading.local()
+
+
+def _mtime(path):
+    """ Latest modification time of the files of a path or glob, None for URLs """
+    if urlparse(path).scheme != "":
+        return None
+    try:
+        return max(os.stat(p).st_mtime_ns for p in glob.glob(path))
+    except (OSError, ValueError):
+        return None
+
+
+class Handle(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.nc = None
+        self.token = None
+        self.mtime = None
+        self.checked = 0
+        self.used = time.time()
+        # Uses in progress, guarded by _lock
+        self.users = 0
+        # Removed from the pool while in use, closed by its last user
+        self.closing = False
+        self.lock = threading.RLock()
+
+    def open(self, token):
+        global _opens
+        self.close()
+        self.token = token
+        self.mtime = _mtime(self.path)
+        self.checked = time.time()
+        try:
+            self.nc = EnhancedDataset(self.path)
+        except (OSError, RuntimeError, FileNotFoundError):
+            try:
+                self.nc = EnhancedMFDataset(self.path, aggdim='time')
+            except (OSError, IndexError, RuntimeError, FileNotFoundError):
+                self.nc = None
+                return
+        _opens += 1
+
+    def changed(self, token):
+        if self.nc is None or token != self.token:
+            return True
+        now = time.time()
+        if now - self.checked > MTIME_CHECK_SECONDS:
+            self.checked = now
+            return _mtime(self.path) != self.mtime
+        return False
+
+    def close(self):
+        if self.nc is not None:
+            try:
+                self.nc.close()
+            except BaseException:
+                logger.exception("Could not close {}".format(self.path))
+            self.nc = None
+
+
+def _evict(keep):
+    """ Close the idle handles and the least recently used ones past the cap, unless in use """
+    now = time.time()
+    over = len(_handles) - settings.NETCDF_POOL_SIZE
+    for key, handle in list(_handles.items()):
+        if handle is keep or handle.users > 0 or (over <= 0 and now - handle.used < settings.NETCDF_POOL_IDLE):
+            continue
+        # Prefetching threads read under the lock without using the handle
+        if not handle.lock.acquire(blocking=False):
+            continue
+        try:
+            handle.close()
+            del _handles[key]
+            over -= 1
+        finally:
+            handle.lock.release()
+
+
+def _used():
+    used = getattr(_local, 'handles', None)
+    if used is None:
+        used = _local.handles = []
+    return used
+
+
+@contextmanager
+def dataset(path, token=None, lane=0):
+    """
+    Yield the pooled netCDF handle of a path, or None if it can not be
+    opened.  Read its data inside `reading()`.
+    """
+    global _reuses
+    key = (path, lane)
+    with _lock:
+        handle = _handles.get(key)
+        if handle is None:
+            handle = Handle(path)
+            _handles[key] = handle
+        _handles.move_to_end(key)
+        handle.users += 1
+        _evict(handle)
+
+    used = _used()
+    try:
+        with handle.lock:
+            # A handle in use by other requests is reopened once they are done
+            if handle.nc is None or (handle.users == 1 and handle.changed(token)):
+                handle.open(token)
+            else:
+                _reuses += 1
+        used.append(handle)
+        try:
+            yield handle.nc
+        finally:
+            used.pop()
+    finally:
+        with _lock:
+            handle.users -= 1
+            handle.used = time.time()
+            if handle.nc is None and handle.users == 0 and _handles.get(key) is handle:
+                del _handles[key]
+            closing = handle.closing and handle.users == 0
+        if closing:
+            with handle.lock:
+                handle.close()
+
+
+@contextmanager
+def reading():
+    """ Hold the lock of the handle this thread used last while reading from it """
+    used = _used()
+    if not used:
+        yield
+        return
+    with used[-1].lock:
+        yield
+
+
+def _lanes(path, pop=False):
+    with _lock:
+        keys = sorted(k for k in _handles if k[0] == path)
+        return [_handles.pop(k) if pop else _handles[k] for k in keys]
+
+
+@contextmanager
+def locked(path):
+    """ Hold the locks of the pooled handles of a path, if there are any """
+    with ExitStack() as stack:
+        # In lane order, as the requests reading from several lanes hold the first one
+        for handle in _lanes(path):
+            stack.enter_context(handle.lock)
+        yield
+
+
+def close(path):
+    """ Close the pooled handles of a path, once they are not in use """
+    for handle in _lanes(path, pop=True):
+        with _lock:
+            handle.closing = handle.users > 0
+        if not handle.closing:
+            with handle.lock:
+                handle.close()
+
+
+def _read_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.READ_WORKERS)
+        return _executor
+
+
+def map_lanes(path, token, func, items):
+    """
+    Return [func(nc, item) for item in items], the first call on this thread
+    with the handle of the path it may already hold and the others
+    concurrently on the read pool, each with another handle of the path
+    """
+    items = list(items)
+    if settings.READ_WORKERS < 1 or len(items) < 2 or green_threads():
+        with dataset(path, token) as nc:
+            return [func(nc, item) for item in items]
+
+    def call(lane, item):
+        with dataset(path, token, lane) as nc:
+            return func(nc, item)
+
+    futures = [_read_pool().submit(call, lane, item) for lane, item in enumerate(items[1:], 1)]
+    try:
+        results = [call(0, items[0])]
+        results += [f.result() for f in futures]
+    finally:
+        for f in futures:
+            f.cancel()
+    return results
+
+
+def stats():
+    return dict(
+        open=len(_handles),
+        maxsize=settings.NETCDF_POOL_SIZE,
+        opens=_opens,
+        reuses=_reuses
+    )
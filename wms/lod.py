@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Level of detail pyramid of triangular meshes.
+
+Each level is a decimation of the mesh by vertex clustering: the nodes are
+binned into square cells, every cell is represented by its node closest to
+the centroid of the cell's nodes, and the faces are rewired to the
+representatives, dropping the ones that collapse.  Faces of every level
+index the nodes of the full mesh, so coordinates and data of any level are
+gathered from the full mesh arrays.
+"""
+import numpy as np
+
+
+MAX_LEVELS = 16
+
+
+def triangles(faces):
+    """ The (n, 3) triangles of a (possibly masked, mixed) faces array """
+    faces = np.ma.filled(np.ma.asarray(faces), -1)[:, :3]
+    return np.asarray(faces[(faces >= 0).all(axis=1)], dtype=np.int64)
+
+
+def edge_length(nodes, faces, sample=100000):
+    """ Median edge length of (a sample of) the triangles of a mesh """
+    faces = faces[::max(1, faces.shape[0] // sample)]
+    a = nodes[faces]
+    lengths = np.hypot(*(a - a[:, [1, 2, 0]]).transpose(2, 0, 1))
+    lengths = lengths[np.isfinite(lengths) & (lengths > 0)]
+    return float(np.median(lengths)) if lengths.size else 0.
+
+
+def decimate(nodes, faces, cell_size):
+    """
+    Cluster the nodes used by `faces` onto a grid of `cell_size` and return
+    the surviving, distinct triangles, still indexing `nodes`.
+    """
+    used = np.unique(faces)
+    lon = nodes[used, 0]
+    lat = nodes[used, 1]
+    valid = np.isfinite(lon) & np.isfinite(lat)
+
+    ix = np.floor((lon - np.nanmin(lon)) / cell_size)
+    iy = np.floor((lat - np.nanmin(lat)) / cell_size)
+    keys = np.where(valid, ix * (np.nanmax(iy) + 1) + iy, -1).astype(np.int64)
+    cells, cell = np.unique(keys, return_inverse=True)
+    cell = cell.ravel()
+
+    # Representative of each cell: the node closest to the centroid
+    count = np.bincount(cell)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cx = np.bincount(cell, np.where(valid, lon, 0)) / count
+        cy = np.bincount(cell, np.where(valid, lat, 0)) / count
+    distance = np.hypot(lon - cx[cell], lat - cy[cell])
+    first = np.lexsort((distance, cell))
+    is_first = np.r_[True, cell[first][1:] != cell[first][:-1]]
+    representative = np.empty(cells.size, dtype=np.int64)
+    representative[cell[first][is_first]] = used[first][is_first]
+    representative[cells == -1] = -1
+
+    lookup = np.full(nodes.shape[0], -1, dtype=np.int64)
+    lookup[used] = representative[cell]
+    decimated = lookup[faces]
+    keep = (
+        (decimated >= 0).all(axis=1) &
+        (decimated[:, 0] != decimated[:, 1]) &
+        (decimated[:, 1] != decimated[:, 2]) &
+        (decimated[:, 0] != decimated[:, 2])
+    )
+    decimated = decimated[keep]
+    _, distinct = np.unique(np.sort(decimated, axis=1), axis=0, return_index=True)
+    return decimated[np.sort(distinct)]
+
+
+def build_levels(nodes, faces, min_faces=1000):
+    """
+    Return [(cell_size, triangles)] of increasingly coarse decimations of a
+    mesh, the first at twice its median edge length, doubling the cell size
+    until a level has less than `min_faces` triangles or stops shrinking.
+    """
+    faces = triangles(faces)
+    cell_size = 2 * edge_length(nodes, faces)
+    levels = []
+    if cell_size <= 0:
+        return levels
+
+    current = faces
+    while len(levels) < MAX_LEVELS and current.shape[0] >= min_faces:
+        decimated = decimate(nodes, current, cell_size)
+        if decimated.shape[0] == 0 or decimated.shape[0] > 0.75 * current.shape[0]:
+            break
+        levels.append((cell_size, decimated))
+        current = decimated
+        cell_size *= 2
+    return levels
+
+
+def pick_level(cell_sizes, pixel_size, pixels):
+    """
+    Index of the coarsest level whose cell size is at most `pixels` pixels
+    of `pixel_size`, or None if the full mesh is needed.
+    """
+    fitting = [i for i, c in enumerate(cell_sizes) if c <= pixels * pixel_size]
+    return fitting[-1] if fitting else None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Render web mercator tiles of a dataset into the tile cache.
+
+Tiles go through the same path as WMS GetMap requests, so they are served
+from the cache afterwards.  Tiles that are already cached are skipped, an
+interrupted run picks up where it stopped when started again.
+"""
+import os
+import time
+from multiprocessing import Pool
+
+from dateutil.parser import parse
+
+from django import db
+from django.conf import settings
+from django.test import RequestFactory
+from django.core.management.base import BaseCommand, CommandError
+
+from wms.models import Dataset
+from wms.utils import get_layer_from_request
+from wms import projections
+from wms import tile_cache
+
+from wms import logger
+
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+_datasets = {}
+
+
+def seed_tile(task):
+    """ Render one tile in a pool worker, returns 'rendered', 'cached' or 'failed' """
+    slug, params = task
+    try:
+        from wms.views import normalize_get_params, enhance_getmap_request
+
+        dataset = _datasets.get(slug)
+        if dataset is None:
+            dataset = _datasets[slug] = Dataset.objects.get(slug=slug)
+
+        request = normalize_get_params(RequestFactory().get('/wms/datasets/{}'.format(slug), params))
+        layer = get_layer_from_request(dataset, request)
+        request = enhance_getmap_request(dataset, layer, request)
+        return 'rendered' if tile_cache.seed(dataset, layer, request) else 'cached'
+    except BaseException:
+        logger.exception("Could not seed tile {}".format(params))
+        return 'failed'
+
+
+def _close_connections():
+    # Forked workers must not share the parent's database connections
+    db.connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Render web mercator tiles of a dataset into the tile cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='Slug of the dataset')
+        parser.add_argument('--layers', help='Comma separated layer names (default: all active layers)')
+        parser.add_argument('--styles', default='', help='Comma separated styles, e.g. pcolor_jet (default: the default style of each layer)')
+        parser.add_argument('--zoom', default='0-8', help='Zoom level or inclusive range of zoom levels, e.g. 3-10')
+        parser.add_argument('--bbox', help='WGS84 bbox minlon,minlat,maxlon,maxlat (default: the bounds of each layer)')
+        parser.add_argument('--time', default='latest', help='"latest", "all" or an ISO 8601 range start/end')
+        parser.add_argument('--size', type=int, default=256, help='Tile size in pixels')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of rendering processes')
+
+    def handle(self, *args, **options):
+        if settings.TILE_CACHE_ENABLED is not True or settings.TILE_CACHE_DISK is not True:
+            raise CommandError('Seeding needs TILE_CACHE_ENABLED and TILE_CACHE_DISK')
+
+        dataset = Dataset.objects.filter(slug=options['dataset']).first()
+        if dataset is None:
+            raise CommandError('No dataset "{}"'.format(options['dataset']))
+
+        if options['layers']:
+            names = options['layers'].split(',')
+            layers = [ly for ly in dataset.all_layers() if ly.var_name in names]
+        else:
+            layers = dataset.active_layers()
+        if not layers:
+            raise CommandError('No layers to seed')
+
+        zooms = [int(z) for z in options['zoom'].split('-')]
+        styles = options['styles'].split(',')
+
+        tasks = []
+        for layer in layers:
+            bbox = self.bbox(dataset, layer, options['bbox'])
+            if bbox is None:
+                self.stderr.write('No bounds for layer {}, skipping'.format(layer.var_name))
+                continue
+            for timestamp in self.times(dataset, layer, options['time']):
+                for style in styles:
+                    for z in range(zooms[0], zooms[-1] + 1):
+                        xmin, ymin, xmax, ymax = projections.tile_range(bbox, z)
+                        for x in range(xmin, xmax + 1):
+                            for y in range(ymin, ymax + 1):
+                                params = dict(
+                                    service='WMS',
+                                    request='GetMap',
+                                    version='1.1.1',
+                                    layers=layer.var_name,
+                                    format='image/png',
+                                    transparent='true',
+                                    width=options['size'],
+                                    height=options['size'],
+                                    srs='EPSG:3857',
+                                    bbox=','.join(str(v) for v in projections.tile_bounds(z, x, y))
+                                )
+                                if style:
+                                    params['styles'] = style
+                                if timestamp is not None:
+                                    params['time'] = timestamp
+                                tasks.append((dataset.slug, params))
+
+        self.stdout.write('Seeding {} tiles of {} with {} processes'.format(len(tasks), dataset.name, options['processes']))
+        counts = dict(rendered=0, cached=0, failed=0)
+        started = time.time()
+        _close_connections()
+        with Pool(options['processes'], initializer=_close_connections) as pool:
+            for done, result in enumerate(pool.imap_unordered(seed_tile, tasks, chunksize=8), 1):
+                counts[result] += 1
+                if done % 100 == 0 or done == len(tasks):
+                    elapsed = time.time() - started
+                    self.stdout.write('{}/{} tiles ({rendered} rendered, {cached} already cached, {failed} failed) in {:.0f}s'.format(
+                        done, len(tasks), elapsed, **counts
+                    ))
+
+        if counts['failed']:
+            self.stderr.write('{} tiles failed, see the log for details'.format(counts['failed']))
+
+    def bbox(self, dataset, layer, requested):
+        if requested:
+            return [float(v) for v in requested.split(',')]
+        bounds = dataset.wgs84_bounds(layer)
+        if bounds is not None:
+            return bounds.bbox
+
+    def times(self, dataset, layer, selection):
+        """ Return the requested times of a layer as ISO 8601 strings, [None] without times """
+        stamps = [t.strftime(TIME_FORMAT) for t in dataset.times(layer)]
+        if not stamps:
+            return [None]
+        if selection == 'latest':
+            return stamps[-1:]
+        elif selection == 'all':
+            return stamps
+        start, end = [parse(t, ignoretz=True) for t in selection.split('/')]
+        return [s for s in stamps if start <= parse(s) <= end]
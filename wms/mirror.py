@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Local mirror of the chunks of remote (OPeNDAP) datasets.
+
+Reads of a mirrored dataset go through a `Variable` proxy.  The hyperslab a
+reader asks for is extended to a fixed chunk grid: one step of the leading
+(time, elevation) dimensions and about MIRROR_CHUNK_ELEMENTS values split
+evenly between the others.  Chunks already on disk are served locally;
+otherwise the aligned hyperslab is fetched in one request and its chunks are
+stored, compressed, under MIRROR_PATH/<dataset>/<generation>/.  An SQLite
+index evicts the least recently used chunks past MIRROR_BYTES.  When the
+chunks can not be stored the remote data is served as it is.
+
+Reads of single points (GetFeatureInfo) or with index arrays are passed to
+the remote variable as they are, the chunks around them would cost more
+than they save.  So are reads with steps (overviews) missing chunks: they
+are only served from the mirror once its chunks are on disk.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import itertools
+
+import numpy as np
+from django.conf import settings
+
+from wms.utils import FileIndex
+from wms import generations
+
+from wms import logger
+
+
+_index = None
+_hits = 0
+_misses = 0
+_fetches = 0
+_failures = 0
+
+
+def root():
+    return settings.MIRROR_PATH
+
+
+def index():
+    global _index
+    if _index is None:
+        _index = FileIndex(os.path.join(root(), 'index.sqlite3'), settings.MIRROR_BYTES)
+        # Not writable mirrors fail to store their chunks (see Variable._store)
+        _index.create()
+    return _index
+
+
+def enabled(dataset):
+    return getattr(dataset, 'mirrored', False) is True
+
+
+def chunk_shape(shape, leading):
+    """
+    Chunks of a variable: one step of its `leading` dimensions and about
+    MIRROR_CHUNK_ELEMENTS values split evenly between the others
+    """
+    spatial = shape[leading:]
+    chunks = [1] * len(spatial)
+    remaining = float(settings.MIRROR_CHUNK_ELEMENTS)
+    # Dimensions shorter than their share leave the rest to the longer ones
+    order = sorted(range(len(spatial)), key=lambda d: spatial[d])
+    for n, d in enumerate(order):
+        side = int(remaining ** (1.0 / (len(order) - n)) + 1e-9)
+        chunks[d] = max(1, min(spatial[d], side))
+        remaining /= chunks[d]
+    return (1,) * leading + tuple(chunks)
+
+
+class Variable(object):
+    """
+    Read-through proxy of a remote variable whose first `leading`
+    dimensions are indexed by the readers prefixes.  Other attributes are
+    the ones of the variable.
+    """
+
+    def __init__(self, dataset, name, variable, leading):
+        self.dataset = dataset
+        self.name = name
+        self.variable = variable
+        self.shape = tuple(variable.shape)
+        self.leading = leading
+        self.chunks = chunk_shape(self.shape, leading)
+
+    def __getattr__(self, name):
+        return getattr(self.variable, name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _bounds(self, key):
+        """ [(start, stop, step, squeeze)] of every dimension, None if the key is not a hyperslab """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > len(self.shape):
+            return None
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+
+        bounds = []
+        for d, k in enumerate(key):
+            size = self.shape[d]
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step < 1 or stop <= start:
+                    return None
+                bounds.append((start, start + step * ((stop - start - 1) // step) + 1, step, False))
+            elif d < self.leading and isinstance(k, (int, np.integer)) and not isinstance(k, bool):
+                k = int(k) + size if k < 0 else int(k)
+                if not 0 <= k < size:
+                    return None
+                bounds.append((k, k + 1, 1, True))
+            else:
+                return None
+        return bounds
+
+    def _chunk_path(self, gen, chunk):
+        name = '_'.join(str(c) for c in chunk)
+        return os.path.join(root(), self.dataset.safe_filename, gen, self.name, '{}.npz'.format(name))
+
+    def __getitem__(self, key):
+        global _hits, _misses, _fetches
+        bounds = self._bounds(key)
+        if bounds is None:
+            return self.variable[key]
+
+        # Chunk coordinates and aligned origin of every dimension
+        ranges = [range(start // c, (stop - 1) // c + 1) for (start, stop, _, _), c in zip(bounds, self.chunks)]
+        origin = [r.start * c for r, c in zip(ranges, self.chunks)]
+        aligned = tuple(slice(o, min(size, r.stop * c)) for o, r, c, size in zip(origin, ranges, self.chunks, self.shape))
+
+        gen = generations.current(self.dataset)
+        chunks = list(itertools.product(*ranges))
+        loaded = {}
+        for chunk in chunks:
+            path = self._chunk_path(gen, chunk)
+            try:
+                if index().get(path) is None:
+                    break
+                with np.load(path) as npz:
+                    loaded[chunk] = (npz['data'], npz['mask'] if 'mask' in npz else None, 'masked' in npz)
+            except (OSError, ValueError, KeyError, sqlite3.Error):
+                break
+
+        if len(loaded) == len(chunks):
+            _hits += len(chunks)
+            block = self._assemble(aligned, chunks, origin, loaded)
+        elif any(step > 1 for _, _, step, _ in bounds):
+            # Fetching the whole chunks would download the values skipped by the steps
+            _misses += len(chunks) - len(loaded)
+            _fetches += 1
+            return self.variable[key]
+        else:
+            _misses += len(chunks) - len(loaded)
+            _fetches += 1
+            block = self.variable[aligned]
+            self._store(gen, chunks, origin, block)
+
+        return block[tuple(
+            0 if squeeze else slice(start - o, stop - o, step)
+            for (start, stop, step, squeeze), o in zip(bounds, origin)
+        )]
+
+    def _chunk_slices(self, chunk, origin):
+        return tuple(slice(c * n - o, min(size, (c + 1) * n) - o) for c, n, o, size in zip(chunk, self.chunks, origin, self.shape))
+
+    def _assemble(self, aligned, chunks, origin, loaded):
+        shape = tuple(s.stop - s.start for s in aligned)
+        data = np.empty(shape, dtype=loaded[chunks[0]][0].dtype)
+        mask = None
+        masked = False
+        for chunk in chunks:
+            chunk_data, chunk_mask, chunk_masked = loaded[chunk]
+            where = self._chunk_slices(chunk, origin)
+            data[where] = chunk_data
+            masked = masked or chunk_masked
+            if chunk_mask is not None:
+                if mask is None:
+                    mask = np.zeros(shape, dtype=bool)
+                mask[where] = chunk_mask
+        if masked:
+            return np.ma.MaskedArray(data, mask=np.ma.nomask if mask is None else mask)
+        return data
+
+    def _store(self, gen, chunks, origin, block):
+        global _failures
+        for chunk in chunks:
+            where = self._chunk_slices(chunk, origin)
+            path = self._chunk_path(gen, chunk)
+            arrays = dict(data=np.ma.getdata(block[where]))
+            if isinstance(block, np.ma.MaskedArray):
+                arrays['masked'] = np.array(True)
+                if np.ma.is_masked(block[where]):
+                    arrays['mask'] = np.ma.getmaskarray(block[where])
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Atomic write
+                tmphandle, tmpsave = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+                try:
+                    with os.fdopen(tmphandle, 'wb') as f:
+                        np.savez_compressed(f, **arrays)
+                    os.replace(tmpsave, path)
+                finally:
+                    if os.path.isfile(tmpsave):
+                        os.remove(tmpsave)
+                evicted = index().add(path, self.dataset.safe_filename, gen, path, 0, os.path.getsize(path))
+            except (OSError, sqlite3.Error) as e:
+                # Once per process, the mirror is likely not writable at all
+                if _failures == 0:
+                    logger.debug("Could not mirror chunk {} of {} under {}: {}".format(chunk, self.name, root(), e))
+                _failures += 1
+                return
+            for old_path, _ in evicted:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+
+def invalidate(dataset):
+    """ Remove the mirrored chunks of the older generations of a dataset """
+    gen = generations.current(dataset)
+    try:
+        index().invalidate(dataset.safe_filename, gen)
+    except (OSError, sqlite3.Error):
+        logger.exception("Could not invalidate the mirror of {}".format(dataset.name))
+        return
+    dataset_root = os.path.join(root(), dataset.safe_filename)
+    if os.path.isdir(dataset_root):
+        for name in os.listdir(dataset_root):
+            if name != gen:
+                shutil.rmtree(os.path.join(dataset_root, name), ignore_errors=True)
+
+
+def stats():
+    try:
+        s = index().stats()
+    except (OSError, sqlite3.Error):
+        s = {}
+    s['hits'] = _hits
+    s['misses'] = _misses
+    s['fetches'] = _fetches
+    s['failures'] = _failures
+    return s
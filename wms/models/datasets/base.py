@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import copy
 import glob
 from urllib.parse import urlparse
 
@@ -14,9 +15,13 @@ from autoslug.settings import slugify as default_slugify
 import numpy as np
 
 from wms.utils import DotDict, calculate_time_windows
-from wms.data_handler import blank_figure
-from wms.mpl_handler import figure_response
+from wms.data_handler import animation_response, blank_response
 from wms import glg_handler
+from wms import encoders
+from wms import generations
+from wms import tile_cache
+from wms import slices
+from wms import mirror
 
 from wms import logger  # noqa
 
@@ -50,6 +55,33 @@ class Dataset(TypedModel):
             if hasattr(x, 'is_valid') and x.is_valid(uri) is True:
                 return x
 
+    @property
+    def png_options(self):
+        """
+        Options of the PNG encoder for this dataset's tiles: the PNG_OPTIONS
+        setting, updated with the valid keys of the "png" object of the json blob
+        """
+        options = dict(settings.PNG_OPTIONS)
+        if isinstance(self.json, dict) and isinstance(self.json.get('png'), dict):
+            for name, value in self.json['png'].items():
+                if encoders.valid_option(name, value):
+                    options[name] = value
+                else:
+                    logger.warning("Ignoring invalid PNG option {}={!r} of {}".format(name, value, self.name))
+        return DotDict(**options)
+
+    @property
+    def mirrored(self):
+        """
+        Whether the reads of this remote dataset go through the local chunk
+        mirror: the MIRROR_ENABLED setting, or the "mirror" boolean of the json blob
+        """
+        if not self.online:
+            return False
+        if isinstance(self.json, dict) and isinstance(self.json.get('mirror'), bool):
+            return self.json['mirror']
+        return settings.MIRROR_ENABLED is True
+
     def path(self):
         if urlparse(self.uri).scheme == "" and not self.uri.startswith("/"):
             # We have a relative path, make it absolute to the sciwms directory.
@@ -91,10 +123,46 @@ class Dataset(TypedModel):
         """ Abstracted here to support many different empty response types"""
         content_type = content_type or 'image/png'
         if content_type == 'image/png':
-            width = request.GET['width']
-            height = request.GET['height']
-            fig = blank_figure(width, height)
-            return figure_response(fig, request)
+            return blank_response(request)
+
+    def animation_times(self, layer, request):
+        """
+        Return the [(time index, time)] frames of an animated GetMap request,
+        the times of the layer within the requested TIME range subsampled to at
+        most ANIMATION_MAX_FRAMES
+        """
+        frames = [(i, t) for i, t in enumerate(self.times(layer)) if request.GET['starting'] <= t <= request.GET['ending']]
+        if not frames:
+            time_index, _ = self.nearest_time(layer, request.GET['time'])
+            return [(time_index, request.GET['time'])]
+        step = int(np.ceil(len(frames) / settings.ANIMATION_MAX_FRAMES))
+        return frames[::step]
+
+    def frame_request(self, request, time):
+        """ The enhanced GetMap request of one frame of an animation, returning an RGBA array """
+        frame_request = copy.copy(request)
+        frame_request.GET = request.GET.copy()
+        frame_request.GET['time'] = time
+        frame_request.GET['keep_rgba'] = True
+        return frame_request
+
+    def getmap_animation(self, layer, request):
+        """
+        Animated GetMap over a TIME range, rendering every frame with getmap.
+        Frames are rendered as the response is streamed.
+        """
+        frames = self.animation_times(layer, request)
+        width = int(request.GET['width'])
+        height = int(request.GET['height'])
+
+        def render():
+            for _, time in frames:
+                response = self.getmap(layer, self.frame_request(request, time))
+                if not hasattr(response, 'rgba'):
+                    raise ValueError('Could not render the frame at {}'.format(time))
+                yield response.rgba if response.rgba is not None else np.zeros((height, width, 4), dtype=np.uint8)
+
+        return animation_response(render(), len(frames), request)
 
     def wgs84_bounds(self, layer):
         raise NotImplementedError
@@ -138,7 +206,13 @@ class Dataset(TypedModel):
     def clear_cache(self):
         cache_file_list = glob.glob(os.path.join(settings.TOPOLOGY_PATH, self.safe_filename + '*'))
         for cache_file in cache_file_list:
-            os.remove(cache_file)
+            if os.path.isfile(cache_file):
+                os.remove(cache_file)
+        # A new generation, so no cache of the removed files is used again
+        generations.advance(self)
+        tile_cache.remove(self)
+        slices.invalidate(self)
+        mirror.invalidate(self)
 
     def active_layers(self):
         layers = self.layer_set.prefetch_related('styles').filter(active=True)
@@ -8,13 +8,21 @@ import netCDF4 as nc4
 
 from django.conf import settings
 
-from pyaxiom.netcdf import EnhancedDataset, EnhancedMFDataset
+from pyaxiom.netcdf import EnhancedDataset
 
-from wms.utils import find_appropriate_time
+from wms.utils import DotDict, LRUCache, find_appropriate_time
+from wms import handles
+from wms import aggregation
+from wms import generations
 from wms.models import VirtualLayer, Layer, Style
 from wms import logger  # noqa
 
 
+# (dataset, generation, layer) -> DotDict(values, units, calendar) of the cached
+# time steps of a layer, or False if it has none
+_time_steps = LRUCache(maxsize=1024)
+
+
 def try_float(obj):
     try:
         return int(obj)
@@ -26,20 +34,20 @@ class NetCDFDataset(object):
 
     @contextmanager
     def dataset(self):
-        try:
-            # Dataset is already loaded
-            self._dataset.variables
-            yield self._dataset
-        except AttributeError:
-            try:
-                self._dataset = EnhancedDataset(self.path())
-                yield self._dataset
-            except (OSError, RuntimeError, FileNotFoundError):
-                try:
-                    self._dataset = EnhancedMFDataset(self.path(), aggdim='time')
-                    yield self._dataset
-                except (OSError, IndexError, RuntimeError, FileNotFoundError):
-                    yield None
+        # Shared by the requests of this process, reopened once the time or grid cache is updated
+        with handles.dataset(self.path(), generations.current(self)) as nc:
+            yield nc
+
+    def read_components(self, read, components):
+        """
+        Return [read(nc, component)] for the components of a VirtualLayer,
+        read concurrently with their own handles of the dataset
+        """
+        # Indexed aggregations read the time steps from the handles of their files, one per file
+        if aggregation.load(self) is not None:
+            with self.dataset() as nc:
+                return [read(nc, component) for component in components]
+        return handles.map_lanes(self.path(), generations.current(self), read, components)
 
     @contextmanager
     def topology(self):
@@ -54,11 +62,10 @@ class NetCDFDataset(object):
                 yield None
 
     def close(self):
-        try:
-            self._dataset.close()
-        except BaseException:
-            pass
+        handles.close(self.path())
+        self.close_topology()
 
+    def close_topology(self):
         try:
             self._topology.close()
         except BaseException:
@@ -68,6 +75,9 @@ class NetCDFDataset(object):
     def topology_file(self):
         return os.path.join(settings.TOPOLOGY_PATH, '{}.nc'.format(self.safe_filename))
 
+    def topology_array_file(self, name):
+        return os.path.join(settings.TOPOLOGY_PATH, '{}.{}.npy'.format(self.safe_filename, name))
+
     @property
     def time_cache_file(self):
         return os.path.join(settings.TOPOLOGY_PATH, '{}.npy'.format(self.safe_filename))
@@ -141,7 +151,8 @@ class NetCDFDataset(object):
         return geo_index, closest_x, closest_y, start_nc_index, end_nc_index, return_dates
 
     def __del__(self):
-        self.close()
+        # The pooled dataset outlives the instance
+        self.close_topology()
 
     def analyze_virtual_layers(self):
         with self.dataset() as nc:
@@ -241,25 +252,59 @@ class NetCDFDataset(object):
 
         self.analyze_virtual_layers()
 
+    def _time_variable(self, nc, layer):
+        """ The time variable of a layer, None if the dataset has none """
+        time_vars = nc.get_variables_by_attributes(standard_name='time')
+
+        if not time_vars:
+            return None
+
+        if len(time_vars) == 1:
+            return time_vars[0]
+
+        # if there is more than variable with standard_name = time
+        # fine the appropriate one to use with the layer
+        var_obj = nc.variables[layer.access_name]
+        time_var_name = find_appropriate_time(var_obj, time_vars)
+        return nc.variables[time_var_name]
+
+    def cached_nearest_time(self, layer, time):
+        """
+        Return the time index nearest_time finds, from the time cache rather
+        than the time variable, or None if the layer has no cached times.
+        Only the first call of each cache generation opens the dataset, for
+        the units of its times.
+        """
+        key = (self.safe_filename, generations.current(self), layer.access_name)
+        steps = _time_steps.get(key)
+        if steps is None:
+            steps = False
+            times = self.times(layer)
+            if isinstance(times, (list, tuple, np.ndarray)) and len(times) > 0:
+                with self.dataset() as nc:
+                    time_var = self._time_variable(nc, layer) if nc is not None else None
+                    if time_var is not None:
+                        units = time_var.units
+                        calendar = getattr(time_var, 'calendar', 'gregorian')
+                        # Exact again after the round trip of the time cache through dates
+                        values = np.round(nc4.date2num(list(times), units=units, calendar=calendar), 6)
+                        steps = DotDict(values=values, units=units, calendar=calendar)
+            _time_steps.set(key, steps)
+        if steps is False:
+            return None
+
+        num_date = round(nc4.date2num(time, units=steps.units, calendar=steps.calendar))
+        return min(int(np.searchsorted(steps.values, num_date, side='left')), len(steps.values) - 1)
+
     def nearest_time(self, layer, time):
         """
         Return the time index and time value that is closest
         """
         with self.dataset() as nc:
-            time_vars = nc.get_variables_by_attributes(standard_name='time')
-
-            if not time_vars:
+            time_var = self._time_variable(nc, layer)
+            if time_var is None:
                 return None, None
 
-            if len(time_vars) == 1:
-                time_var = time_vars[0]
-            else:
-                # if there is more than variable with standard_name = time
-                # fine the appropriate one to use with the layer
-                var_obj = nc.variables[layer.access_name]
-                time_var_name = find_appropriate_time(var_obj, time_vars)
-                time_var = nc.variables[time_var_name]
-
             units = time_var.units
             if hasattr(time_var, 'calendar'):
                 calendar = time_var.calendar
@@ -267,7 +312,13 @@ class NetCDFDataset(object):
                 calendar = 'gregorian'
             num_date = round(nc4.date2num(time, units=units, calendar=calendar))
 
-            times = time_var[:]
+            index = aggregation.load(self)
+            if index is not None and index.has_times(time_var.name, len(time_var)):
+                # Only read the times of the file holding the time step
+                return index.nearest(time_var.name, num_date)
+
+            with handles.reading():
+                times = time_var[:]
 
             time_index = np.searchsorted(times, num_date, side='left')
             time_index = min(time_index, len(times) - 1)  # Don't do over the length of time
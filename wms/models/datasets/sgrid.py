@@ -17,15 +17,22 @@ import pandas as pd
 
 from rtree import index
 
+from django.conf import settings
 from django.core.cache import caches
 
 from wms import mpl_handler
+from wms import raster
 from wms import gfi_handler
 from wms import data_handler
 from wms import gmd_handler
+from wms import topology
+from wms import handles
+from wms import projections
+from wms import slices
+from wms import aggregation
 
 from wms.models import Dataset, Layer, VirtualLayer, NetCDFDataset
-from wms.utils import DotDict, calc_lon_lat_padding, calc_safety_factor, find_appropriate_time
+from wms.utils import calc_lon_lat_padding, calc_safety_factor, compose_slices, find_appropriate_time
 
 from wms import logger
 
@@ -60,6 +67,10 @@ class SGridDataset(Dataset, NetCDFDataset):
         except (OSError, FileNotFoundError, AttributeError):
             return False
 
+    @property
+    def sgrid_metadata_file(self):
+        return os.path.join(settings.TOPOLOGY_PATH, '{}.sgrid.json'.format(self.safe_filename))
+
     def has_grid_cache(self):
         return all([
             os.path.exists(self.topology_file),
@@ -76,7 +87,7 @@ class SGridDataset(Dataset, NetCDFDataset):
 
     def make_rtree(self):
 
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             sg = load_grid(nc)
 
             def rtree_generator_function():
@@ -107,7 +118,7 @@ class SGridDataset(Dataset, NetCDFDataset):
             shutil.move('{}.idx'.format(temp_file), self.face_tree_index_file)
 
     def update_time_cache(self):
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             if nc is None:
                 logger.error("Failed update_time_cache, could not load dataset "
                              "as a netCDF4 object")
@@ -132,10 +143,11 @@ class SGridDataset(Dataset, NetCDFDataset):
             full_cache = {'times': time_cache, 'layers': layer_cache}
             logger.info("Built time cache for {0}".format(self.name))
             caches['time'].set(self.time_cache_file, full_cache, None)
+            aggregation.update(self, nc)
             return full_cache
 
     def update_grid_cache(self, force=False):
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             if nc is None:
                 logger.error("Failed update_grid_cache, could not load dataset "
                              "as a netCDF4 object")
@@ -154,6 +166,16 @@ class SGridDataset(Dataset, NetCDFDataset):
                     logger.error("Failed to create topology_file cache for Dataset '{}'".format(self.dataset.name))
                     return
 
+            # Memory mappable cell centers for requests
+            topology.save_sgrid(self, sg)
+
+            # Projections of the cell centers into the advertised CRSs
+            grid = topology.sgrid(self)
+            projections.save_projected(self, 'centers', grid.lon, grid.lat)
+            for stride in grid.overviews:
+                lon, lat = topology.sgrid_overview(grid, stride)
+                projections.save_projected(self, 'centers.o{}'.format(stride), lon, lat)
+
         # Now do the RTree index
         self.make_rtree()
 
@@ -162,12 +184,9 @@ class SGridDataset(Dataset, NetCDFDataset):
         wgs84_bbox = request.GET['wgs84_bbox']
 
         with self.dataset() as nc:
-            cached_sg = load_grid(self.topology_file)
-            lon_name, lat_name = cached_sg.face_coordinates
-            lon_obj = getattr(cached_sg, lon_name)
-            lat_obj = getattr(cached_sg, lat_name)
-            lon = cached_sg.center_lon[lon_obj.center_slicing]
-            lat = cached_sg.center_lat[lat_obj.center_slicing]
+            grid = topology.sgrid(self)
+            lon = grid.lon
+            lat = grid.lat
             spatial_idx = data_handler.lat_lon_subset_idx(lon, lat,
                                                           lonmin=wgs84_bbox.minx,
                                                           latmin=wgs84_bbox.miny,
@@ -175,23 +194,16 @@ class SGridDataset(Dataset, NetCDFDataset):
                                                           latmax=wgs84_bbox.maxy)
             subset_lon = np.unique(spatial_idx[0])
             subset_lat = np.unique(spatial_idx[1])
-            grid_variables = cached_sg.grid_variables
+            grid_variables = grid.grid_variables
 
             vmin = None
             vmax = None
             raw_data = None
             if isinstance(layer, Layer):
-                data_obj = getattr(cached_sg, layer.access_name)
+                data_obj = grid.variables[layer.access_name]
                 raw_var = nc.variables[layer.access_name]
-                if len(raw_var.shape) == 4:
-                    z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                    raw_data = raw_var[time_index, z_index, subset_lon, subset_lat]
-                elif len(raw_var.shape) == 3:
-                    raw_data = raw_var[time_index, subset_lon, subset_lat]
-                elif len(raw_var.shape) == 2:
-                    raw_data = raw_var[subset_lon, subset_lat]
-                else:
-                    raise BaseException('Unable to trim variable {0} data.'.format(layer.access_name))
+                prefix = self._raw_prefix(layer, layer.access_name, raw_var, time_index, request)
+                raw_data = self._read_raw(layer.access_name, raw_var, prefix)[np.ix_(subset_lon, subset_lat)]
 
                 # handle grid variables
                 if set([layer.access_name]).issubset(grid_variables):
@@ -204,20 +216,16 @@ class SGridDataset(Dataset, NetCDFDataset):
                 x_var = None
                 y_var = None
                 raw_vars = []
+                components = []
                 for l in layer.layers:
-                    data_obj = getattr(cached_sg, l.access_name)
                     raw_var = nc.variables[l.access_name]
                     raw_vars.append(raw_var)
-                    if len(raw_var.shape) == 4:
-                        z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                        raw_data = raw_var[time_index, z_index, subset_lon, subset_lat]
-                    elif len(raw_var.shape) == 3:
-                        raw_data = raw_var[time_index, subset_lon, subset_lat]
-                    elif len(raw_var.shape) == 2:
-                        raw_data = raw_var[subset_lon, subset_lat]
-                    else:
-                        raise BaseException('Unable to trim variable {0} data.'.format(l.access_name))
+                    components.append((l.access_name, self._raw_prefix(layer, l.access_name, raw_var, time_index, request)))
+                subset = np.ix_(subset_lon, subset_lat)
+                raw_datas = self.read_components(lambda c_nc, c: self._read_raw(c[0], c_nc.variables[c[0]], c[1])[subset], components)
 
+                for l, raw_data in zip(layer.layers, raw_datas):
+                    data_obj = grid.variables[l.access_name]
                     if x_var is None:
                         if data_obj.vector_axis and data_obj.vector_axis.lower() == 'x':
                             x_var = raw_data
@@ -246,33 +254,43 @@ class SGridDataset(Dataset, NetCDFDataset):
         wgs84_bbox = request.GET['wgs84_bbox']
 
         with self.dataset() as nc:
-            cached_sg = load_grid(self.topology_file)
-            lon_name, lat_name = cached_sg.face_coordinates
-            lon_obj = getattr(cached_sg, lon_name)
-            lat_obj = getattr(cached_sg, lat_name)
-            lon = cached_sg.center_lon[lon_obj.center_slicing]
-            lat = cached_sg.center_lat[lat_obj.center_slicing]
+            grid = topology.sgrid(self)
+            lon = grid.lon
+            lat = grid.lat
+            x, y = projections.projected(self, 'centers', lon, lat, request.GET['crs'])
 
             if isinstance(layer, Layer):
-                data_obj = getattr(cached_sg, layer.access_name)
+                data_obj = grid.variables[layer.access_name]
                 raw_var = nc.variables[layer.access_name]
-                if len(raw_var.shape) == 4:
-                    z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                    raw_data = raw_var[time_index, z_index, data_obj.center_slicing[-2], data_obj.center_slicing[-1]]
-                elif len(raw_var.shape) == 3:
-                    raw_data = raw_var[time_index, data_obj.center_slicing[-2], data_obj.center_slicing[-1]]
-                elif len(raw_var.shape) == 2:
-                    raw_data = raw_var[data_obj.center_slicing]
-                else:
-                    raise BaseException('Unable to trim variable {0} data.'.format(layer.access_name))
-                # handle edge variables
-                if data_obj.location is not None and 'edge' in data_obj.location:
-                    raw_data = avg_to_cell_center(raw_data, data_obj.center_axis)
+                is_edge = data_obj.location is not None and 'edge' in data_obj.location
+
+                # Zoomed out tiles read a strided overview of the grid
+                stride = 1 if is_edge else self._overview_stride(grid, request)
+                if stride > 1:
+                    lon, lat = topology.sgrid_overview(grid, stride)
+                    x, y = projections.projected(self, 'centers.o{}'.format(stride), lon, lat, request.GET['crs'])
+
+                if request.GET['image_type'] == 'pcolor' and request.GET['renderer'] == 'numpy':
+                    crs_code = projections.crs_code(request.GET['crs'])
+                    window, pixel_cell = raster.grid_pixel_index(x, y, request, key=(self.safe_filename, grid.mtime, crs_code, stride))
+                    if window is None:
+                        return self.empty_response(layer, request)
+
+                    colorscalerange = request.GET['colorscalerange']
+                    if is_edge or colorscalerange.min is None or colorscalerange.max is None:
+                        # Averaging edges and autoscaling need the whole grid
+                        raw_data = self._read_centers(layer, request, raw_var, data_obj, time_index, stride=stride)
+                        return raster.pcolormesh_response(raw_data[window], pixel_cell, request, autoscale_data=raw_data)
+
+                    raw_data = self._read_centers(layer, request, raw_var, data_obj, time_index, window=window, stride=stride)
+                    return raster.pcolormesh_response(raw_data, pixel_cell, request)
+
+                raw_data = self._read_centers(layer, request, raw_var, data_obj, time_index, stride=stride)
 
                 if request.GET['image_type'] == 'pcolor':
-                    return mpl_handler.pcolormesh_response(lon, lat, data=raw_data, request=request)
+                    return mpl_handler.pcolormesh_response(x, y, data=raw_data, request=request)
                 elif request.GET['image_type'] in ['filledhatches', 'hatches', 'filledcontours', 'contours']:
-                    return mpl_handler.contouring_response(lon, lat, data=raw_data, request=request)
+                    return mpl_handler.contouring_response(x, y, data=raw_data, request=request)
                 else:
                     raise NotImplementedError('Image type "{}" is not supported.'.format(request.GET['image_type']))
 
@@ -280,20 +298,17 @@ class SGridDataset(Dataset, NetCDFDataset):
                 x_var = None
                 y_var = None
                 raw_vars = []
+                components = []
                 for l in layer.layers:
-                    data_obj = getattr(cached_sg, l.access_name)
+                    data_obj = grid.variables[l.access_name]
                     raw_var = nc.variables[l.access_name]
                     raw_vars.append(raw_var)
-                    if len(raw_var.shape) == 4:
-                        z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                        raw_data = raw_var[time_index, z_index, data_obj.center_slicing[-2], data_obj.center_slicing[-1]]
-                    elif len(raw_var.shape) == 3:
-                        raw_data = raw_var[time_index, data_obj.center_slicing[-2], data_obj.center_slicing[-1]]
-                    elif len(raw_var.shape) == 2:
-                        raw_data = raw_var[data_obj.center_slicing]
-                    else:
-                        raise BaseException('Unable to trim variable {0} data.'.format(l.access_name))
+                    prefix = self._raw_prefix(layer, l.access_name, raw_var, time_index, request)
+                    components.append((l.access_name, prefix, data_obj.center_slicing[-2], data_obj.center_slicing[-1]))
+                raw_datas = self.read_components(lambda c_nc, c: self._read_raw(c[0], c_nc.variables[c[0]], *c[1:]), components)
 
+                for l, raw_data in zip(layer.layers, raw_datas):
+                    data_obj = grid.variables[l.access_name]
                     raw_data = avg_to_cell_center(raw_data, data_obj.center_axis)
                     if x_var is None:
                         if data_obj.vector_axis and data_obj.vector_axis.lower() == 'x':
@@ -315,7 +330,7 @@ class SGridDataset(Dataset, NetCDFDataset):
                     raise AttributeError('One or both of the specified variables has incorrect dimensions.')
 
                 if request.GET['image_type'] == 'vectors':
-                    angles = cached_sg.angles[lon_obj.center_slicing]
+                    angles = grid.angles
                     vectorstep = request.GET['vectorstep']
                     # don't do this if the vectorstep is 1; let's save a microsecond or two
                     # it's identical to getting all the data
@@ -324,6 +339,8 @@ class SGridDataset(Dataset, NetCDFDataset):
                         step_slice = (np.s_[::vectorstep],) * data_dim  # make sure the vector step is used for all applicable dimensions
                         lon = lon[step_slice]
                         lat = lat[step_slice]
+                        x = x[step_slice]
+                        y = y[step_slice]
                         x_var = x_var[step_slice]
                         y_var = y_var[step_slice]
                         angles = angles[step_slice]
@@ -339,14 +356,14 @@ class SGridDataset(Dataset, NetCDFDataset):
                                                                   latmax=wgs84_bbox.maxy,
                                                                   padding=spatial_idx_padding
                                                                   )
-                    subset_lon = self._spatial_data_subset(lon, spatial_idx)
-                    subset_lat = self._spatial_data_subset(lat, spatial_idx)
+                    subset_x = self._spatial_data_subset(x, spatial_idx)
+                    subset_y = self._spatial_data_subset(y, spatial_idx)
                     # rotate vectors
                     x_rot, y_rot = rotate_vectors(x_var, y_var, angles)
                     spatial_subset_x_rot = self._spatial_data_subset(x_rot, spatial_idx)
                     spatial_subset_y_rot = self._spatial_data_subset(y_rot, spatial_idx)
-                    return mpl_handler.quiver_response(subset_lon,
-                                                       subset_lat,
+                    return mpl_handler.quiver_response(subset_x,
+                                                       subset_y,
                                                        spatial_subset_x_rot,
                                                        spatial_subset_y_rot,
                                                        request,
@@ -363,14 +380,15 @@ class SGridDataset(Dataset, NetCDFDataset):
 
             return_arrays = []
             z_value = None
+            times = slice(start_time_index, end_time_index)
             if isinstance(layer, Layer):
                 if len(data_obj.shape) == 4:
                     z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                    data = data_obj[start_time_index:end_time_index, z_index, geo_index[0], geo_index[1]]
+                    data = self._read_raw(layer.access_name, data_obj, (times, z_index), int(geo_index[0]), int(geo_index[1]))
                 elif len(data_obj.shape) == 3:
-                    data = data_obj[start_time_index:end_time_index, geo_index[0], geo_index[1]]
+                    data = self._read_raw(layer.access_name, data_obj, (times,), int(geo_index[0]), int(geo_index[1]))
                 elif len(data_obj.shape) == 2:
-                    data = data_obj[geo_index[0], geo_index[1]]
+                    data = self._read_raw(layer.access_name, data_obj, (), int(geo_index[0]), int(geo_index[1]))
                 else:
                     raise ValueError("Dimension Mismatch: data_obj.shape == {0} and time indexes = {1} to {2}".format(data_obj.shape, start_time_index, end_time_index))
 
@@ -382,11 +400,11 @@ class SGridDataset(Dataset, NetCDFDataset):
                 for l in layer.layers:
                     if len(data_obj.shape) == 4:
                         z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                        data = data_obj[start_time_index:end_time_index, z_index, geo_index[0], geo_index[1]]
+                        data = self._read_raw(layer.access_name, data_obj, (times, z_index), int(geo_index[0]), int(geo_index[1]))
                     elif len(data_obj.shape) == 3:
-                        data = data_obj[start_time_index:end_time_index, geo_index[0], geo_index[1]]
+                        data = self._read_raw(layer.access_name, data_obj, (times,), int(geo_index[0]), int(geo_index[1]))
                     elif len(data_obj.shape) == 2:
-                        data = data_obj[geo_index[0], geo_index[1]]
+                        data = self._read_raw(layer.access_name, data_obj, (), int(geo_index[0]), int(geo_index[1]))
                     else:
                         raise ValueError("Dimension Mismatch: data_obj.shape == {0} and time indexes = {1} to {2}".format(data_obj.shape, start_time_index, end_time_index))
                     return_arrays.append((l.var_name, data))
@@ -416,25 +434,9 @@ class SGridDataset(Dataset, NetCDFDataset):
 
     def wgs84_bounds(self, layer):
         try:
-            cached_sg = load_grid(self.topology_file)
+            return topology.sgrid(self).bounds
         except BaseException:
             pass
-        else:
-            lon_name, lat_name = cached_sg.face_coordinates
-            lon_var_obj = getattr(cached_sg, lon_name)
-            lat_var_obj = getattr(cached_sg, lat_name)
-            lon_trimmed = cached_sg.center_lon[lon_var_obj.center_slicing]
-            lat_trimmed = cached_sg.center_lat[lat_var_obj.center_slicing]
-            lon_max = lon_trimmed.max()
-            lon_min = lon_trimmed.min()
-            lat_max = lat_trimmed.max()
-            lat_min = lat_trimmed.min()
-            return DotDict(minx=lon_min,
-                           miny=lat_min,
-                           maxx=lon_max,
-                           maxy=lat_max,
-                           bbox=(lon_min, lat_min, lon_max, lat_max)
-                           )
 
     def nearest_z(self, layer, z):
         """
@@ -482,6 +484,66 @@ class SGridDataset(Dataset, NetCDFDataset):
             except AttributeError:
                 pass
 
+    def _overview_stride(self, grid, request):
+        """
+        Largest overview stride of the grid leaving at least one cell per pixel
+        of the requested image, estimated from the cells of the coarsest
+        overview inside the bbox.
+        """
+        if not grid.overviews:
+            return 1
+        coarsest = max(grid.overviews)
+        lon, lat = topology.sgrid_overview(grid, coarsest)
+        x, y = projections.projected(self, 'centers.o{}'.format(coarsest), lon, lat, request.GET['crs'])
+        bbox = request.GET['bbox']
+        with np.errstate(invalid='ignore'):
+            inside = np.count_nonzero((x >= bbox.minx) & (x <= bbox.maxx) & (y >= bbox.miny) & (y <= bbox.maxy))
+        cells_per_pixel = inside * coarsest ** 2 / (int(request.GET['width']) * int(request.GET['height']))
+
+        stride = 1
+        for s in sorted(grid.overviews):
+            if s * s <= cells_per_pixel:
+                stride = s
+        return stride
+
+    def _read_centers(self, layer, request, raw_var, data_obj, time_index, window=None, stride=1):
+        """
+        Read a variable trimmed to the cell centers, optionally only every
+        `stride`th row and column (see topology.sgrid_overview) and only the
+        (rows, columns) window of those centers returned by raster.grid_window.
+        Reads go through the slice cache.
+        """
+        rows, columns = data_obj.center_slicing[-2], data_obj.center_slicing[-1]
+        if stride > 1:
+            rows = compose_slices(rows, raw_var.shape[-2], slice(None, None, stride))
+            columns = compose_slices(columns, raw_var.shape[-1], slice(None, None, stride))
+        if window is not None:
+            rows = compose_slices(rows, raw_var.shape[-2], window[0])
+            columns = compose_slices(columns, raw_var.shape[-1], window[1])
+
+        prefix = self._raw_prefix(layer, layer.access_name, raw_var, time_index, request)
+        raw_data = self._read_raw(layer.access_name, raw_var, prefix, rows, columns)
+        # handle edge variables
+        if data_obj.location is not None and 'edge' in data_obj.location:
+            raw_data = avg_to_cell_center(raw_data, data_obj.center_axis)
+        return raw_data
+
+    def _raw_prefix(self, layer, name, raw_var, time_index, request):
+        """ Index of the time and elevation dimensions of a variable, before its two grid dimensions """
+        if len(raw_var.shape) == 4:
+            z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
+            return (time_index, z_index)
+        elif len(raw_var.shape) == 3:
+            return (time_index,)
+        elif len(raw_var.shape) == 2:
+            return ()
+        raise BaseException('Unable to trim variable {0} data.'.format(name))
+
+    def _read_raw(self, name, raw_var, prefix, rows=slice(None), columns=slice(None)):
+        """ Read the rows and columns (slices or single indexes) of a variable through the slice cache """
+        region = tuple(slices.slice_key(s) if isinstance(s, slice) else s for s in (rows, columns))
+        return slices.read(self, name, raw_var, prefix, region, lambda v, p: v[p + (rows, columns)])
+
     def _spatial_data_subset(self, data, spatial_index):
         rows = spatial_index[0, :]
         columns = spatial_index[1, :]
@@ -17,15 +17,22 @@ import matplotlib.tri as Tri
 
 from rtree import index
 
+from django.conf import settings
 from django.core.cache import caches
 
 from wms import data_handler
 from wms import mpl_handler
+from wms import raster
 from wms import gfi_handler
 from wms import gmd_handler
+from wms import topology
+from wms import handles
+from wms import projections
+from wms import slices
+from wms import aggregation
 
 from wms.models import Dataset, Layer, VirtualLayer, NetCDFDataset
-from wms.utils import DotDict, calc_lon_lat_padding, calc_safety_factor, find_appropriate_time
+from wms.utils import DotDict, calc_lon_lat_padding, calc_safety_factor, find_appropriate_time, index_ranges
 
 from wms import logger
 
@@ -46,6 +53,12 @@ class UGridDataset(Dataset, NetCDFDataset):
         except (FileNotFoundError, AttributeError):
             return False
 
+    def ugrid_metadata_file(self, mesh_name):
+        return os.path.join(settings.TOPOLOGY_PATH, '{}.{}.ugrid.json'.format(self.safe_filename, mesh_name))
+
+    def lod_metadata_file(self, mesh_name):
+        return os.path.join(settings.TOPOLOGY_PATH, '{}.{}.lod.json'.format(self.safe_filename, mesh_name))
+
     def has_grid_cache(self):
         return os.path.exists(self.topology_file)
 
@@ -58,7 +71,7 @@ class UGridDataset(Dataset, NetCDFDataset):
 
     def make_rtree(self):
 
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             ug = UGrid.from_nc_dataset(nc=nc)
 
             def rtree_faces_generator_function():
@@ -108,7 +121,7 @@ class UGridDataset(Dataset, NetCDFDataset):
             shutil.move('{}.idx'.format(node_temp_file), self.node_tree_index_file)
 
     def update_time_cache(self):
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             if nc is None:
                 logger.error("Failed update_time_cache, could not load dataset "
                              "as a netCDF4 object")
@@ -133,10 +146,11 @@ class UGridDataset(Dataset, NetCDFDataset):
             full_cache = {'times': time_cache, 'layers': layer_cache}
             logger.info("Built time cache for {0}".format(self.name))
             caches['time'].set(self.time_cache_file, full_cache, None)
+            aggregation.update(self, nc)
             return full_cache
 
     def update_grid_cache(self, force=False):
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             if nc is None:
                 logger.error("Failed update_grid_cache, could not load dataset "
                              "as a netCDF4 object")
@@ -156,6 +170,16 @@ class UGridDataset(Dataset, NetCDFDataset):
                     logger.error("Failed to create topology_file cache for Dataset '{}'".format(self.dataset.name))
                     return
 
+            topology.save_ugrid(self, ug)
+            topology.save_face_index(self, ug.mesh_name)
+            topology.save_lod(self, ug.mesh_name)
+
+            # Projections of the coordinates into the advertised CRSs
+            projections.save_projected(self, '{}.node'.format(ug.mesh_name), ug.nodes[:, 0], ug.nodes[:, 1])
+            for location, coords in (('face', ug.face_coordinates), ('edge', ug.edge_coordinates)):
+                if coords is not None:
+                    projections.save_projected(self, '{}.{}'.format(ug.mesh_name, location), coords[:, 0], coords[:, 1])
+
         # Now do the RTree index
         self.make_rtree()
 
@@ -168,7 +192,7 @@ class UGridDataset(Dataset, NetCDFDataset):
             data_location = data_obj.location
             mesh_name = data_obj.mesh
 
-            ug = UGrid.from_ncfile(self.topology_file, mesh_name=mesh_name)
+            ug = topology.ugrid(self, mesh_name)
             coords = np.empty(0)
             if data_location == 'node':
                 coords = ug.nodes
@@ -187,11 +211,11 @@ class UGridDataset(Dataset, NetCDFDataset):
             if isinstance(layer, Layer):
                 if (len(data_obj.shape) == 3):
                     z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                    data = data_obj[time_index, z_index, spatial_idx]
+                    data = self._read_mesh(layer.access_name, data_obj, (time_index, z_index))[spatial_idx]
                 elif (len(data_obj.shape) == 2):
-                    data = data_obj[time_index, spatial_idx]
+                    data = self._read_mesh(layer.access_name, data_obj, (time_index,))[spatial_idx]
                 elif len(data_obj.shape) == 1:
-                    data = data_obj[spatial_idx]
+                    data = self._read_mesh(layer.access_name, data_obj, ())[spatial_idx]
                 else:
                     logger.debug("Dimension Mismatch: data_obj.shape == {0} and time = {1}".format(data_obj.shape, time_value))
 
@@ -201,18 +225,14 @@ class UGridDataset(Dataset, NetCDFDataset):
             elif isinstance(layer, VirtualLayer):
 
                 # Data needs to be [var1,var2] where var are 1D (nodes only, elevation and time already handled)
-                data = []
+                components = []
                 for l in layer.layers:
-                    data_obj = nc.variables[l.var_name]
-                    if (len(data_obj.shape) == 3):
-                        z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                        data.append(data_obj[time_index, z_index, spatial_idx])
-                    elif (len(data_obj.shape) == 2):
-                        data.append(data_obj[time_index, spatial_idx])
-                    elif len(data_obj.shape) == 1:
-                        data.append(data_obj[spatial_idx])
+                    prefix = self._mesh_prefix(layer, nc.variables[l.var_name], time_index, request)
+                    if prefix is None:
+                        logger.debug("Dimension Mismatch: data_obj.shape == {0} and time = {1}".format(nc.variables[l.var_name].shape, time_value))
                     else:
-                        logger.debug("Dimension Mismatch: data_obj.shape == {0} and time = {1}".format(data_obj.shape, time_value))
+                        components.append((l.var_name, prefix))
+                data = self.read_components(lambda c_nc, c: self._read_mesh(c[0], c_nc.variables[c[0]], c[1])[spatial_idx], components)
 
                 if ',' in layer.var_name and data:
                     # Vectors, so return magnitude
@@ -234,7 +254,7 @@ class UGridDataset(Dataset, NetCDFDataset):
             data_location = data_obj.location
             mesh_name = data_obj.mesh
 
-            ug = UGrid.from_ncfile(self.topology_file, mesh_name=mesh_name)
+            ug = topology.ugrid(self, mesh_name)
             coords = np.empty(0)
             if data_location == 'node':
                 coords = ug.nodes
@@ -246,55 +266,61 @@ class UGridDataset(Dataset, NetCDFDataset):
             lon = coords[:, 0]
             lat = coords[:, 1]
 
-            # Calculate any vector padding if we need to
-            padding = None
-            vector_step = request.GET['vectorstep']
-            if request.GET['image_type'] == 'vectors':
-                padding_factor = calc_safety_factor(request.GET['vectorscale'])
-                padding = calc_lon_lat_padding(lon, lat, padding_factor) * vector_step
-
-            # Calculate the boolean spatial mask to slice with
-            bool_spatial_idx = data_handler.ugrid_lat_lon_subset_idx(lon, lat,
-                                                                     bbox=wgs84_bbox.bbox,
-                                                                     padding=padding)
-
-            # Randomize vectors to subset if we need to
-            if request.GET['image_type'] == 'vectors' and vector_step > 1:
-                num_vec = int(bool_spatial_idx.size / vector_step)
-                step = int(bool_spatial_idx.size / num_vec)
-                bool_spatial_idx[np.where(bool_spatial_idx==True)][0::step] = False  # noqa: E225
-
-            # If no triangles intersect the field of view, return a transparent tile
-            if not np.any(bool_spatial_idx):
-                logger.info("No triangles in field of view, returning empty tile.")
-                return self.empty_response(layer, request)
+            if isinstance(layer, Layer) and request.GET['image_type'] in ['pcolor', 'contours', 'filledcontours']:
+                faces_subset, face_idx, read_idx = self._tile_faces(ug, mesh_name, data_location, request)
+                if faces_subset.shape[0] == 0:
+                    logger.info("No triangles in field of view, returning empty tile.")
+                    return self.empty_response(layer, request)
+
+                # Triangles are always drawn between the nodes
+                x, y = projections.projected(self, '{}.node'.format(mesh_name), ug.nodes[:, 0], ug.nodes[:, 1], request.GET['crs'])
+            else:
+                read_idx = None
+
+                # Calculate any vector padding if we need to
+                padding = None
+                vector_step = request.GET['vectorstep']
+                if request.GET['image_type'] == 'vectors':
+                    padding_factor = calc_safety_factor(request.GET['vectorscale'])
+                    padding = calc_lon_lat_padding(lon, lat, padding_factor) * vector_step
+
+                # Calculate the boolean spatial mask to slice with
+                bool_spatial_idx = data_handler.ugrid_lat_lon_subset_idx(lon, lat,
+                                                                         bbox=wgs84_bbox.bbox,
+                                                                         padding=padding)
+
+                # Randomize vectors to subset if we need to
+                if request.GET['image_type'] == 'vectors' and vector_step > 1:
+                    num_vec = int(bool_spatial_idx.size / vector_step)
+                    step = int(bool_spatial_idx.size / num_vec)
+                    bool_spatial_idx[np.where(bool_spatial_idx==True)][0::step] = False  # noqa: E225
+
+                # If no triangles intersect the field of view, return a transparent tile
+                if not np.any(bool_spatial_idx):
+                    logger.info("No triangles in field of view, returning empty tile.")
+                    return self.empty_response(layer, request)
+
+                x, y = projections.projected(self, '{}.{}'.format(mesh_name, data_location), lon, lat, request.GET['crs'])
 
             if isinstance(layer, Layer):
                 if (len(data_obj.shape) == 3):
                     z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                    data = data_obj[time_index, z_index, :]
+                    prefix = (time_index, z_index)
                 elif (len(data_obj.shape) == 2):
-                    data = data_obj[time_index, :]
+                    prefix = (time_index,)
                 elif len(data_obj.shape) == 1:
-                    data = data_obj[:]
+                    prefix = ()
                 else:
                     logger.debug("Dimension Mismatch: data_obj.shape == {0} and time = {1}".format(data_obj.shape, time_value))
                     return self.empty_response(layer, request)
+                data = self._read_mesh_data(layer.access_name, data_obj, prefix, read_idx, request)
 
                 if request.GET['image_type'] in ['pcolor', 'contours', 'filledcontours']:
-                    # Avoid triangles with nan values
-                    bool_spatial_idx[np.isnan(data)] = False
-
-                    # Get the faces to plot
-                    faces = ug.faces[:]
-                    face_idx = data_handler.face_idx_from_node_idx(faces, bool_spatial_idx)
-                    faces_subset = faces[face_idx]
-                    tri_subset = Tri.Triangulation(lon, lat, triangles=faces_subset)
-
-                    if request.GET['image_type'] == 'pcolor':
-                        return mpl_handler.tripcolor_response(tri_subset, data, request, data_location=data_location)
-                    else:
-                        return mpl_handler.tricontouring_response(tri_subset, data, request)
+                    faces_subset, data = self._valid_faces(data, data_location, faces_subset, face_idx)
+                    if faces_subset.size == 0:
+                        return self.empty_response(layer, request)
+                    tri_subset = Tri.Triangulation(x, y, triangles=faces_subset)
+                    return self._draw_faces(tri_subset, data, data_location, request)
                 elif request.GET['image_type'] in ['filledhatches', 'hatches']:
                     raise NotImplementedError('matplotlib does not support hatching on triangular grids... sorry!')
                 else:
@@ -302,29 +328,180 @@ class UGridDataset(Dataset, NetCDFDataset):
 
             elif isinstance(layer, VirtualLayer):
                 # Data needs to be [var1,var2] where var are 1D (nodes only, elevation and time already handled)
-                data = []
+                components = []
                 for l in layer.layers:
-                    data_obj = nc.variables[l.var_name]
-                    if (len(data_obj.shape) == 3):
-                        z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                        data.append(data_obj[time_index, z_index, bool_spatial_idx])
-                    elif (len(data_obj.shape) == 2):
-                        data.append(data_obj[time_index, bool_spatial_idx])
-                    elif len(data_obj.shape) == 1:
-                        data.append(data_obj[bool_spatial_idx])
-                    else:
-                        logger.debug("Dimension Mismatch: data_obj.shape == {0} and time = {1}".format(data_obj.shape, time_value))
+                    prefix = self._mesh_prefix(layer, nc.variables[l.var_name], time_index, request)
+                    if prefix is None:
+                        logger.debug("Dimension Mismatch: data_obj.shape == {0} and time = {1}".format(nc.variables[l.var_name].shape, time_value))
                         return self.empty_response(layer, request)
+                    components.append((l.var_name, prefix))
+                data = self.read_components(lambda c_nc, c: self._read_mesh(c[0], c_nc.variables[c[0]], c[1])[bool_spatial_idx], components)
 
                 if request.GET['image_type'] == 'vectors':
-                    return mpl_handler.quiver_response(lon[bool_spatial_idx],
-                                                       lat[bool_spatial_idx],
+                    return mpl_handler.quiver_response(x[bool_spatial_idx],
+                                                       y[bool_spatial_idx],
                                                        data[0],
                                                        data[1],
                                                        request)
                 else:
                     raise NotImplementedError('Image type "{}" is not supported.'.format(request.GET['image_type']))
 
+    def _tile_faces(self, ug, mesh_name, data_location, request):
+        """
+        Return the faces drawn for a tile, the indexes of those faces in the
+        mesh (None when drawn from a decimated mesh) and the sorted indexes of
+        the data elements the faces need.
+        """
+        wgs84_bbox = request.GET['wgs84_bbox']
+        faces_subset = None
+        face_idx = None
+        if data_location == 'node':
+            # Zoomed out tiles are drawn from a decimated mesh (see wms.lod)
+            pixel_size = min((wgs84_bbox.maxx - wgs84_bbox.minx) / int(request.GET['width']),
+                             (wgs84_bbox.maxy - wgs84_bbox.miny) / int(request.GET['height']))
+            faces_subset = topology.lod_faces(self, mesh_name, wgs84_bbox.bbox, pixel_size)
+        if faces_subset is None:
+            # Faces intersecting the field of view, from the packed face index
+            face_idx = topology.query_faces(self, mesh_name, wgs84_bbox.bbox)
+            faces_subset = ug.faces[face_idx]
+
+        read_idx = None
+        if data_location == 'node':
+            read_idx = np.unique(np.ma.compressed(faces_subset))
+        elif data_location == 'face':
+            read_idx = face_idx
+        return faces_subset, face_idx, read_idx
+
+    def _valid_faces(self, data, data_location, faces_subset, face_idx):
+        """ Drop the faces with nan values, returns the faces and the data to draw them with """
+        invalid = np.isnan(np.ma.filled(np.ma.asarray(data, dtype=np.float64), np.nan))
+        if data_location == 'face':
+            valid = ~invalid[face_idx]
+            return faces_subset[valid], data[face_idx[valid]]
+        elif data_location == 'node':
+            return faces_subset[~invalid[faces_subset].any(axis=1)], data
+        return faces_subset, data
+
+    def _draw_faces(self, tri_subset, data, data_location, request):
+        if request.GET['image_type'] == 'pcolor':
+            if request.GET['renderer'] == 'numpy':
+                return raster.tripcolor_response(tri_subset, data, request, data_location=data_location, shading=request.GET['shading'])
+            return mpl_handler.tripcolor_response(tri_subset, data, request, data_location=data_location, shading=request.GET['shading'])
+        else:
+            return mpl_handler.tricontouring_response(tri_subset, data, request)
+
+    def _mesh_ranges(self, size, indexes, request):
+        """
+        Given the sorted `indexes` of the elements a tile needs, return a few
+        contiguous ranges of the mesh around them to read, or None to read the
+        whole mesh: when the request autoscales its colors over the whole mesh
+        or the ranges would cover most of it.
+        """
+        colorscalerange = request.GET['colorscalerange']
+        if indexes is not None and colorscalerange.min is not None and colorscalerange.max is not None:
+            ranges = index_ranges(indexes, settings.UGRID_READ_RANGES)
+            # Reading most of the mesh in pieces is slower than a single read
+            if sum(s.stop - s.start for s in ranges) < size / 2:
+                return ranges
+
+    def _mesh_prefix(self, layer, data_obj, time_index, request):
+        """ Index of the time and elevation dimensions of a variable, before its mesh dimension """
+        if len(data_obj.shape) == 3:
+            z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
+            return (time_index, z_index)
+        elif len(data_obj.shape) == 2:
+            return (time_index,)
+        elif len(data_obj.shape) == 1:
+            return ()
+
+    def _read_mesh(self, name, data_obj, prefix, element=None):
+        """
+        Read the whole mesh dimension of a variable, or only one `element` of
+        it, through the slice cache.  `prefix` indexes the time and elevation
+        dimensions.
+        """
+        if element is None:
+            return slices.read(self, name, data_obj, prefix, None, lambda v, p: v[p + (slice(None),)])
+        element = int(element)
+        return slices.read(self, name, data_obj, prefix, ('element', element), lambda v, p: v[p + (element,)])
+
+    def _read_mesh_data(self, name, data_obj, prefix, indexes, request):
+        """
+        Read the mesh dimension of a variable, `prefix` indexing the time and
+        elevation dimensions, through the slice cache.  Only the ranges of the
+        mesh around the `indexes` a tile needs are read (see _mesh_ranges).
+        """
+        size = data_obj.shape[-1]
+        ranges = self._mesh_ranges(size, indexes, request)
+        if ranges is not None:
+            return slices.read(self, name, data_obj, prefix, tuple(slices.slice_key(s) for s in ranges),
+                               lambda v, p: data_handler.read_ranges(v, p, ranges, size))
+        return self._read_mesh(name, data_obj, prefix)
+
+    def getmap_animation(self, layer, request):
+        """
+        Animated GetMap of a layer drawn on the mesh faces: the faces, nodes and
+        triangulation are computed once and all frames are read in a single
+        hyperslab read.  Other layers and styles render every frame with getmap.
+        """
+        if not isinstance(layer, Layer) or request.GET['image_type'] not in ['pcolor', 'contours', 'filledcontours']:
+            return super(UGridDataset, self).getmap_animation(layer, request)
+
+        frames = self.animation_times(layer, request)
+        width = int(request.GET['width'])
+        height = int(request.GET['height'])
+        blank = np.zeros((height, width, 4), dtype=np.uint8)
+
+        with self.dataset() as nc:
+            data_obj = nc.variables[layer.access_name]
+            if len(data_obj.shape) not in [2, 3]:
+                return super(UGridDataset, self).getmap_animation(layer, request)
+            data_location = data_obj.location
+            mesh_name = data_obj.mesh
+
+            ug = topology.ugrid(self, mesh_name)
+            faces_subset, face_idx, read_idx = self._tile_faces(ug, mesh_name, data_location, request)
+            if faces_subset.shape[0] == 0:
+                return data_handler.animation_response((blank for _ in frames), len(frames), request)
+            x, y = projections.projected(self, '{}.node'.format(mesh_name), ug.nodes[:, 0], ug.nodes[:, 1], request.GET['crs'])
+
+            # Frames are evenly spaced time indexes (see animation_times)
+            indexes = [i for i, _ in frames]
+            step = indexes[1] - indexes[0] if len(indexes) > 1 else 1
+            prefix = (slice(indexes[0], indexes[-1] + 1, step),)
+            if len(data_obj.shape) == 3:
+                z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
+                prefix = prefix + (z_index,)
+            size = data_obj.shape[-1]
+            ranges = self._mesh_ranges(size, read_idx, request)
+            with handles.reading():
+                if ranges is not None:
+                    data = data_handler.read_ranges(data_obj, prefix, ranges, size)
+                else:
+                    data = data_obj[prefix + (slice(None),)]
+
+        colorscalerange = request.GET['colorscalerange']
+        if colorscalerange.min is None or colorscalerange.max is None:
+            # One color scale for all frames
+            visible = np.ma.filled(np.ma.asarray(data if read_idx is None else data[:, read_idx], dtype=np.float64), np.nan)
+            if np.isnan(visible).all():
+                logger.info("No data in field of view, returning empty frames.")
+                return data_handler.animation_response((blank for _ in frames), len(frames), request)
+            request.GET['colorscalerange'] = DotDict(min=float(np.nanmin(visible)), max=float(np.nanmax(visible)))
+        tri_subset = Tri.Triangulation(x, y, triangles=faces_subset)
+
+        def render():
+            for k, (_, time) in enumerate(frames):
+                faces, frame = self._valid_faces(data[k], data_location, faces_subset, face_idx)
+                if faces.shape[0] == 0:
+                    yield blank
+                    continue
+                # Reuse the triangulation unless faces were dropped
+                tri = tri_subset if faces.shape[0] == faces_subset.shape[0] else Tri.Triangulation(x, y, triangles=faces)
+                yield self._draw_faces(tri, frame, data_location, self.frame_request(request, time)).rgba
+
+        return data_handler.animation_response(render(), len(frames), request)
+
     def getfeatureinfo(self, layer, request):
         with self.dataset() as nc:
             data_obj = nc.variables[layer.access_name]
@@ -338,14 +515,15 @@ class UGridDataset(Dataset, NetCDFDataset):
 
             return_arrays = []
             z_value = None
+            times = slice(start_time_index, end_time_index)
             if isinstance(layer, Layer):
                 if len(data_obj.shape) == 3:
                     z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                    data = data_obj[start_time_index:end_time_index, z_index, geo_index]
+                    data = self._read_mesh(layer.access_name, data_obj, (times, z_index), geo_index)
                 elif len(data_obj.shape) == 2:
-                    data = data_obj[start_time_index:end_time_index, geo_index]
+                    data = self._read_mesh(layer.access_name, data_obj, (times,), geo_index)
                 elif len(data_obj.shape) == 1:
-                    data = data_obj[geo_index]
+                    data = self._read_mesh(layer.access_name, data_obj, (), geo_index)
                 else:
                     raise ValueError("Dimension Mismatch: data_obj.shape == {0} and time indexes = {1} to {2}".format(data_obj.shape, start_time_index, end_time_index))
 
@@ -358,11 +536,11 @@ class UGridDataset(Dataset, NetCDFDataset):
                     data_obj = nc.variables[l.var_name]
                     if len(data_obj.shape) == 3:
                         z_index, z_value = self.nearest_z(layer, request.GET['elevation'])
-                        data = data_obj[start_time_index:end_time_index, z_index, geo_index]
+                        data = self._read_mesh(l.var_name, data_obj, (times, z_index), geo_index)
                     elif len(data_obj.shape) == 2:
-                        data = data_obj[start_time_index:end_time_index, geo_index]
+                        data = self._read_mesh(l.var_name, data_obj, (times,), geo_index)
                     elif len(data_obj.shape) == 1:
-                        data = data_obj[geo_index]
+                        data = self._read_mesh(l.var_name, data_obj, (), geo_index)
                     else:
                         raise ValueError("Dimension Mismatch: data_obj.shape == {0} and time indexes = {1} to {2}".format(data_obj.shape, start_time_index, end_time_index))
 
@@ -397,7 +575,7 @@ class UGridDataset(Dataset, NetCDFDataset):
                 data_location = nc.variables[layer.access_name].location
                 mesh_name = nc.variables[layer.access_name].mesh
                 # Use local topology for pulling bounds data
-                ug = UGrid.from_ncfile(self.topology_file, mesh_name=mesh_name)
+                ug = topology.ugrid(self, mesh_name)
                 coords = np.empty(0)
                 if data_location == 'node':
                     coords = ug.nodes
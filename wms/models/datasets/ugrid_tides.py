@@ -19,6 +19,10 @@ from wms.utils import calc_lon_lat_padding, calc_safety_factor, DotDict
 from wms import data_handler
 from wms import mpl_handler
 from wms import gmd_handler
+from wms import topology
+from wms import handles
+from wms import projections
+from wms import slices
 
 from wms import logger
 
@@ -43,7 +47,7 @@ class UGridTideDataset(UGridDataset):
         return {}
 
     def update_grid_cache(self, force=False):
-        with self.dataset() as nc:
+        with self.dataset() as nc, handles.reading():
             if nc is None:
                 logger.error("Failed update_grid_cache, could not load dataset "
                              "as a netCDF4 object")
@@ -126,6 +130,8 @@ class UGridTideDataset(UGridDataset):
                     logger.error("Failed to create topology_file cache for Dataset '{}'".format(self.dataset.name))
                     return
 
+            topology.save_ugrid(self, ug)
+
         # Now do the RTree index
         self.make_rtree()
 
@@ -150,7 +156,7 @@ class UGridTideDataset(UGridDataset):
             data_location = getattr(data_obj, 'location', 'node')
             mesh_name = data_obj.mesh
 
-            ug = UGrid.from_nc_dataset(nc, mesh_name=mesh_name)
+            ug = topology.ugrid(self, mesh_name)
             coords = np.empty(0)
             if data_location == 'node':
                 coords = ug.nodes
@@ -193,10 +199,10 @@ class UGridTideDataset(UGridDataset):
                 e = np.ma.empty(0)
                 return e, e, e, e
 
-            ua = nc.variables['u'][extract_mask, spatial_idx]
-            va = nc.variables['v'][extract_mask, spatial_idx]
-            up = nc.variables['u_phase'][extract_mask, spatial_idx]
-            vp = nc.variables['v_phase'][extract_mask, spatial_idx]
+            ua = self._read_constituents(nc, 'u', extract_mask)[:, spatial_idx]
+            va = self._read_constituents(nc, 'v', extract_mask)[:, spatial_idx]
+            up = self._read_constituents(nc, 'u_phase', extract_mask)[:, spatial_idx]
+            vp = self._read_constituents(nc, 'v_phase', extract_mask)[:, spatial_idx]
             freqs = tfreqs[extract_mask]
 
             omega = freqs * 3600  # Convert from radians/s to radians/hour.
@@ -219,6 +225,12 @@ class UGridTideDataset(UGridDataset):
 
             return U, V, lon[spatial_idx], lat[spatial_idx]
 
+    def _read_constituents(self, nc, name, extract_mask):
+        """ The whole mesh of the extracted tidal constituents of a variable, through the slice cache """
+        constituents = np.where(extract_mask)[0]
+        return slices.read(self, name, nc.variables[name], (), ('constituents', tuple(constituents.tolist())),
+                           lambda v, p: v[constituents, :])
+
     def getmap(self, layer, request):
         _, time_value = self.nearest_time(layer, request.GET['time'])
 
@@ -239,7 +251,8 @@ class UGridTideDataset(UGridDataset):
             return self.empty_response(layer, request)
 
         if request.GET['image_type'] == 'vectors':
-            return mpl_handler.quiver_response(lons, lats, us, vs, request)
+            x, y = projections.to_crs(lons, lats, request.GET['crs'])
+            return mpl_handler.quiver_response(x, y, us, vs, request)
         else:
             raise NotImplementedError('Image type "{}" is not supported.'.format(request.GET['image_type']))
 
@@ -273,7 +286,7 @@ class UGridTideDataset(UGridDataset):
                 data_location = nc.variables['u'].location
                 mesh_name = nc.variables['u'].mesh
                 # Use local topology for pulling bounds data
-                ug = UGrid.from_ncfile(self.topology_file, mesh_name=mesh_name)
+                ug = topology.ugrid(self, mesh_name)
                 coords = np.empty(0)
                 if data_location == 'node':
                     coords = ug.nodes
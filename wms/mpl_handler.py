@@ -1,10 +1,8 @@
 # -*- coding: utf-8 -*-
-import pyproj
 import numpy as np
 import matplotlib as mpl
-from matplotlib.figure import Figure
 
-from wms.data_handler import figure_response
+from wms.data_handler import pooled_figure, tile_response
 
 from wms import logger  # noqa
 
@@ -35,9 +33,9 @@ def _get_common_params(request):
     return params
 
 
-def tripcolor_response(tri_subset, data, request, data_location=None, dpi=None):
+def tripcolor_response(tri_subset, data, request, data_location=None, dpi=None, shading='flat'):
     """
-    triang_subset is a matplotlib.Tri object in lat/lon units (will be converted to projected coordinates)
+    triang_subset is a matplotlib.Tri object in PROJECTED COORDINATES (see wms.projections)
     xmin, ymin, xmax, ymax is the bounding pox of the plot in PROJETED COORDINATES!!!
     request is the original getMap request object
     """
@@ -51,51 +49,37 @@ def tripcolor_response(tri_subset, data, request, data_location=None, dpi=None):
     colorscalerange = request.GET['colorscalerange']
     cmin = colorscalerange.min
     cmax = colorscalerange.max
-    crs = request.GET['crs']
-
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
-    tri_subset.x, tri_subset.y = pyproj.transform(EPSG4326, crs, tri_subset.x, tri_subset.y)
-
-    fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
-    fig.set_alpha(0)
-    fig.set_figheight(height / dpi)
-    fig.set_figwidth(width / dpi)
 
-    ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
-    ax.set_axis_off()
+    with pooled_figure(width, height, dpi) as (fig, ax):
+        if request.GET['logscale'] is True:
+            norm_func = mpl.colors.LogNorm
+        else:
+            norm_func = mpl.colors.Normalize
 
-    if request.GET['logscale'] is True:
-        norm_func = mpl.colors.LogNorm
-    else:
-        norm_func = mpl.colors.Normalize
+        # Set out of bound data to NaN so it shows transparent?
+        # Set to black like ncWMS?
+        # Configurable by user?
+        if cmin is not None and cmax is not None:
+            # Cached data is shared, clip a copy
+            data = np.clip(data, cmin, cmax)
+            norm = norm_func(vmin=cmin, vmax=cmax)
+        else:
+            norm = norm_func()
 
-    # Set out of bound data to NaN so it shows transparent?
-    # Set to black like ncWMS?
-    # Configurable by user?
-    if cmin is not None and cmax is not None:
-        data[data > cmax] = cmax
-        data[data < cmin] = cmin
-        norm = norm_func(vmin=cmin, vmax=cmax)
-    else:
-        norm = norm_func()
+        if data_location == 'face':
+            ax.tripcolor(tri_subset, facecolors=data, edgecolors='none', norm=norm, cmap=colormap)
+        else:
+            ax.tripcolor(tri_subset, data, edgecolors='none', norm=norm, cmap=colormap, shading=shading)
 
-    if data_location == 'face':
-        ax.tripcolor(tri_subset, facecolors=data, edgecolors='none', norm=norm, cmap=colormap)
-    else:
-        ax.tripcolor(tri_subset, data, edgecolors='none', norm=norm, cmap=colormap)
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
 
-    ax.set_xlim(bbox.minx, bbox.maxx)
-    ax.set_ylim(bbox.miny, bbox.maxy)
-    ax.set_frame_on(False)
-    ax.set_clip_on(False)
-    ax.set_position([0., 0., 1., 1.])
-
-    return figure_response(fig, request)
+        return tile_response(fig, request)
 
 
 def tricontouring_response(tri_subset, data, request, dpi=None):
     """
-    triang_subset is a matplotlib.Tri object in lat/lon units (will be converted to projected coordinates)
+    triang_subset is a matplotlib.Tri object in PROJECTED COORDINATES (see wms.projections)
     xmin, ymin, xmax, ymax is the bounding pox of the plot in PROJETED COORDINATES!!!
     request is the original getMap request object
     """
@@ -109,52 +93,41 @@ def tricontouring_response(tri_subset, data, request, dpi=None):
     colorscalerange = request.GET['colorscalerange']
     cmin = colorscalerange.min
     cmax = colorscalerange.max
-    crs = request.GET['crs']
     nlvls = request.GET['numcontours']
 
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
-    tri_subset.x, tri_subset.y = pyproj.transform(EPSG4326, crs, tri_subset.x, tri_subset.y)
-
-    fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
-    fig.set_alpha(0)
-    fig.set_figheight(height / dpi)
-    fig.set_figwidth(width / dpi)
+    with pooled_figure(width, height, dpi) as (fig, ax):
+        if request.GET['logscale'] is True:
+            norm_func = mpl.colors.LogNorm
+        else:
+            norm_func = mpl.colors.Normalize
 
-    ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
-    ax.set_axis_off()
+        # Set out of bound data to NaN so it shows transparent?
+        # Set to black like ncWMS?
+        # Configurable by user?
+        if cmin is not None and cmax is not None:
+            # Cached data is shared, clip a copy
+            data = np.clip(data, cmin, cmax)
+            lvls = np.linspace(cmin, cmax, nlvls)
+            norm = norm_func(vmin=cmin, vmax=cmax)
+        else:
+            lvls = nlvls
+            norm = norm_func()
 
-    if request.GET['logscale'] is True:
-        norm_func = mpl.colors.LogNorm
-    else:
-        norm_func = mpl.colors.Normalize
+        if request.GET['image_type'] == 'filledcontours':
+            ax.tricontourf(tri_subset, data, lvls, norm=norm, cmap=colormap)
+        elif request.GET['image_type'] == 'contours':
+            ax.tricontour(tri_subset, data, lvls, norm=norm, cmap=colormap)
 
-    # Set out of bound data to NaN so it shows transparent?
-    # Set to black like ncWMS?
-    # Configurable by user?
-    if cmin is not None and cmax is not None:
-        data[data > cmax] = cmax
-        data[data < cmin] = cmin
-        lvls = np.linspace(cmin, cmax, nlvls)
-        norm = norm_func(vmin=cmin, vmax=cmax)
-    else:
-        lvls = nlvls
-        norm = norm_func()
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
 
-    if request.GET['image_type'] == 'filledcontours':
-        ax.tricontourf(tri_subset, data, lvls, norm=norm, cmap=colormap)
-    elif request.GET['image_type'] == 'contours':
-        ax.tricontour(tri_subset, data, lvls, norm=norm, cmap=colormap)
+        return tile_response(fig, request)
 
-    ax.set_xlim(bbox.minx, bbox.maxx)
-    ax.set_ylim(bbox.miny, bbox.maxy)
-    ax.set_frame_on(False)
-    ax.set_clip_on(False)
-    ax.set_position([0., 0., 1., 1.])
 
-    return figure_response(fig, request)
-
-
-def quiver_response(lon, lat, dx, dy, request, dpi=None):
+def quiver_response(x, y, dx, dy, request, dpi=None):
+    """
+    x, y are the vector positions in PROJECTED COORDINATES (see wms.projections)
+    """
 
     dpi = dpi or 80.
 
@@ -166,138 +139,107 @@ def quiver_response(lon, lat, dx, dy, request, dpi=None):
     vectorscale = request.GET['vectorscale']
     cmin = colorscalerange.min
     cmax = colorscalerange.max
-    crs = request.GET['crs']
     unit_vectors = None  # We don't support requesting these yet, but wouldn't be hard
 
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
-    x, y = pyproj.transform(EPSG4326, crs, lon, lat)  # TODO order for non-inverse?
+    with pooled_figure(width, height, dpi) as (fig, ax):
+        mags = np.sqrt(dx**2 + dy**2)
 
-    fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
-    fig.set_alpha(0)
-    fig.set_figheight(height / dpi)
-    fig.set_figwidth(width / dpi)
+        cmap = mpl.cm.get_cmap(colormap)
 
-    ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
-    ax.set_axis_off()
-    mags = np.sqrt(dx**2 + dy**2)
+        if request.GET['logscale'] is True:
+            norm_func = mpl.colors.LogNorm
+        else:
+            norm_func = mpl.colors.Normalize
 
-    cmap = mpl.cm.get_cmap(colormap)
+        # Set out of bound data to NaN so it shows transparent?
+        # Set to black like ncWMS?
+        # Configurable by user?
+        if cmin is not None and cmax is not None:
+            mags[mags > cmax] = cmax
+            mags[mags < cmin] = cmin
+            norm = norm_func(vmin=cmin, vmax=cmax)
+        else:
+            norm = norm_func()
 
-    if request.GET['logscale'] is True:
-        norm_func = mpl.colors.LogNorm
-    else:
-        norm_func = mpl.colors.Normalize
+        # plot unit vectors
+        if unit_vectors:
+            ax.quiver(x, y, dx / mags, dy / mags, mags, cmap=cmap, norm=norm, scale=vectorscale)
+        else:
+            ax.quiver(x, y, dx, dy, mags, cmap=cmap, norm=norm, scale=vectorscale)
 
-    # Set out of bound data to NaN so it shows transparent?
-    # Set to black like ncWMS?
-    # Configurable by user?
-    if cmin is not None and cmax is not None:
-        mags[mags > cmax] = cmax
-        mags[mags < cmin] = cmin
-        norm = norm_func(vmin=cmin, vmax=cmax)
-    else:
-        norm = norm_func()
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
 
-    # plot unit vectors
-    if unit_vectors:
-        ax.quiver(x, y, dx / mags, dy / mags, mags, cmap=cmap, norm=norm, scale=vectorscale)
-    else:
-        ax.quiver(x, y, dx, dy, mags, cmap=cmap, norm=norm, scale=vectorscale)
+        return tile_response(fig, request)
 
-    ax.set_xlim(bbox.minx, bbox.maxx)
-    ax.set_ylim(bbox.miny, bbox.maxy)
-    ax.set_frame_on(False)
-    ax.set_clip_on(False)
-    ax.set_position([0., 0., 1., 1.])
 
-    return figure_response(fig, request)
-
-
-def contouring_response(lon, lat, data, request, dpi=None):
+def contouring_response(x, y, data, request, dpi=None):
+    """
+    x, y are the cell centers in PROJECTED COORDINATES (see wms.projections)
+    """
 
     dpi = dpi or 80.
 
-    bbox, width, height, colormap, cmin, cmax, crs = _get_common_params(request)
+    bbox, width, height, colormap, cmin, cmax, _ = _get_common_params(request)
     nlvls = request.GET['numcontours']
 
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
-    x, y = pyproj.transform(EPSG4326, crs, lon, lat)
-
-    fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
-    fig.set_alpha(0)
-    fig.set_figheight(height / dpi)
-    fig.set_figwidth(width / dpi)
-
-    ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
-    ax.set_axis_off()
-
-    if request.GET['logscale'] is True:
-        norm_func = mpl.colors.LogNorm
-    else:
-        norm_func = mpl.colors.Normalize
-
-    if cmin is not None and cmax is not None:
-        data[data > cmax] = cmax
-        data[data < cmin] = cmin
-        lvls = np.linspace(cmin, cmax, nlvls)
-        norm = norm_func(vmin=cmin, vmax=cmax)
-    else:
-        lvls = nlvls
-        norm = norm_func()
-
-    if request.GET['image_type'] == 'filledcontours':
-        ax.contourf(x, y, data, lvls, norm=norm, cmap=colormap)
-    elif request.GET['image_type'] == 'contours':
-        ax.contour(x, y, data, lvls, norm=norm, cmap=colormap)
-    elif request.GET['image_type'] == 'filledhatches':
-        hatches = DEFAULT_HATCHES[:nlvls]
-        ax.contourf(x, y, data, lvls, norm=norm, cmap=colormap, hatches=hatches)
-    elif request.GET['image_type'] == 'hatches':
-        hatches = DEFAULT_HATCHES[:nlvls]
-        ax.contourf(x, y, data, lvls, norm=norm, colors='none', hatches=hatches)
-
-    ax.set_xlim(bbox.minx, bbox.maxx)
-    ax.set_ylim(bbox.miny, bbox.maxy)
-    ax.set_frame_on(False)
-    ax.set_clip_on(False)
-    ax.set_position([0., 0., 1., 1.])
-
-    return figure_response(fig, request)
-
-
-def pcolormesh_response(lon, lat, data, request, dpi=None):
+    with pooled_figure(width, height, dpi) as (fig, ax):
+        if request.GET['logscale'] is True:
+            norm_func = mpl.colors.LogNorm
+        else:
+            norm_func = mpl.colors.Normalize
+
+        if cmin is not None and cmax is not None:
+            # Cached data is shared, clip a copy
+            data = np.clip(data, cmin, cmax)
+            lvls = np.linspace(cmin, cmax, nlvls)
+            norm = norm_func(vmin=cmin, vmax=cmax)
+        else:
+            lvls = nlvls
+            norm = norm_func()
+
+        if request.GET['image_type'] == 'filledcontours':
+            ax.contourf(x, y, data, lvls, norm=norm, cmap=colormap)
+        elif request.GET['image_type'] == 'contours':
+            ax.contour(x, y, data, lvls, norm=norm, cmap=colormap)
+        elif request.GET['image_type'] == 'filledhatches':
+            hatches = DEFAULT_HATCHES[:nlvls]
+            ax.contourf(x, y, data, lvls, norm=norm, cmap=colormap, hatches=hatches)
+        elif request.GET['image_type'] == 'hatches':
+            hatches = DEFAULT_HATCHES[:nlvls]
+            ax.contourf(x, y, data, lvls, norm=norm, colors='none', hatches=hatches)
+
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
+
+        return tile_response(fig, request)
+
+
+def pcolormesh_response(x, y, data, request, dpi=None):
+    """
+    x, y are the cell centers in PROJECTED COORDINATES (see wms.projections)
+    """
 
     dpi = dpi or 80.
 
-    bbox, width, height, colormap, cmin, cmax, crs = _get_common_params(request)
-
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
-    x, y = pyproj.transform(EPSG4326, crs, lon, lat)
-    fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
-    fig.set_alpha(0)
-    fig.set_figheight(height / dpi)
-    fig.set_figwidth(width / dpi)
-    ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
-    ax.set_axis_off()
-
-    if request.GET['logscale'] is True:
-        norm_func = mpl.colors.LogNorm
-    else:
-        norm_func = mpl.colors.Normalize
-
-    if cmin is not None and cmax is not None:
-        data[data > cmax] = cmax
-        data[data < cmin] = cmin
-        norm = norm = norm_func(vmin=cmin, vmax=cmax)
-    else:
-        norm = norm_func()
-
-    masked = np.ma.masked_invalid(data)
-    ax.pcolormesh(x, y, masked, norm=norm, cmap=colormap)
-    ax.set_xlim(bbox.minx, bbox.maxx)
-    ax.set_ylim(bbox.miny, bbox.maxy)
-    ax.set_frame_on(False)
-    ax.set_clip_on(False)
-    ax.set_position([0., 0., 1., 1.])
-
-    return figure_response(fig, request)
+    bbox, width, height, colormap, cmin, cmax, _ = _get_common_params(request)
+
+    with pooled_figure(width, height, dpi) as (fig, ax):
+        if request.GET['logscale'] is True:
+            norm_func = mpl.colors.LogNorm
+        else:
+            norm_func = mpl.colors.Normalize
+
+        if cmin is not None and cmax is not None:
+            # Cached data is shared, clip a copy
+            data = np.clip(data, cmin, cmax)
+            norm = norm = norm_func(vmin=cmin, vmax=cmax)
+        else:
+            norm = norm_func()
+
+        masked = np.ma.masked_invalid(data)
+        ax.pcolormesh(x, y, masked, norm=norm, cmap=colormap)
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
+
+        return tile_response(fig, request)
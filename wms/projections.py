@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Projection of WGS84 coordinates into the CRS of a request.
+
+Node and cell center coordinates never move between grid cache updates, so
+their projections are computed once per (dataset, coordinates, CRS) and
+stored as memory mappable .npy files next to the topology cache.
+"""
+import os
+import re
+import hashlib
+import threading
+
+import numpy as np
+import pyproj
+
+from django.conf import settings
+
+from wms.utils import LRUCache, nbytes
+from wms import topology
+
+from wms import logger
+
+
+WEB_MERCATOR_CODES = ['EPSG:3857', 'EPSG:900913', 'EPSG:3785', 'EPSG:102100', 'EPSG:102113']
+WEB_MERCATOR_RADIUS = 6378137.0
+
+# CRS names advertised in GetCapabilities that are not valid proj init strings
+CRS_ALIASES = {
+    'MERCATOR': 'EPSG:3857'
+}
+# Projections and transformers built when the app starts
+ADVERTISED_CRS = ['EPSG:3857', 'EPSG:4326']
+
+_projs = {}
+_transformers = {}
+_registry_lock = threading.Lock()
+
+_projected = LRUCache(maxsize=settings.TOPOLOGY_CACHE_BYTES, sizeof=nbytes)
+
+
+def get_proj(code):
+    """
+    Return the process wide pyproj.Proj object for a CRS code like
+    'EPSG:3857', building it on first use.
+    """
+    key = crs_code(code)
+    proj = _projs.get(key)
+    if proj is None:
+        with _registry_lock:
+            proj = _projs.get(key)
+            if proj is None:
+                init = key if code.strip().upper() in CRS_ALIASES else code.strip()
+                proj = pyproj.Proj(init=init)
+                _projs[key] = proj
+    return proj
+
+
+def crs_code(crs):
+    """
+    Return a normalized code ('EPSG:3857') for a CRS string or a pyproj.Proj
+    object created with an 'init' definition.  Other definitions are
+    identified by a hash of their proj4 string.
+    """
+    if isinstance(crs, str):
+        code = crs.strip().upper()
+        return CRS_ALIASES.get(code, code)
+
+    srs = getattr(crs, 'srs', '')
+    match = re.search(r'init=(\w+:\w+)', srs)
+    if match is not None:
+        return match.group(1).upper()
+    return 'PROJ:{}'.format(hashlib.sha1(srs.encode('utf-8')).hexdigest()[:12])
+
+
+def is_web_mercator(crs):
+    if crs_code(crs) in WEB_MERCATOR_CODES:
+        return True
+    # Expanded definition of a spherical mercator
+    params = dict(p.lstrip('+').partition('=')[::2] for p in getattr(crs, 'srs', '').split())
+    return (
+        params.get('proj') == 'merc' and
+        params.get('a') == params.get('b') == '6378137' and
+        all(float(params.get(k, 0)) == 0 for k in ('lat_ts', 'lon_0', 'x_0', 'y_0')) and
+        float(params.get('k', 1)) == 1
+    )
+
+
+def web_mercator(lon, lat):
+    """ Vectorized spherical mercator (EPSG:3857) forward projection """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    # Wrap longitudes like proj.4 does
+    lon = np.where(np.abs(lon) > 180, ((lon + 180) % 360) - 180, lon)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = WEB_MERCATOR_RADIUS * np.radians(lon)
+        y = WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def inverse_web_mercator(x, y):
+    """ Vectorized spherical mercator (EPSG:3857) inverse projection """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lon = np.degrees(x / WEB_MERCATOR_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / WEB_MERCATOR_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def tile_bounds(z, x, y):
+    """ EPSG:3857 bbox (minx, miny, maxx, maxy) of an XYZ (slippy map) tile """
+    extent = np.pi * WEB_MERCATOR_RADIUS
+    size = 2 * extent / 2 ** z
+    minx = -extent + x * size
+    maxy = extent - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile_range(wgs84_bbox, z):
+    """
+    Return the inclusive (xmin, ymin, xmax, ymax) XYZ tile numbers at zoom
+    level `z` covering a WGS84 bbox (minlon, minlat, maxlon, maxlat)
+    """
+    n = 2 ** z
+    minlon, minlat, maxlon, maxlat = wgs84_bbox
+    x, y = web_mercator([minlon, maxlon], np.clip([minlat, maxlat], -85.0511, 85.0511))
+    extent = np.pi * WEB_MERCATOR_RADIUS
+    columns = np.clip(np.floor((x + extent) / (2 * extent) * n), 0, n - 1).astype(int)
+    rows = np.clip(np.floor((extent - y) / (2 * extent) * n), 0, n - 1).astype(int)
+    return int(columns[0]), int(rows[1]), int(columns[1]), int(rows[0])
+
+
+def _is_wgs84(crs):
+    return crs_code(crs) in ['EPSG:4326', 'CRS:84']
+
+
+class Transformer(object):
+    """
+    Coordinate transformation between two pyproj.Proj objects.  Transformations
+    between WGS84 and web mercator are computed analytically, others go through
+    pyproj and are serialized because a Proj object is not safe to share
+    between threads.
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self._lock = threading.Lock()
+        self._fast = None
+        if _is_wgs84(src) and is_web_mercator(dst):
+            self._fast = web_mercator
+        elif is_web_mercator(src) and _is_wgs84(dst):
+            self._fast = inverse_web_mercator
+
+    def transform(self, x, y):
+        if self._fast is not None:
+            return self._fast(x, y)
+        if not np.isscalar(x):
+            x = np.array(x, dtype=np.float64)
+            y = np.array(y, dtype=np.float64)
+        with self._lock:
+            return pyproj.transform(self.src, self.dst, x, y)
+
+
+def get_transformer(src, dst):
+    """
+    Return the process wide Transformer between two CRSs, each given as a
+    code or a pyproj.Proj object.
+    """
+    src = get_proj(src) if isinstance(src, str) else src
+    dst = get_proj(dst) if isinstance(dst, str) else dst
+    key = (crs_code(src), crs_code(dst))
+    transformer = _transformers.get(key)
+    if transformer is None:
+        with _registry_lock:
+            transformer = _transformers.get(key)
+            if transformer is None:
+                transformer = Transformer(src, dst)
+                _transformers[key] = transformer
+    return transformer
+
+
+def warm():
+    """ Build the projections and transformers of every advertised CRS """
+    for code in ADVERTISED_CRS:
+        get_transformer('EPSG:4326', code)
+        get_transformer(code, 'EPSG:4326')
+
+
+def to_crs(lon, lat, crs):
+    """ Project WGS84 coordinates into a CRS (a pyproj.Proj object) """
+    return get_transformer('EPSG:4326', crs).transform(lon, lat)
+
+
+def _projected_file(dataset, name, code):
+    return dataset.topology_array_file('{}.{}'.format(name, re.sub(r'\W', '', code).lower()))
+
+
+def save_projected(dataset, name, lon, lat):
+    """
+    Write the projections of a dataset's WGS84 coordinates into every
+    ADVERTISED_CRS, when its grid cache is updated (see projected).
+    """
+    for code in ADVERTISED_CRS:
+        x, y = to_crs(lon, lat, code)
+        topology.save_array(_projected_file(dataset, name, code), np.stack((x, y)))
+
+
+def projected(dataset, name, lon, lat, crs):
+    """
+    Return the (x, y) projection of a dataset's cached WGS84 coordinates
+    `lon` and `lat` into `crs`.  `name` identifies the coordinates within the
+    dataset (e.g. a mesh and data location).  The result is computed on first
+    use and stored as a read-only memory map, rebuilt when the topology
+    cache is newer.  Where the topology cache is read-only it is kept in the
+    memory of the worker.
+    """
+    code = crs_code(crs)
+    path = _projected_file(dataset, name, code)
+
+    try:
+        topology_mtime = os.stat(dataset.topology_file).st_mtime_ns
+    except OSError:
+        topology_mtime = None
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if topology_mtime is not None and mtime < topology_mtime:
+            mtime = None
+    except OSError:
+        mtime = None
+
+    if mtime is not None:
+        cached = _projected.get(path)
+        if cached is not None and cached[0] == mtime:
+            xy = cached[1]
+        else:
+            xy = topology.load_array(path)
+            _projected.set(path, (mtime, xy))
+        if xy.shape[1:] == np.shape(lon):
+            return xy[0], xy[1]
+
+    memkey = ('memory', path)
+    cached = _projected.get(memkey)
+    if cached is not None and cached[0] == topology_mtime and cached[1].shape[1:] == np.shape(lon):
+        return cached[1][0], cached[1][1]
+
+    logger.info("Projecting {} coordinates of {} to {}".format(name, dataset.name, code))
+    x, y = to_crs(lon, lat, crs)
+    xy = np.stack((x, y))
+    try:
+        topology.save_array(path, xy)
+    except OSError:
+        logger.debug("Could not write {}, keeping the projection in memory".format(path))
+        _projected.set(memkey, (topology_mtime, xy))
+    return xy[0], xy[1]
+
+
+def stats():
+    return _projected.stats()
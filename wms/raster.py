@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Rasterization of triangular meshes straight into RGBA numpy arrays.
+
+This is an alternative to matplotlib's tripcolor for plain colored triangle
+tiles.  Pixels are assigned to the triangle containing their center, colors
+come from a lookup table built once per colormap.
+"""
+import numpy as np
+import matplotlib as mpl
+
+from django.conf import settings
+
+from wms.utils import LRUCache, nbytes
+from wms.data_handler import image_response
+
+
+_luts = LRUCache(maxsize=64)
+_grid_indexes = LRUCache(maxsize=settings.RASTER_INDEX_CACHE_BYTES, sizeof=nbytes)
+
+
+def colormap_lut(colormap):
+    """
+    Return the RGBA lookup table of a colormap as an (N + 3, 4) uint8 array.
+    Rows 0..N-1 are the colormap, followed by the under, over and bad colors.
+    """
+    lut = _luts.get(colormap)
+    if lut is None:
+        cmap = mpl.cm.get_cmap(colormap)
+        lut = np.concatenate([
+            cmap(np.arange(cmap.N), bytes=True),
+            cmap(np.array([-1., 2., np.nan]), bytes=True)
+        ])
+        lut.flags.writeable = False
+        _luts.set(colormap, lut)
+    return lut
+
+
+def normalize(values, vmin, vmax, logscale=False):
+    """ Scale values to [0, 1] like matplotlib's Normalize and LogNorm """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if logscale is True:
+            values = np.where(values > 0, values, np.nan)
+            values, vmin, vmax = np.log(values), np.log(vmin), np.log(vmax)
+        if vmax == vmin:
+            return np.where(np.isnan(values), np.nan, 0.)
+        return (values - vmin) / (vmax - vmin)
+
+
+def colorize(normalized, lut):
+    """ Map normalized values to RGBA through a lookup table (see colormap_lut) """
+    n = lut.shape[0] - 3
+    with np.errstate(invalid='ignore'):
+        scaled = normalized * n
+        idx = np.where(scaled == n, n - 1, scaled)
+        idx = np.where(scaled < 0, n, idx)
+        idx = np.where(scaled > n, n + 1, idx)
+        idx = np.where(np.isnan(scaled), n + 2, idx)
+    return lut[idx.astype(np.intp)]
+
+
+def _expand(starts, counts):
+    """ Return the repeated position and an offset within each run of counts """
+    owner = np.repeat(np.arange(counts.size), counts)
+    offset = np.arange(owner.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, starts[owner] + offset
+
+
+def rasterize(x, y, triangles, width, height):
+    """
+    Find the triangle containing the center of every pixel.  x and y are the
+    node coordinates in pixel units, with the origin at the top left corner.
+    Returns an (height, width) array of triangle indexes, -1 where there is none.
+
+    Triangles are scanned one pixel row at a time: each (triangle, row) pair
+    is turned into the span of columns between its edge crossings.
+    """
+    index = np.full((height, width), -1, dtype=np.int64)
+
+    tx = x[triangles]
+    ty = y[triangles]
+    with np.errstate(invalid='ignore'):
+        r0 = np.maximum(np.ceil(ty.min(axis=1) - 0.5), 0)
+        r1 = np.minimum(np.floor(ty.max(axis=1) - 0.5), height - 1)
+        visible = np.where(
+            (r1 >= r0) &
+            (tx.max(axis=1) >= 0.5) &
+            (tx.min(axis=1) <= width - 0.5)
+        )[0]
+    if visible.size == 0:
+        return index
+
+    # One entry per (triangle, pixel row)
+    owner, rows = _expand(r0[visible].astype(np.int64), (r1 - r0)[visible].astype(np.int64) + 1)
+    tri = visible[owner]
+    center = rows + 0.5
+
+    # Crossings of the row center with the three edges, horizontal edges
+    # are covered by the crossings of the other two
+    xa, ya = tx[tri], ty[tri]
+    xb, yb = xa[:, [1, 2, 0]], ya[:, [1, 2, 0]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (center[:, None] - ya) / (yb - ya)
+        crossing = (t >= 0) & (t <= 1)
+        xs = xa + t * (xb - xa)
+        left = np.where(crossing, xs, np.inf).min(axis=1)
+        right = np.where(crossing, xs, -np.inf).max(axis=1)
+        c0 = np.maximum(np.ceil(left - 0.5), 0)
+        c1 = np.minimum(np.floor(right - 0.5), width - 1)
+        counts = np.where(c1 >= c0, c1 - c0 + 1, 0).astype(np.int64)
+
+    span, cols = _expand(np.where(counts > 0, c0, 0).astype(np.int64), counts)
+    index[rows[span], cols] = tri[span]
+    return index
+
+
+def barycentric(x, y, triangles, index):
+    """
+    Return the (3, n) barycentric weights of the centers of the covered pixels
+    of a rasterized index (see rasterize) in their triangle.
+    """
+    rows, cols = np.nonzero(index >= 0)
+    tri = triangles[index[rows, cols]]
+    tx, ty = x[tri], y[tri]
+    px, py = cols + 0.5, rows + 0.5
+    det = (ty[:, 1] - ty[:, 2]) * (tx[:, 0] - tx[:, 2]) + (tx[:, 2] - tx[:, 1]) * (ty[:, 0] - ty[:, 2])
+    l0 = ((ty[:, 1] - ty[:, 2]) * (px - tx[:, 2]) + (tx[:, 2] - tx[:, 1]) * (py - ty[:, 2])) / det
+    l1 = ((ty[:, 2] - ty[:, 0]) * (px - tx[:, 2]) + (tx[:, 0] - tx[:, 2]) * (py - ty[:, 2])) / det
+    return np.clip(np.stack((l0, l1, 1 - l0 - l1)), 0, 1)
+
+
+def _pixels(x, y, request):
+    """ Convert projected coordinates to pixel coordinates of the requested image """
+    bbox = request.GET['bbox']
+    px = (np.asarray(x, dtype=np.float64) - bbox.minx) / (bbox.maxx - bbox.minx) * int(request.GET['width'])
+    py = (bbox.maxy - np.asarray(y, dtype=np.float64)) / (bbox.maxy - bbox.miny) * int(request.GET['height'])
+    return px, py
+
+
+def _scale(values, request, autoscale_values=None):
+    """
+    Clip values to the requested color scale range and normalize them.  Without
+    a range, scale to the extent of `autoscale_values` (or `values`).
+    """
+    colorscalerange = request.GET['colorscalerange']
+    cmin = colorscalerange.min
+    cmax = colorscalerange.max
+    if cmin is not None and cmax is not None:
+        values = np.clip(values, cmin, cmax)
+    else:
+        extent = values if autoscale_values is None else autoscale_values
+        if np.any(np.isfinite(extent)):
+            cmin = np.nanmin(extent)
+            cmax = np.nanmax(extent)
+        else:
+            cmin, cmax = 0., 1.
+    return normalize(values, cmin, cmax, logscale=request.GET['logscale'])
+
+
+def _filled(data):
+    """ Float copy of (masked) data with NaN at masked or invalid values """
+    return np.ma.filled(np.ma.masked_invalid(np.ma.asarray(data, dtype=np.float64)), np.nan)
+
+
+def tripcolor(x, y, triangles, data, request, data_location=None, shading='flat'):
+    """
+    Render colored triangles to an (height, width, 4) uint8 RGBA array.
+
+    x, y are the node coordinates in PROJECTED COORDINATES, `triangles` the
+    node indexes of the triangles to draw.  With 'flat' shading every triangle
+    gets the color of its face value (or of the mean of its node values, as
+    matplotlib's tripcolor does), with 'gouraud' shading the colors of the
+    nodes are interpolated across each triangle.
+    """
+    width = int(request.GET['width'])
+    height = int(request.GET['height'])
+
+    data = _filled(data)
+    if data_location == 'face':
+        values = data
+        shading = 'flat'
+    elif shading == 'gouraud':
+        values = data
+    else:
+        values = data[triangles].mean(axis=1)
+    normalized = _scale(values, request)
+
+    px, py = _pixels(x, y, request)
+    index = rasterize(px, py, triangles, width, height)
+
+    lut = colormap_lut(request.GET['colormap'])
+    covered = index >= 0
+    rgba = np.zeros((height, width, 4), dtype=np.uint8)
+    if shading == 'gouraud':
+        # Interpolate the node colors, as matplotlib does
+        colors = colorize(normalized, lut).astype(np.float64)
+        weights = barycentric(px, py, triangles, index)
+        pixel_colors = (colors[triangles[index[covered]]] * weights.T[:, :, None]).sum(axis=1)
+        rgba[covered] = np.round(pixel_colors).astype(np.uint8)
+    else:
+        rgba[covered] = colorize(normalized[index[covered]], lut)
+    return rgba
+
+
+def tripcolor_response(tri_subset, data, request, data_location=None, shading='flat'):
+    """
+    Same interface as mpl_handler.tripcolor_response, rendered with tripcolor()
+    """
+    rgba = tripcolor(tri_subset.x, tri_subset.y, tri_subset.triangles, data, request,
+                     data_location=data_location, shading=shading)
+    return image_response(rgba, request)
+
+
+def grid_window(x, y, bbox):
+    """
+    Return the (rows, columns) slices of the cell centers of a structured
+    grid needed to draw the quads intersecting a bbox, or None.  Quads join
+    four neighbouring centers, as with matplotlib's pcolormesh.
+    """
+    def corners(a, func):
+        return func(func(a[:-1, :-1], a[:-1, 1:]), func(a[1:, :-1], a[1:, 1:]))
+
+    with np.errstate(invalid='ignore'):
+        hit = (
+            (corners(x, np.fmax) >= bbox.minx) &
+            (corners(x, np.fmin) <= bbox.maxx) &
+            (corners(y, np.fmax) >= bbox.miny) &
+            (corners(y, np.fmin) <= bbox.maxy)
+        )
+    rows = np.where(hit.any(axis=1))[0]
+    cols = np.where(hit.any(axis=0))[0]
+    if rows.size == 0:
+        return None
+    return slice(rows[0], rows[-1] + 2), slice(cols[0], cols[-1] + 2)
+
+
+def grid_pixel_index(x, y, request, key=None):
+    """
+    Map every pixel of the requested image to a cell of a structured grid
+    with centers x, y (PROJECTED COORDINATES).
+
+    Returns the grid window (see grid_window) and an (height, width) array of
+    indexes into the flattened window, -1 where no cell is drawn.  Results are
+    cached when a `key` identifying the grid and the CRS is given.
+    """
+    bbox = request.GET['bbox']
+    width = int(request.GET['width'])
+    height = int(request.GET['height'])
+    if key is not None:
+        key = key + (bbox.minx, bbox.miny, bbox.maxx, bbox.maxy, width, height)
+        cached = _grid_indexes.get(key)
+        if cached is not None:
+            return cached
+
+    window = grid_window(x, y, bbox)
+    pixel_cell = None
+    if window is not None:
+        px, py = _pixels(x[window], y[window], request)
+        ny, nx = px.shape
+        # Two triangles per quad, numbered by the index of the quad's first center
+        cell = np.arange(ny * nx).reshape(ny, nx)[:-1, :-1].ravel()
+        triangles = np.column_stack((
+            cell, cell + 1, cell + nx + 1,
+            cell, cell + nx + 1, cell + nx
+        )).reshape(-1, 3)
+        index = rasterize(px.ravel(), py.ravel(), triangles, width, height)
+        pixel_cell = np.where(index >= 0, cell[index // 2], -1).astype(np.int32)
+        pixel_cell.flags.writeable = False
+
+    if key is not None:
+        _grid_indexes.set(key, (window, pixel_cell))
+    return window, pixel_cell
+
+
+def pcolormesh(data, pixel_cell, request, autoscale_data=None):
+    """
+    Render the cells of a structured grid to an (height, width, 4) uint8 RGBA
+    array.  `data` is the windowed cell data and `pixel_cell` the index from
+    grid_pixel_index.  Without a color scale range the colors are scaled to
+    `autoscale_data` (or `data`).
+    """
+    covered = pixel_cell >= 0
+    values = _filled(data).ravel()[pixel_cell[covered]]
+
+    extent = None
+    colorscalerange = request.GET['colorscalerange']
+    if colorscalerange.min is None or colorscalerange.max is None:
+        extent = _filled(autoscale_data if autoscale_data is not None else data)
+    normalized = _scale(values, request, extent)
+
+    rgba = np.zeros(pixel_cell.shape + (4,), dtype=np.uint8)
+    rgba[covered] = colorize(normalized, colormap_lut(request.GET['colormap']))
+    return rgba
+
+
+def pcolormesh_response(data, pixel_cell, request, autoscale_data=None):
+    rgba = pcolormesh(data, pixel_cell, request, autoscale_data=autoscale_data)
+    return image_response(rgba, request)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of decoded data slices.
+
+A slice is what a reader function returns for a variable and a `prefix`
+indexing its time and elevation dimensions, e.g. the ranges of a UGRID mesh
+or the window of a SGRID a tile needs.  Slices are cached in an in-process
+LRU bounded by SLICE_CACHE_BYTES, keyed by dataset, cache generation,
+variable, prefix and region: updating the time or grid cache of a dataset
+starts a new generation (see wms.generations) and its old slices are no
+longer used by any worker.  The arrays are shared, callers must not modify
+them in place.
+
+Slices of at least SLICE_SHARED_MIN_BYTES are also written as .npy files to
+SLICE_SHARED_PATH (preferably a tmpfs), which every worker of the node maps
+in memory on a miss of its own LRU, so a slice is read and decoded once per
+node.  An SQLite index next to the files records their size and last use and
+evicts the least recently used ones past SLICE_SHARED_BYTES.
+
+Reads that step through the time dimension (animation playback) are
+watched: after two equal steps the next PREFETCH_STEPS time slices of the
+same region are read ahead by background threads.  A different step cancels
+the slices that were not read yet.
+"""
+import os
+import shutil
+import sqlite3
+import threading
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from wms.utils import FileIndex, LRUCache, green_threads, nbytes
+from wms import generations
+from wms import topology
+from wms import handles
+from wms import mirror
+from wms import aggregation
+
+from wms import logger
+
+
+# Most prefetch reads queued at once, over all streams
+MAX_PENDING = 256
+
+_slices = LRUCache(maxsize=settings.SLICE_CACHE_BYTES, sizeof=nbytes)
+
+
+def slice_key(s):
+    """ Hashable form of a slice, for regions made of slices """
+    return (s.start, s.stop, s.step)
+
+
+def _plain(value):
+    """ Numpy integers as ints, so keys have the same repr in every process """
+    if isinstance(value, tuple):
+        return tuple(_plain(v) for v in value)
+    elif isinstance(value, slice):
+        return slice_key(value)
+    elif isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def _key(dataset, name, prefix, region):
+    return (dataset.safe_filename, generations.current(dataset), name, _plain(tuple(prefix)), _plain(region))
+
+
+def _get(key):
+    data = _slices.get(key)
+    if data is None and _shared is not None:
+        data = _shared.get(key)
+        if data is not None:
+            _slices.set(key, data)
+    return data
+
+
+def _set(key, data):
+    _slices.set(key, data)
+    if _shared is not None:
+        _shared.set(key, data)
+
+
+def read(dataset, name, variable, prefix, region, reader):
+    """
+    Return `reader(variable, prefix)` through the cache.  `name` is the name
+    of the variable in the dataset, `region` a hashable description of what
+    the reader reads from the other dimensions.
+    """
+    if prefix:
+        variable = aggregation.variable(dataset, name, variable)
+    if mirror.enabled(dataset):
+        variable = mirror.Variable(dataset, name, variable, len(prefix))
+
+    key = _key(dataset, name, prefix, region)
+    data = _get(key)
+    if data is None:
+        with handles.reading():
+            data = reader(variable, prefix)
+        _set(key, data)
+
+    # Reading ahead on green threads would delay the live requests of the worker
+    if prefix and isinstance(prefix[0], (int, np.integer)) and settings.PREFETCH_STEPS > 0 and not green_threads():
+        _prefetcher.observe(dataset, name, variable, prefix, region, reader)
+    return data
+
+
+def invalidate(dataset):
+    """
+    Drop the slices of a dataset held by this process, and the shared slices
+    of its older generations
+    """
+    _prefetcher.cancel_all()
+    for key in _slices.keys():
+        if key[0] == dataset.safe_filename:
+            _slices.pop(key)
+    if _shared is not None:
+        _shared.invalidate(dataset.safe_filename, generations.current(dataset))
+
+
+def stats():
+    s = _slices.stats()
+    s['prefetched'] = _prefetcher.prefetched
+    s['prefetch_cancelled'] = _prefetcher.cancelled
+    if _shared is not None:
+        s['shared'] = _shared.stats()
+    return s
+
+
+class SharedSlices(object):
+    """
+    Slices shared by the processes of a node, as .npy files under `root`
+    mapped in memory by the processes reading them.  The index flags tell
+    plain arrays (0) from masked arrays without (1) or with (2) a mask file.
+    Slices are no longer shared once `root` fails to store one, e.g. when it
+    is mounted read-only.
+    """
+
+    def __init__(self, root, maxsize, minsize):
+        self.root = root
+        self.minsize = minsize
+        self.hits = 0
+        self.misses = 0
+        self.index = FileIndex(os.path.join(root, 'index.sqlite3'), maxsize)
+        self.failed = False
+        if not self.index.create():
+            self._fail("{} is not writable".format(root))
+
+    def _fail(self, reason):
+        self.failed = True
+        logger.debug("Not sharing slices under {}: {}".format(self.root, reason))
+
+    def shareable(self, data):
+        return not self.failed and isinstance(data, np.ndarray) and data.dtype.kind in 'biufc' and data.nbytes >= self.minsize
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return digest, os.path.join(self.root, key[0], key[1], digest[:2], digest)
+
+    @staticmethod
+    def _remove(path, masked):
+        for p in [path + '.npy', path + '.mask.npy'] if masked == 2 else [path + '.npy']:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def get(self, key):
+        """ Return the shared slice of a key mapped in memory, or None """
+        if self.failed:
+            self.misses += 1
+            return None
+        digest, path = self._path(key)
+        try:
+            masked = self.index.get(digest)
+            if masked is None:
+                self.misses += 1
+                return None
+            # Plain arrays, so the LRU of the process accounts for the mapped bytes
+            data = topology.load_array(path + '.npy').view(np.ndarray)
+            if masked == 2:
+                data = np.ma.MaskedArray(data, mask=topology.load_array(path + '.mask.npy').view(np.ndarray), copy=False)
+            elif masked == 1:
+                data = np.ma.MaskedArray(data, copy=False)
+        except (OSError, ValueError, sqlite3.Error):
+            # Evicted by another process while loading it, or no store
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def set(self, key, data):
+        if not self.shareable(data):
+            return
+        digest, path = self._path(key)
+        if not isinstance(data, np.ma.MaskedArray):
+            masked = 0
+        elif np.ma.is_masked(data):
+            masked = 2
+        else:
+            masked = 1
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if masked == 2:
+                topology.save_array(path + '.mask.npy', np.ma.getmaskarray(data))
+            topology.save_array(path + '.npy', np.ma.getdata(data))
+            evicted = self.index.add(digest, key[0], key[1], path, masked, data.nbytes + (data.size if masked == 2 else 0))
+        except (OSError, sqlite3.Error) as e:
+            self._fail(e)
+            return
+
+        # Processes that mapped them keep their pages until they drop them
+        for old_path, old_masked in evicted:
+            self._remove(old_path, old_masked)
+
+    def invalidate(self, dataset, generation):
+        """ Remove the shared slices of the generations of a dataset other than `generation` """
+        try:
+            self.index.invalidate(dataset, generation)
+        except (OSError, sqlite3.Error):
+            logger.exception("Could not invalidate the shared slices of {}".format(dataset))
+            return
+        root = os.path.join(self.root, dataset)
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                if name != generation:
+                    shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def stats(self):
+        s = self.index.stats()
+        s['failed'] = self.failed
+        s['hits'] = self.hits
+        s['misses'] = self.misses
+        return s
+
+
+class Prefetcher(object):
+    """
+    Reads the next time slices of streams, a stream being the reads of one
+    variable and region at different time indexes.
+    """
+
+    def __init__(self, steps, workers):
+        self.steps = steps
+        self.workers = workers
+        self.prefetched = 0
+        self.cancelled = 0
+        self._executor = None
+        # stream -> (last time index, last step)
+        self._history = LRUCache(maxsize=1024)
+        # stream -> {time index: future}
+        self._pending = {}
+        # Reentrant, cancelling a future runs its done callback right away
+        self._lock = threading.RLock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def observe(self, dataset, name, variable, prefix, region, reader):
+        time_index = prefix[0]
+        stream = (dataset.safe_filename, name, prefix[1:], region)
+        with self._lock:
+            last = self._history.get(stream)
+            if last is not None and time_index == last[0]:
+                # Another read of the same frame
+                return
+            step = time_index - last[0] if last is not None else None
+            self._history.set(stream, (time_index, step))
+            if step is None or step != last[1]:
+                self._cancel(stream)
+                return
+
+            for k in range(1, self.steps + 1):
+                target = time_index + k * step
+                if target < 0 or target >= variable.shape[0]:
+                    break
+                target_prefix = (target,) + prefix[1:]
+                if target in self._pending.get(stream, {}) or _key(dataset, name, target_prefix, region) in _slices:
+                    continue
+                if sum(len(p) for p in self._pending.values()) >= MAX_PENDING:
+                    break
+                future = self.executor.submit(self._load, dataset, name, variable, target_prefix, region, reader)
+                self._pending.setdefault(stream, {})[target] = future
+                future.add_done_callback(lambda f, stream=stream, target=target: self._done(stream, target))
+
+    def _load(self, dataset, name, variable, prefix, region, reader):
+        key = _key(dataset, name, prefix, region)
+        # The netCDF handle of the variable is shared with the requests
+        path = dataset.path() if callable(getattr(dataset, 'path', None)) else None
+        try:
+            if key in _slices or _get(key) is not None:
+                return
+            with handles.locked(path):
+                data = reader(variable, prefix)
+            _set(key, data)
+            self.prefetched += 1
+        except BaseException:
+            logger.exception("Could not prefetch {} {} of {}".format(name, prefix, dataset.name))
+
+    def _done(self, stream, target):
+        with self._lock:
+            pending = self._pending.get(stream)
+            if pending is not None:
+                pending.pop(target, None)
+                if not pending:
+                    del self._pending[stream]
+
+    def _cancel(self, stream):
+        """ Drop the reads of a stream that did not start yet """
+        for future in list(self._pending.get(stream, {}).values()):
+            if future.cancel():
+                self.cancelled += 1
+
+    def cancel_all(self):
+        with self._lock:
+            for stream in list(self._pending):
+                self._cancel(stream)
+
+
+_prefetcher = Prefetcher(settings.PREFETCH_STEPS, settings.PREFETCH_WORKERS)
+
+if settings.SLICE_SHARED_BYTES > 0:
+    _shared = SharedSlices(settings.SLICE_SHARED_PATH, settings.SLICE_SHARED_BYTES, settings.SLICE_SHARED_MIN_BYTES)
+else:
+    _shared = None
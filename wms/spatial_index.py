@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Packed Hilbert R-tree over bounding boxes, stored as two flat arrays.
+
+Boxes are sorted along a Hilbert curve and packed NODE_SIZE at a time into
+parent boxes, level by level up to a single root.  `order` holds the
+original box indexes in curve order and `tree` every level of boxes
+(minx, miny, maxx, maxy), leaves first.  Both are plain arrays so they can be
+saved as .npy files and memory mapped.
+"""
+import numpy as np
+
+
+NODE_SIZE = 16
+HILBERT_BITS = 16
+
+
+def hilbert_keys(x, y, bounds, bits=HILBERT_BITS):
+    """
+    Return the distance along a Hilbert curve of 2**bits cells per side
+    covering `bounds` (minx, miny, maxx, maxy) of every point.  Points with
+    NaN coordinates sort last.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = 1 << bits
+    minx, miny, maxx, maxy = bounds
+    invalid = ~(np.isfinite(x) & np.isfinite(y))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xi = np.clip((x - minx) / max(maxx - minx, 1e-300) * n, 0, n - 1)
+        yi = np.clip((y - miny) / max(maxy - miny, 1e-300) * n, 0, n - 1)
+    xi = np.where(invalid, 0, xi).astype(np.int64)
+    yi = np.where(invalid, 0, yi).astype(np.int64)
+
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        xi = np.where(flip, n - 1 - xi, xi)
+        yi = np.where(flip, n - 1 - yi, yi)
+        xi, yi = np.where(ry, xi, yi), np.where(ry, yi, xi)
+        s >>= 1
+    d[invalid] = n * n
+    return d
+
+
+def face_boxes(nodes, faces):
+    """
+    Return the (n, 4) bounding boxes of the faces of a mesh.  Masked (or
+    negative) node indexes of mixed meshes are ignored.
+    """
+    faces = np.ma.asarray(faces)
+    filled = np.ma.filled(faces, -1)
+    filled = np.where(filled < 0, filled[:, :1], filled)
+    fx = nodes[:, 0][filled]
+    fy = nodes[:, 1][filled]
+    with np.errstate(invalid='ignore'):
+        return np.column_stack((fx.min(axis=1), fy.min(axis=1), fx.max(axis=1), fy.max(axis=1)))
+
+
+def level_sizes(n, node_size=NODE_SIZE):
+    """ Number of boxes in each level of a tree over n boxes, leaves first """
+    sizes = [n]
+    while sizes[-1] > 1:
+        sizes.append(-(-sizes[-1] // node_size))
+    return sizes
+
+
+def build(boxes, node_size=NODE_SIZE):
+    """
+    Pack (n, 4) boxes into a tree.  Returns (order, tree), see the module
+    docstring.  Boxes with NaN coordinates are never found by query().
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    dtype = np.int32 if boxes.shape[0] < np.iinfo(np.int32).max else np.int64
+    if boxes.shape[0] == 0:
+        return np.empty(0, dtype=dtype), np.empty((0, 4))
+
+    with np.errstate(invalid='ignore'):
+        bounds = (np.nanmin(boxes[:, 0]), np.nanmin(boxes[:, 1]), np.nanmax(boxes[:, 2]), np.nanmax(boxes[:, 3]))
+        keys = hilbert_keys((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2, bounds)
+    order = np.argsort(keys, kind='mergesort').astype(dtype)
+
+    level = boxes[order]
+    levels = [level]
+    while level.shape[0] > 1:
+        starts = np.arange(0, level.shape[0], node_size)
+        level = np.column_stack((
+            np.fmin.reduceat(level[:, 0], starts),
+            np.fmin.reduceat(level[:, 1], starts),
+            np.fmax.reduceat(level[:, 2], starts),
+            np.fmax.reduceat(level[:, 3], starts)
+        ))
+        levels.append(level)
+    return order, np.concatenate(levels)
+
+
+def query(order, tree, bbox, node_size=NODE_SIZE):
+    """
+    Return the sorted indexes of the boxes intersecting bbox
+    (minx, miny, maxx, maxy).
+    """
+    minx, miny, maxx, maxy = bbox
+    sizes = level_sizes(order.shape[0], node_size)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    if sizes[0] == 0:
+        return np.empty(0, dtype=order.dtype)
+
+    candidates = np.arange(sizes[-1])
+    for level in range(len(sizes) - 1, -1, -1):
+        boxes = tree[offsets[level] + candidates]
+        with np.errstate(invalid='ignore'):
+            hit = (
+                (boxes[:, 0] <= maxx) &
+                (boxes[:, 2] >= minx) &
+                (boxes[:, 1] <= maxy) &
+                (boxes[:, 3] >= miny)
+            )
+        candidates = candidates[hit]
+        if level > 0:
+            children = (candidates[:, None] * node_size + np.arange(node_size)).ravel()
+            candidates = children[children < sizes[level - 1]]
+
+    return np.sort(order[candidates])
+
+
+def scan(boxes, bbox):
+    """ query() without a tree: the sorted indexes of the (n, 4) boxes intersecting bbox """
+    minx, miny, maxx, maxy = bbox
+    with np.errstate(invalid='ignore'):
+        hit = (
+            (boxes[:, 0] <= maxx) &
+            (boxes[:, 2] >= minx) &
+            (boxes[:, 1] <= maxy) &
+            (boxes[:, 3] >= miny)
+        )
+    return np.flatnonzero(hit)
@@ -9,6 +9,10 @@ from huey.contrib.djhuey import HUEY
 from django.db.utils import IntegrityError
 
 from wms.models import Dataset, UnidentifiedDataset
+from wms import generations
+from wms import tile_cache
+from wms import slices
+from wms import mirror
 from huey.contrib.djhuey import db_periodic_task, db_task
 
 from sciwms import logger  # noqa
@@ -33,6 +37,10 @@ def update_time_cache(pkey):
         try:
             d = Dataset.objects.get(pk=pkey)
             d.update_time_cache()
+            generations.advance(d)
+            tile_cache.invalidate(d)
+            slices.invalidate(d)
+            mirror.invalidate(d)
             # Save without callbacks
             Dataset.objects.filter(pk=pkey).update(cache_last_updated=datetime.utcnow().replace(tzinfo=pytz.utc))
             return 'Updated {} ({!s})'.format(d.name, d.pk)
@@ -48,6 +56,10 @@ def update_grid_cache(pkey):
         try:
             d = Dataset.objects.get(pk=pkey)
             d.update_grid_cache()
+            generations.advance(d)
+            tile_cache.invalidate(d)
+            slices.invalidate(d)
+            mirror.invalidate(d)
             return 'Updated {} ({!s})'.format(d.name, d.pk)
         except Dataset.DoesNotExist:
             return 'Dataset did not exist, can not complete task'
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import netCDF4 as nc4
+from django.test.utils import override_settings
+from pyaxiom.netcdf import EnhancedMFDataset
+
+from wms.utils import DotDict
+from wms import aggregation
+from wms import handles
+from wms import slices
+
+
+class TestAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(TOPOLOGY_PATH=self.root)
+        self.settings.enable()
+        slices._slices.clear()
+
+        # Three daily files of 4 steps, the second one empty
+        for i, count in enumerate([4, 0, 4, 4]):
+            with nc4.Dataset(os.path.join(self.root, 'day_{}.nc'.format(i)), 'w', format='NETCDF3_64BIT_OFFSET') as nc:
+                nc.createDimension('time', None)
+                nc.createDimension('node', 10)
+                t = nc.createVariable('time', 'f8', ('time',))
+                t.units = 'hours since 2000-01-01'
+                t.standard_name = 'time'
+                t[:] = np.arange(i * 24, i * 24 + count * 6, 6)
+                v = nc.createVariable('salt', 'f4', ('time', 'node'))
+                v[:] = np.arange(i * 1000, i * 1000 + count * 10).reshape(count, 10)
+                nc.createVariable('depth', 'f4', ('node',))[:] = np.arange(10)
+
+        self.pattern = os.path.join(self.root, 'day_*.nc')
+        self.nc = EnhancedMFDataset(self.pattern, aggdim='time')
+        self.dataset = DotDict(safe_filename='aggregation_testing', name='aggregation_testing')
+        aggregation.update(self.dataset, self.nc)
+
+    def tearDown(self):
+        self.nc.close()
+        for i in range(4):
+            handles.close(os.path.join(self.root, 'day_{}.nc'.format(i)))
+        self.settings.disable()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_index(self):
+        index = aggregation.load(self.dataset)
+        assert index.size == 12
+        assert index.locate(0) == (os.path.join(self.root, 'day_0.nc'), 0)
+        assert index.locate(4) == (os.path.join(self.root, 'day_2.nc'), 0)
+        assert index.locate(11) == (os.path.join(self.root, 'day_3.nc'), 3)
+        assert index.segments(3, 12, 2) == [
+            (os.path.join(self.root, 'day_0.nc'), slice(3, 4, 2)),
+            (os.path.join(self.root, 'day_2.nc'), slice(1, 4, 2)),
+            (os.path.join(self.root, 'day_3.nc'), slice(1, 4, 2)),
+        ]
+
+    def test_reads(self):
+        salt = self.nc.variables['salt']
+        proxy = aggregation.variable(self.dataset, 'salt', salt)
+        assert isinstance(proxy, aggregation.Variable)
+        for key in [5, -1, (7, slice(2, 5)), slice(None), (slice(1, 11, 3), 4)]:
+            np.testing.assert_array_equal(proxy[key], salt[key])
+
+        # Only the file holding the time step is opened
+        with handles.dataset(os.path.join(self.root, 'day_0.nc')):
+            pass
+        handles.close(os.path.join(self.root, 'day_3.nc'))
+        proxy[4]
+        assert (os.path.join(self.root, 'day_3.nc'), 0) not in handles._handles
+
+        # Variables without time are not indexed
+        assert aggregation.variable(self.dataset, 'depth', self.nc.variables['depth']) is self.nc.variables['depth']
+
+    def test_slices_read(self):
+        data = slices.read(self.dataset, 'salt', self.nc.variables['salt'], (6,), None, lambda v, p: v[p])
+        np.testing.assert_array_equal(data, self.nc.variables['salt'][6])
+
+    def test_nearest(self):
+        index = aggregation.load(self.dataset)
+        time = self.nc.variables['time'][:]
+        for value in [-5, 0, 7, 18, 19, 30, 48, 66, 100]:
+            expected = min(np.searchsorted(time, value, side='left'), len(time) - 1)
+            assert index.nearest('time', value) == (expected, time[expected])
+
+    def test_single_file(self):
+        with nc4.Dataset(os.path.join(self.root, 'day_0.nc')) as nc:
+            aggregation.update(self.dataset, nc)
+        assert aggregation.load(self.dataset) is None
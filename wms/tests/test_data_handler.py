@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import io
+import unittest
+
+import numpy as np
+import matplotlib as mpl
+import matplotlib.image  # noqa
+
+from wms import data_handler
+from wms.data_handler import blank_response, pooled_figure, read_ranges
+from wms.utils import DotDict
+
+
+class TestPooledFigure(unittest.TestCase):
+
+    def test_figures_are_reused_and_cleared(self):
+        with pooled_figure(64, 32) as (fig, ax):
+            ax.pcolormesh(np.arange(3), np.arange(3), np.ones((2, 2)))
+            ax.plot([0, 1], [0, 1])
+            assert len(ax.collections) == 1
+
+        with pooled_figure(64, 32) as (again, ax):
+            assert again is fig
+            assert len(ax.collections) == 0
+            assert len(ax.lines) == 0
+            assert ax.axison is False
+
+            fig.canvas.draw()
+            assert fig.canvas.get_width_height() == (64, 32)
+
+    def test_nested_figures_are_distinct(self):
+        with pooled_figure(16, 16) as (outer, _):
+            with pooled_figure(16, 16) as (inner, _):
+                assert inner is not outer
+
+
+class TestBlankResponse(unittest.TestCase):
+
+    class FakeRequest(object):
+        def __init__(self, **kwargs):
+            self.GET = kwargs
+
+    def test_blank_tiles_are_transparent_and_reused(self):
+        request = self.FakeRequest(width=300, height=200)
+        response = blank_response(request)
+        assert response['Content-Type'] == 'image/png'
+        img = mpl.image.imread(io.BytesIO(response.content), format='png')
+        assert img.shape[:2] == (200, 300)
+        assert not img[:, :, 3].any()
+
+        hits = data_handler._blanks.hits
+        assert blank_response(request).content == response.content
+        assert data_handler._blanks.hits == hits + 1
+        assert blank_response(self.FakeRequest(width=200, height=300)).content != response.content
+
+    def test_png_options(self):
+        options = DotDict(compress_level=0, filter='none', strategy='default', palette=False)
+        plain = blank_response(self.FakeRequest(width=64, height=64))
+        stored = blank_response(self.FakeRequest(width=64, height=64, png_options=options))
+        assert len(stored.content) > len(plain.content)
+
+
+class TestAnimationResponse(unittest.TestCase):
+
+    class FakeRequest(object):
+        def __init__(self, **kwargs):
+            self.GET = kwargs
+
+    def test_first_frame_errors_are_raised(self):
+        def frames():
+            raise ValueError('Could not render the frame')
+            yield
+
+        with self.assertRaises(ValueError):
+            data_handler.animation_response(frames(), 2, self.FakeRequest(framerate=4., animation='apng'))
+
+    def test_frames(self):
+        frames = (np.full((8, 8, 4), k, dtype=np.uint8) for k in range(3))
+        response = data_handler.animation_response(frames, 3, self.FakeRequest(framerate=4., animation='apng'))
+        content = b''.join(response.streaming_content)
+        assert content.count(b'fcTL') == 3
+
+
+class TestReadRanges(unittest.TestCase):
+
+    def test_read_ranges(self):
+        variable = np.arange(60.).reshape(3, 20)
+        data = read_ranges(variable, (1,), [slice(2, 5), slice(10, 12)], 20)
+        assert data.shape == (20,)
+        np.testing.assert_array_equal(data.compressed(), [22., 23., 24., 30., 31.])
+        assert data.mask[:2].all() and data.mask[12:].all()
+
+    def test_read_ranges_of_several_times(self):
+        variable = np.arange(60.).reshape(3, 20)
+        data = read_ranges(variable, (slice(0, 3, 2),), [slice(2, 5)], 20)
+        assert data.shape == (2, 20)
+        np.testing.assert_array_equal(data[:, 2:5], [[2., 3., 4.], [42., 43., 44.]])
+        assert data.mask[:, 5:].all()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import io
+import zlib
+import struct
+import unittest
+
+import numpy as np
+import matplotlib as mpl
+import matplotlib.image  # noqa
+
+from wms import encoders
+
+
+def decode(content):
+    img = mpl.image.imread(io.BytesIO(content), format='png')
+    if img.shape[2] == 3:
+        img = np.dstack((img, np.ones(img.shape[:2])))
+    return (img * 255).round().astype(np.uint8)
+
+
+def visible(rgba):
+    """ RGB of transparent pixels is not meaningful """
+    rgba = rgba.copy()
+    rgba[rgba[:, :, 3] == 0] = 0
+    return rgba
+
+
+class TestPngEncoder(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(42)
+        # Few colors, like a rendered colormap tile
+        colors = rs.randint(0, 256, size=(40, 4)).astype(np.uint8)
+        colors[:, 3] = 255
+        colors[0] = 0
+        self.indexed = colors[rs.randint(0, 40, size=(64, 96))]
+        # Many colors
+        self.rgba = rs.randint(0, 256, size=(64, 96, 4)).astype(np.uint8)
+
+    def test_palette(self):
+        palette, indexes = encoders.palettize(self.indexed)
+        assert palette.shape[0] <= 40
+        np.testing.assert_array_equal(palette[indexes], visible(self.indexed))
+        assert encoders.palettize(self.rgba) is None
+
+    def test_valid_option(self):
+        assert encoders.valid_option('compress_level', 9)
+        assert not encoders.valid_option('compress_level', 10)
+        assert not encoders.valid_option('compress_level', True)
+        assert encoders.valid_option('filter', 'adaptive')
+        assert not encoders.valid_option('filter', 'best')
+        assert encoders.valid_option('strategy', 'rle')
+        assert not encoders.valid_option('strategy', ['rle'])
+        assert not encoders.valid_option('level', 6)
+
+    def test_palette_roundtrip(self):
+        content = encoders.png(self.indexed)
+        assert content[25] == 3  # IHDR color type: indexed
+        np.testing.assert_array_equal(decode(content), visible(self.indexed))
+        assert len(content) < len(encoders.png(self.indexed, palette=False))
+
+    def test_filters_roundtrip(self):
+        for filter in encoders.FILTERS + ['adaptive', 'auto']:
+            for image in (self.rgba, self.indexed):
+                content = encoders.png(image, filter=filter)
+                np.testing.assert_array_equal(visible(decode(content)), visible(image))
+
+    def test_strategies_roundtrip(self):
+        for strategy in encoders.STRATEGIES:
+            for level in (0, 1, 9):
+                content = encoders.png(self.rgba, compress_level=level, strategy=strategy)
+                np.testing.assert_array_equal(decode(content), self.rgba)
+
+
+def chunks(content):
+    """ (type, data) of the chunks of a PNG """
+    position = len(encoders.PNG_SIGNATURE)
+    while position < len(content):
+        length, = struct.unpack('>I', content[position:position + 4])
+        yield content[position + 4:position + 8], content[position + 8:position + 8 + length]
+        position += length + 12
+
+
+def lzw_decode(data, min_code_size):
+    """ Minimal GIF LZW decoder """
+    clear = 1 << min_code_size
+    bits = int.from_bytes(data, 'little')
+    position = 0
+    out = []
+    table = None
+    previous = None
+    width = min_code_size + 1
+    while True:
+        code = (bits >> position) & ((1 << width) - 1)
+        position += width
+        if code == clear:
+            table = [[i] for i in range(clear)] + [None, None]
+            width = min_code_size + 1
+            previous = None
+            continue
+        elif code == clear + 1:
+            return out
+        if previous is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else previous + previous[:1]
+            if len(table) < 4096:
+                table.append(previous + entry[:1])
+        out.extend(entry)
+        previous = entry
+        if len(table) == (1 << width) and width < 12:
+            width += 1
+
+
+class TestAnimationEncoders(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(42)
+        colors = rs.randint(0, 256, size=(40, 4)).astype(np.uint8)
+        colors[:, 3] = 255
+        colors[0] = 0
+        self.frames = [colors[rs.randint(0, 40, size=(64, 96))] for _ in range(3)]
+
+    def test_apng(self):
+        content = b''.join(encoders.apng(iter(self.frames), 3, 250))
+        # The first frame is the default image
+        np.testing.assert_array_equal(decode(content), self.frames[0])
+
+        found = list(chunks(content))
+        kinds = [k for k, _ in found]
+        assert kinds == [b'IHDR', b'acTL', b'fcTL', b'IDAT', b'fcTL', b'fdAT', b'fcTL', b'fdAT', b'IEND']
+        assert struct.unpack('>II', found[1][1]) == (3, 0)
+        sequences = [struct.unpack('>I', d[:4])[0] for k, d in found if k in [b'fcTL', b'fdAT']]
+        assert sequences == list(range(5))
+
+        scanlines = np.frombuffer(zlib.decompress(found[-2][1][4:]), dtype=np.uint8).reshape(64, 96 * 4 + 1)
+        expected = encoders.filter_scanlines(self.frames[2].reshape(64, 96 * 4), 4, 'up')
+        np.testing.assert_array_equal(scanlines, expected)
+
+    def test_gif_lzw_roundtrip(self):
+        rs = np.random.RandomState(1)
+        for size in [1, 2, 255, 256, 5000, 70000]:
+            indexes = rs.randint(0, 4, size=size).astype(np.uint8)
+            indexes[size // 2:] = 3
+            assert lzw_decode(encoders.lzw(indexes, 2), 2) == indexes.tolist()
+
+    def test_gif_quantize(self):
+        palette, image = encoders.quantize(self.frames[0])
+        assert palette.shape[0] <= 256
+        opaque = self.frames[0][:, :, 3] >= 128
+        assert (image[~opaque] == 0).all()
+        np.testing.assert_array_equal(palette[image[opaque]], self.frames[0][:, :, :3][opaque])
+
+        many = np.random.RandomState(0).randint(0, 256, size=(64, 96, 4)).astype(np.uint8)
+        many[:, :, 3] = 255
+        palette, image = encoders.quantize(many)
+        assert palette.shape[0] <= 256
+        assert np.abs(palette[image].astype(int) - many[:, :, :3]).max() <= 26
+
+    def test_gif(self):
+        content = b''.join(encoders.gif(iter(self.frames), 250))
+        assert content[:6] == b'GIF89a'
+        assert content[-1:] == b'\x3b'
+        # One graphic control extension per frame
+        assert content.count(b'\x21\xf9\x04') == 3
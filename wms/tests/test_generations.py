@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.test.utils import override_settings
+
+from wms.utils import DotDict
+from wms import generations
+
+
+class TestGenerations(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(TOPOLOGY_PATH=self.root)
+        self.settings.enable()
+        generations._current.clear()
+        self.dataset = DotDict(safe_filename='generations_testing', name='generations_testing')
+
+    def tearDown(self):
+        generations._current.clear()
+        self.settings.disable()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_initial(self):
+        assert generations.current(self.dataset) == generations.INITIAL_GENERATION
+        # Reads never write the marker
+        assert os.listdir(self.root) == []
+
+    def test_advance(self):
+        first = generations.advance(self.dataset)
+        assert first != generations.INITIAL_GENERATION
+        assert generations.current(self.dataset) == first
+        second = generations.advance(self.dataset)
+        assert second != first
+        assert generations.current(self.dataset) == second
+
+    def test_checked_by_mtime(self):
+        first = generations.advance(self.dataset)
+        generations.current(self.dataset)
+        # Another worker starts a generation
+        with open(generations.marker(self.dataset), 'w') as f:
+            f.write('other')
+        os.utime(generations.marker(self.dataset), ns=(0, 1))
+        assert generations.current(self.dataset) == first
+        checked, mtime, generation = generations._current[self.dataset.safe_filename]
+        generations._current[self.dataset.safe_filename] = (checked - generations.CHECK_SECONDS, mtime, generation)
+        assert generations.current(self.dataset) == 'other'
+
+    def test_read_only(self):
+        with override_settings(TOPOLOGY_PATH=os.path.join(self.root, 'missing')):
+            assert generations.advance(self.dataset) == generations.INITIAL_GENERATION
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import netCDF4 as nc4
+from django.test.utils import override_settings
+
+from wms import handles
+
+
+class TestHandles(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.root, 'handles_{}.nc'.format(i))
+            self.write(path, i)
+            self.paths.append(path)
+
+    def tearDown(self):
+        for path in self.paths:
+            handles.close(path)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, path, value):
+        # Replaced, as the files of a dataset are updated
+        tmpsave = path + '.tmp'
+        with nc4.Dataset(tmpsave, 'w') as nc:
+            nc.createDimension('x', 1)
+            nc.createVariable('value', 'i4', ('x',))[:] = value
+        os.replace(tmpsave, path)
+
+    def test_reused(self):
+        with handles.dataset(self.paths[0], 'a') as first:
+            assert first.variables['value'][0] == 0
+            # Nested uses share the handle
+            with handles.dataset(self.paths[0], 'a') as nested:
+                assert nested is first
+        with handles.dataset(self.paths[0], 'a') as second:
+            assert second is first
+
+    def test_locked_while_reading(self):
+        with handles.dataset(self.paths[0], 'a') as nc:
+            handle = handles._handles[(self.paths[0], 0)]
+            # Other requests may use the handle between reads
+            assert not handle.lock._is_owned()
+            with handles.reading():
+                assert handle.lock._is_owned()
+                assert nc.variables['value'][0] == 0
+            # Nor is it reopened under them on a new token
+            with handles.dataset(self.paths[0], 'b') as nested:
+                assert nested is nc
+        assert handle.users == 0
+
+    def test_reopened_on_new_token(self):
+        with handles.dataset(self.paths[0], 'a') as first:
+            pass
+        with handles.dataset(self.paths[0], 'b') as second:
+            assert second is not first
+            assert second.variables['value'][0] == 0
+
+    def test_reopened_on_modification(self):
+        with handles.dataset(self.paths[0], 'a') as first:
+            pass
+        self.write(self.paths[0], 10)
+        os.utime(self.paths[0], ns=(0, 0))
+        handles._handles[(self.paths[0], 0)].checked = 0
+        with handles.dataset(self.paths[0], 'a') as second:
+            assert second is not first
+            assert second.variables['value'][0] == 10
+
+    def test_closed_once_released(self):
+        with handles.dataset(self.paths[0], 'a') as nc:
+            handle = handles._handles[(self.paths[0], 0)]
+            handles.close(self.paths[0])
+            # Still readable by the request using it
+            assert handle.nc is nc
+            assert nc.variables['value'][0] == 0
+        assert handle.nc is None
+        assert (self.paths[0], 0) not in handles._handles
+
+    def test_missing(self):
+        with handles.dataset(os.path.join(self.root, 'nope.nc')) as nc:
+            assert nc is None
+        assert (os.path.join(self.root, 'nope.nc'), 0) not in handles._handles
+
+    @override_settings(NETCDF_POOL_SIZE=2)
+    def test_max_open(self):
+        for path in self.paths:
+            with handles.dataset(path, 'a'):
+                pass
+        assert len(handles._handles) == 2
+        assert (self.paths[0], 0) not in handles._handles
+
+    @override_settings(NETCDF_POOL_IDLE=0)
+    def test_idle(self):
+        with handles.dataset(self.paths[0], 'a'):
+            pass
+        with handles.dataset(self.paths[1], 'a'):
+            assert (self.paths[0], 0) not in handles._handles
+
+    def test_map_lanes(self):
+        threads = []
+
+        def read(nc, name):
+            threads.append((threading.get_ident(), id(nc)))
+            return nc.variables[name][0]
+
+        with handles.dataset(self.paths[0], 'a') as nc:
+            values = handles.map_lanes(self.paths[0], 'a', read, ['value', 'value', 'value'])
+            assert values == [0, 0, 0]
+            # The first component is read with the handle held by this thread
+            assert (threading.get_ident(), id(nc)) in threads
+            # The others each with their own handle
+            assert len(set(t[1] for t in threads)) == 3
+
+        with handles.locked(self.paths[0]):
+            assert all(h.lock._is_owned() for k, h in handles._handles.items() if k[0] == self.paths[0])
+
+    @override_settings(READ_WORKERS=0)
+    def test_map_lanes_sequential(self):
+        assert handles.map_lanes(self.paths[0], 'a', lambda nc, n: nc.variables[n][0], ['value', 'value']) == [0, 0]
+        assert len([k for k in handles._handles if k[0] == self.paths[0]]) == 1
+
+    def test_map_lanes_green_threads(self):
+        # Lanes on green threads would read one after another anyway
+        with mock.patch('wms.handles.green_threads', return_value=True):
+            assert handles.map_lanes(self.paths[0], 'a', lambda nc, n: nc.variables[n][0], ['value', 'value']) == [0, 0]
+        assert len([k for k in handles._handles if k[0] == self.paths[0]]) == 1
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+
+from wms import lod
+
+
+class TestLod(unittest.TestCase):
+
+    def setUp(self):
+        # Regular triangulated grid of 0.1 degree
+        n = 101
+        i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        self.nodes = np.column_stack((j.ravel() * 0.1, i.ravel() * 0.1))
+        cell = (i[:-1, :-1] * n + j[:-1, :-1]).ravel()
+        self.faces = np.column_stack((cell, cell + 1, cell + n + 1, cell, cell + n + 1, cell + n)).reshape(-1, 3)
+
+    def test_edge_length(self):
+        self.assertAlmostEqual(lod.edge_length(self.nodes, self.faces), 0.1)
+
+    def test_decimate(self):
+        faces = lod.decimate(self.nodes, self.faces, 0.5)
+        assert 0 < faces.shape[0] < self.faces.shape[0] / 10
+        # Faces still index the full mesh, none collapsed or repeated
+        assert faces.max() < self.nodes.shape[0]
+        assert (np.sort(faces, axis=1)[:, 1:] != np.sort(faces, axis=1)[:, :-1]).all()
+        assert np.unique(np.sort(faces, axis=1), axis=0).shape[0] == faces.shape[0]
+
+    def test_levels(self):
+        levels = lod.build_levels(self.nodes, self.faces, min_faces=50)
+        cell_sizes = [c for c, _ in levels]
+        counts = [f.shape[0] for _, f in levels]
+        self.assertAlmostEqual(cell_sizes[0], 0.2)
+        assert cell_sizes == sorted(cell_sizes)
+        assert counts == sorted(counts, reverse=True)
+        assert counts[0] < self.faces.shape[0]
+
+    def test_masked_and_nan_nodes(self):
+        nodes = self.nodes.copy()
+        nodes[0] = np.nan
+        faces = np.ma.masked_array(np.column_stack((self.faces, self.faces[:, 0])), mask=False)
+        faces[:, 3] = np.ma.masked
+        decimated = lod.decimate(nodes, lod.triangles(faces), 0.5)
+        assert not (decimated == 0).any()
+
+    def test_pick_level(self):
+        cell_sizes = [0.2, 0.4, 0.8]
+        assert lod.pick_level(cell_sizes, 0.01, 4) is None
+        assert lod.pick_level(cell_sizes, 0.1, 4) == 1
+        assert lod.pick_level(cell_sizes, 1., 4) == 2
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import netCDF4 as nc4
+from django.test.utils import override_settings
+
+from wms.utils import DotDict
+from wms import mirror
+from wms import slices
+
+
+class RemoteStandIn(object):
+    """ A netCDF variable recording the requests made to it, as an OPeNDAP server would """
+
+    def __init__(self, variable):
+        self.variable = variable
+        self.shape = variable.shape
+        self.requests = []
+
+    def __getitem__(self, key):
+        self.requests.append(key)
+        return self.variable[key]
+
+
+class TestMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(TOPOLOGY_PATH=self.root, MIRROR_PATH=os.path.join(self.root, 'mirror'),
+                                          MIRROR_CHUNK_ELEMENTS=64, MIRROR_BYTES=1 << 30)
+        self.settings.enable()
+        mirror._index = None
+        slices._slices.clear()
+        # Only the cache of this process
+        self.shared = slices._shared
+        slices._shared = None
+
+        self.nc = nc4.Dataset(os.path.join(self.root, 'remote.nc'), 'w')
+        self.nc.createDimension('time', 5)
+        self.nc.createDimension('y', 20)
+        self.nc.createDimension('x', 30)
+        v = self.nc.createVariable('temp', 'f4', ('time', 'y', 'x'), fill_value=-999.)
+        data = np.arange(5 * 20 * 30, dtype=np.float32).reshape(5, 20, 30)
+        data[:, 3:5, 7:9] = -999.
+        v[:] = data
+        self.remote = RemoteStandIn(v)
+        self.dataset = DotDict(safe_filename='mirror_testing', name='mirror_testing', mirrored=True)
+        self.variable = mirror.Variable(self.dataset, 'temp', self.remote, 1)
+
+    def tearDown(self):
+        self.nc.close()
+        self.settings.disable()
+        mirror._index = None
+        slices._shared = self.shared
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_chunk_shape(self):
+        assert self.variable.chunks == (1, 8, 8)
+        assert mirror.chunk_shape((10, 3, 1000), 1) == (1, 3, 21)
+        assert mirror.chunk_shape((10, 1000), 1) == (1, 64)
+
+    def test_read_through(self):
+        first = self.variable[2, 1:12, 5:20]
+        np.testing.assert_array_equal(first, self.remote.variable[2, 1:12, 5:20])
+        # Aligned to the chunk grid
+        assert self.remote.requests == [(slice(2, 3), slice(0, 16), slice(0, 24))]
+
+        # Served from the chunks on disk, with the mask
+        second = self.variable[2, 3:10:2, 6:17]
+        assert len(self.remote.requests) == 1
+        expected = self.remote.variable[2, 3:10:2, 6:17]
+        np.testing.assert_array_equal(second.mask, expected.mask)
+        np.testing.assert_array_equal(second.filled(0), expected.filled(0))
+
+        # Another time step is not mirrored yet
+        self.variable[3, 1:12, 5:20]
+        assert len(self.remote.requests) == 2
+
+    def test_points_are_not_mirrored(self):
+        self.variable[0:5, 4, 4]
+        assert self.remote.requests == [(slice(0, 5), 4, 4)]
+        assert mirror.index().stats()['items'] == 0
+
+    def test_strided_reads_are_not_mirrored(self):
+        data = self.variable[2, 0:20:4, 1:30:5]
+        np.testing.assert_array_equal(data, self.remote.variable[2, 0:20:4, 1:30:5])
+        assert self.remote.requests == [(2, slice(0, 20, 4), slice(1, 30, 5))]
+        assert mirror.index().stats()['items'] == 0
+
+        # Served from the mirror once its chunks are stored
+        self.variable[2]
+        requests = len(self.remote.requests)
+        np.testing.assert_array_equal(self.variable[2, 0:20:4, 1:30:5], data)
+        assert len(self.remote.requests) == requests
+
+    def test_not_writable(self):
+        # A file where the mirror should be, as a read-only mount
+        path = os.path.join(self.root, 'readonly')
+        open(path, 'w').close()
+        failures = mirror._failures
+        with override_settings(MIRROR_PATH=path):
+            mirror._index = None
+            for _ in range(2):
+                np.testing.assert_array_equal(self.variable[2, 1:12, 5:20], self.remote.variable[2, 1:12, 5:20])
+            assert len(self.remote.requests) == 2
+            assert mirror.stats()['failures'] == failures + 2
+
+    def test_quota(self):
+        with override_settings(MIRROR_BYTES=4096):
+            mirror._index = None
+            for t in range(5):
+                self.variable[t]
+            stats = mirror.index().stats()
+            assert stats['size'] <= 4096
+            assert stats['evictions'] > 0
+            # The evicted chunks are read again
+            requests = len(self.remote.requests)
+            self.variable[0]
+            assert len(self.remote.requests) == requests + 1
+
+    def test_slices_read(self):
+        data = slices.read(self.dataset, 'temp', self.remote, (1,), None, lambda v, p: v[p])
+        np.testing.assert_array_equal(data, self.remote.variable[1])
+        assert self.remote.requests == [(slice(1, 2), slice(0, 20), slice(0, 30))]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyproj
+
+from wms.utils import DotDict
+from .. import projections
+from ..projections import (crs_code, is_web_mercator, web_mercator, to_crs,
+                           get_proj, get_transformer, tile_bounds, tile_range)
+
+
+class TestProjections(unittest.TestCase):
+
+    def setUp(self):
+        self.EPSG4326 = pyproj.Proj(init='EPSG:4326')
+        self.lon = np.array([-180., -123.5, 0., 45.25, 179.9, 190.])
+        self.lat = np.array([-85., -33.3, 0., 12.5, 60., 85.])
+
+    def test_crs_code(self):
+        assert crs_code(pyproj.Proj(init='EPSG:3857')) == 'EPSG:3857'
+        assert crs_code('epsg:4326') == 'EPSG:4326'
+        assert crs_code('MERCATOR') == 'EPSG:3857'
+        assert is_web_mercator(pyproj.Proj(init='EPSG:900913')) is True
+        assert is_web_mercator(pyproj.Proj(init='EPSG:4326')) is False
+
+    def test_web_mercator_matches_pyproj(self):
+        crs = pyproj.Proj(init='EPSG:3857')
+        x, y = web_mercator(self.lon, self.lat)
+        px, py = pyproj.transform(self.EPSG4326, crs, self.lon, self.lat)
+        np.testing.assert_allclose(x, px, atol=1e-6)
+        np.testing.assert_allclose(y, py, atol=1e-6)
+
+    def test_to_crs_other(self):
+        crs = pyproj.Proj(init='EPSG:32610')
+        x, y = to_crs(self.lon[1:2], self.lat[1:2], crs)
+        px, py = pyproj.transform(self.EPSG4326, crs, self.lon[1:2], self.lat[1:2])
+        np.testing.assert_allclose(x, px)
+        np.testing.assert_allclose(y, py)
+
+    def test_registry_reuses_objects(self):
+        assert get_proj('epsg:3857') is get_proj('EPSG:3857')
+        assert get_proj('MERCATOR') is get_proj('EPSG:3857')
+        assert get_transformer('EPSG:3857', 'EPSG:4326') is get_transformer(get_proj('EPSG:3857'), get_proj('EPSG:4326'))
+
+    def test_inverse_web_mercator(self):
+        x, y = web_mercator(self.lon[1:-1], self.lat[1:-1])
+        lon, lat = get_transformer('EPSG:3857', 'EPSG:4326').transform(x, y)
+        np.testing.assert_allclose(lon, self.lon[1:-1], atol=1e-9)
+        np.testing.assert_allclose(lat, self.lat[1:-1], atol=1e-9)
+
+    def test_tile_bounds(self):
+        extent = 20037508.342789244
+        np.testing.assert_allclose(tile_bounds(0, 0, 0), (-extent, -extent, extent, extent))
+        np.testing.assert_allclose(tile_bounds(1, 1, 0), (0, 0, extent, extent), atol=1e-6)
+
+    def test_tile_range(self):
+        assert tile_range((-180, -90, 180, 90), 2) == (0, 0, 3, 3)
+        # New York harbour at zoom 10
+        assert tile_range((-74.1, 40.5, -73.7, 40.9), 10) == (301, 384, 302, 385)
+        # Every tile of the range intersects the bbox
+        minx, miny, maxx, maxy = tile_bounds(10, 301, 385)
+        lon, lat = get_transformer('EPSG:3857', 'EPSG:4326').transform([minx, maxx], [miny, maxy])
+        assert lon[0] <= -74.1 <= lon[1] and lat[0] <= 40.5 <= lat[1]
+
+
+class TestProjected(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.lon = np.linspace(-120, -110, 50)
+        self.lat = np.linspace(30, 40, 50)
+        projections._projected.clear()
+
+    def tearDown(self):
+        projections._projected.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def dataset(self, root):
+        return DotDict(
+            name='projected_testing',
+            topology_file=os.path.join(self.root, 'projected_testing.nc'),
+            topology_array_file=lambda name: os.path.join(root, 'projected_testing.{}.npy'.format(name))
+        )
+
+    def test_saved_at_grid_update(self):
+        dataset = self.dataset(self.root)
+        projections.save_projected(dataset, 'node', self.lon, self.lat)
+        x, y = projections.projected(dataset, 'node', self.lon, self.lat, 'EPSG:3857')
+        assert isinstance(x, np.memmap)
+        np.testing.assert_allclose((x, y), web_mercator(self.lon, self.lat))
+
+    def test_read_only(self):
+        # Projections can not be written, they are kept in memory
+        dataset = self.dataset(os.path.join(self.root, 'missing'))
+        x, y = projections.projected(dataset, 'node', self.lon, self.lat, 'EPSG:3857')
+        np.testing.assert_allclose((x, y), web_mercator(self.lon, self.lat))
+        again, _ = projections.projected(dataset, 'node', self.lon, self.lat, 'EPSG:3857')
+        assert np.shares_memory(again, x)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import io
+import unittest
+
+import numpy as np
+import matplotlib as mpl
+import matplotlib.tri as Tri
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from wms.utils import DotDict
+from wms import raster
+from wms import encoders
+
+
+def interior(index):
+    """ Pixels of a rasterized index whose neighbours all belong to the same shape """
+    padded = np.pad(index, 1, mode='edge')
+    inside = np.ones(index.shape, dtype=bool)
+    for dy in range(3):
+        for dx in range(3):
+            inside &= padded[dy:dy + index.shape[0], dx:dx + index.shape[1]] == index
+    return inside
+
+
+class FakeRequest(object):
+
+    def __init__(self, **kwargs):
+        self.GET = kwargs
+
+
+class TestRaster(unittest.TestCase):
+
+    def setUp(self):
+        # A jittered regular mesh in projected units, larger than the tile
+        np.random.seed(0)
+        gx, gy = np.meshgrid(np.linspace(0, 1000, 12), np.linspace(0, 1000, 12))
+        self.x = (gx + np.random.uniform(-20, 20, gx.shape)).ravel()
+        self.y = (gy + np.random.uniform(-20, 20, gy.shape)).ravel()
+        self.tri = Tri.Triangulation(self.x, self.y)
+        self.data = np.sin(self.x / 200.) * np.cos(self.y / 300.)
+        self.request = FakeRequest(
+            bbox=DotDict(minx=100., miny=50., maxx=900., maxy=950.),
+            width=256,
+            height=256,
+            colormap='cubehelix',
+            colorscalerange=DotDict(min=-1, max=1),
+            logscale=False
+        )
+
+    def matplotlib_rgba(self, shading):
+        bbox = self.request.GET['bbox']
+        dpi = 80.
+        fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
+        fig.set_figheight(256 / dpi)
+        fig.set_figwidth(256 / dpi)
+        ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
+        ax.set_axis_off()
+        # Antialiased edges blend with the transparent background, compare
+        # against the aliased output
+        ax.tripcolor(self.tri, self.data.copy(), edgecolors='none', norm=mpl.colors.Normalize(vmin=-1, vmax=1),
+                     cmap='cubehelix', shading=shading, antialiased=False)
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        rgba = np.asarray(canvas.buffer_rgba()).reshape(256, 256, 4).copy()
+        rgba[rgba[:, :, 3] == 0] = 0
+        return rgba
+
+    def pixel_diff(self, shading):
+        expected = self.matplotlib_rgba(shading).astype(int)
+        rgba = raster.tripcolor(self.x, self.y, self.tri.triangles, self.data.copy(), self.request, shading=shading)
+        assert rgba.shape == (256, 256, 4)
+        diff = np.abs(rgba.astype(int) - expected).max(axis=2)
+
+        # Pixels along triangle edges may be assigned to either triangle
+        bbox = self.request.GET['bbox']
+        index = raster.rasterize((self.x - bbox.minx) / (bbox.maxx - bbox.minx) * 256,
+                                 (bbox.maxy - self.y) / (bbox.maxy - bbox.miny) * 256,
+                                 self.tri.triangles, 256, 256)
+        return diff, interior(index)
+
+    def test_flat_matches_matplotlib(self):
+        diff, interior = self.pixel_diff('flat')
+        assert (diff[interior] > 2).mean() < 0.005
+        assert (diff > 2).mean() < 0.1
+
+    def test_gouraud_matches_matplotlib(self):
+        diff, interior = self.pixel_diff('gouraud')
+        # Agg's span interpolator rounds differently
+        assert (diff[interior] > 8).mean() < 0.005
+        assert diff.mean() < 2
+
+    def test_outside_mesh_is_transparent(self):
+        self.request.GET['bbox'] = DotDict(minx=2000., miny=2000., maxx=3000., maxy=3000.)
+        rgba = raster.tripcolor(self.x, self.y, self.tri.triangles, self.data.copy(), self.request)
+        assert not rgba.any()
+
+    def test_png_encoder(self):
+        rgba = raster.tripcolor(self.x, self.y, self.tri.triangles, self.data.copy(), self.request)
+        content = encoders.png(rgba)
+        assert content.startswith(encoders.PNG_SIGNATURE)
+        img = mpl.image.imread(io.BytesIO(content), format='png')
+        np.testing.assert_array_equal((img * 255).round().astype(np.uint8), rgba)
+
+
+class TestRasterGrid(unittest.TestCase):
+
+    def setUp(self):
+        # A rotated and warped curvilinear grid of cell centers
+        i, j = np.meshgrid(np.arange(30), np.arange(25), indexing='ij')
+        self.x = 40. * j + 10. * i + 3. * np.sin(i / 3.)
+        self.y = 35. * i - 8. * j
+        self.data = np.cos(i / 5.) * np.sin(j / 4.) * 10
+        self.request = FakeRequest(
+            bbox=DotDict(minx=100., miny=-50., maxx=900., maxy=750.),
+            width=256,
+            height=256,
+            colormap='jet',
+            colorscalerange=DotDict(min=-10, max=10),
+            logscale=False
+        )
+
+    def test_window(self):
+        bbox = self.request.GET['bbox']
+        rows, cols = raster.grid_window(self.x, self.y, bbox)
+        # Every quad outside of the window is outside of the bbox
+        inside = (self.x >= bbox.minx) & (self.x <= bbox.maxx) & (self.y >= bbox.miny) & (self.y <= bbox.maxy)
+        outside = np.ones(inside.shape, dtype=bool)
+        outside[rows, cols] = False
+        assert not (inside & outside).any()
+
+    def test_pcolormesh_matches_matplotlib(self):
+        bbox = self.request.GET['bbox']
+        window, pixel_cell = raster.grid_pixel_index(self.x, self.y, self.request, key=('test',))
+        assert raster.grid_pixel_index(self.x, self.y, self.request, key=('test',))[1] is pixel_cell
+        rgba = raster.pcolormesh(self.data[window], pixel_cell, self.request)
+
+        dpi = 80.
+        fig = Figure(dpi=dpi, facecolor='none', edgecolor='none')
+        fig.set_figheight(256 / dpi)
+        fig.set_figwidth(256 / dpi)
+        ax = fig.add_axes([0., 0., 1., 1.], xticks=[], yticks=[])
+        ax.set_axis_off()
+        ax.pcolormesh(self.x, self.y, self.data[:-1, :-1], norm=mpl.colors.Normalize(vmin=-10, vmax=10),
+                      cmap='jet', antialiased=False)
+        ax.set_xlim(bbox.minx, bbox.maxx)
+        ax.set_ylim(bbox.miny, bbox.maxy)
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        expected = np.asarray(canvas.buffer_rgba()).reshape(256, 256, 4).astype(int)
+        expected[expected[:, :, 3] == 0] = 0
+
+        diff = np.abs(rgba.astype(int) - expected).max(axis=2)
+        # Pixels along cell edges may be assigned to either cell
+        assert (diff[interior(pixel_cell)] > 2).mean() < 0.005
+        assert (diff > 2).mean() < 0.15
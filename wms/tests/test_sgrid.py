@@ -121,6 +121,24 @@ class TestSgrid(TestCase):
         params.update(styles='pcolor_cubehelix', logscale=True)
         self.do_test(params)
 
+    def test_sgrid_pcolor_numpy(self):
+        params = copy(self.url_params)
+        params.update(styles='pcolor_cubehelix', renderer='numpy')
+        self.do_test(params)
+
+    def test_sgrid_pcolor_numpy_logscale(self):
+        params = copy(self.url_params)
+        params.update(styles='pcolor_cubehelix', renderer='numpy', logscale=True, colorscalerange='1,30')
+        self.do_test(params)
+
+    def test_sgrid_pcolor_overview(self):
+        # Small images read a strided overview of the grid
+        params = copy(self.url_params)
+        params.update(styles='pcolor_cubehelix', width=16, height=16)
+        self.do_test(params)
+        params.update(renderer='numpy', colorscalerange='-1,1')
+        self.do_test(params)
+
     def test_sgrid_contours(self):
         params = copy(self.url_params)
         params.update(styles='contours_cubehelix')
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from concurrent.futures import wait
+
+import numpy as np
+
+from wms.utils import DotDict
+from wms import generations
+from wms import slices
+
+
+class TestSlices(unittest.TestCase):
+
+    def setUp(self):
+        slices._slices.clear()
+        slices._prefetcher._history.clear()
+        # Only the cache of this process
+        self.shared = slices._shared
+        slices._shared = None
+        self.dataset = DotDict(safe_filename='slices_testing', name='slices_testing')
+        self.variable = np.arange(20 * 100, dtype=np.float64).reshape(20, 100)
+        self.reads = []
+
+    def tearDown(self):
+        slices._shared = self.shared
+
+    def reader(self, variable, prefix):
+        self.reads.append(prefix)
+        return variable[prefix + (slice(10, 20),)]
+
+    def read(self, time_index):
+        return slices.read(self.dataset, 'var', self.variable, (time_index,), (10, 20, None), self.reader)
+
+    def wait_prefetch(self):
+        futures = [f for pending in list(slices._prefetcher._pending.values()) for f in pending.values()]
+        wait(futures)
+
+    def test_cached(self):
+        first = self.read(0)
+        second = self.read(0)
+        assert first is second
+        assert self.reads == [(0,)]
+
+    def test_prefetch_sequential_steps(self):
+        for t in [0, 2, 4]:
+            self.read(t)
+        self.wait_prefetch()
+        assert self.reads[:3] == [(0,), (2,), (4,)]
+        assert sorted(self.reads[3:]) == [(t,) for t in range(6, 6 + 2 * slices._prefetcher.steps, 2)]
+
+        # Served from the prefetched slices
+        reads = len(self.reads)
+        np.testing.assert_array_equal(self.read(6), self.variable[6, 10:20])
+        self.wait_prefetch()
+        assert (6,) not in self.reads[reads:]
+
+    def test_no_prefetch_on_green_threads(self):
+        with mock.patch('wms.slices.green_threads', return_value=True):
+            for t in [0, 2, 4]:
+                self.read(t)
+        self.wait_prefetch()
+        assert self.reads == [(0,), (2,), (4,)]
+
+    def test_no_prefetch_out_of_range(self):
+        for t in [17, 18, 19]:
+            self.read(t)
+        self.wait_prefetch()
+        assert self.reads == [(17,), (18,), (19,)]
+
+    def test_cancel_when_pattern_breaks(self):
+        # Block the prefetch threads until the pattern breaks
+        release = threading.Event()
+
+        def slow_reader(variable, prefix):
+            if 2 < prefix[0] < 10:
+                release.wait(5)
+            return self.reader(variable, prefix)
+
+        for t in [0, 1, 2]:
+            slices.read(self.dataset, 'var', self.variable, (t,), (10, 20, None), slow_reader)
+        slices.read(self.dataset, 'var', self.variable, (10,), (10, 20, None), slow_reader)
+        release.set()
+        self.wait_prefetch()
+        # At most the reads that had started when the pattern broke went through
+        assert len([p for p in self.reads if 2 < p[0] < 10]) <= slices._prefetcher.workers
+
+    def test_invalidate(self):
+        self.read(0)
+        self.read(0)
+        slices.invalidate(self.dataset)
+        self.read(0)
+        assert self.reads == [(0,), (0,)]
+
+    def test_new_generation(self):
+        self.read(0)
+        generations.advance(self.dataset)
+        self.read(0)
+        assert self.reads == [(0,), (0,)]
+        assert slices.stats()['misses'] >= 2
+
+
+class TestSharedSlices(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.shared = slices._shared
+        slices._shared = slices.SharedSlices(self.root, 10 * 8 * 100, 0)
+        slices._slices.clear()
+        self.dataset = DotDict(safe_filename='shared_slices_testing', name='shared_slices_testing')
+        self.variable = np.ma.masked_greater(np.arange(20 * 100, dtype=np.float64).reshape(20, 100), 1950)
+        self.reads = []
+
+    def tearDown(self):
+        slices._shared = self.shared
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def reader(self, variable, prefix):
+        self.reads.append(prefix[0].start)
+        return variable[prefix][0]
+
+    def read(self, time_index):
+        # Slices of time are not prefetched
+        return slices.read(self.dataset, 'var', self.variable, (slice(time_index, time_index + 1),), None, self.reader)
+
+    def test_shared_between_processes(self):
+        first = self.read(19)
+        # Another worker only has the shared slices
+        slices._slices.clear()
+        second = self.read(19)
+        assert self.reads == [19]
+        assert np.ma.is_masked(second)
+        assert isinstance(second, np.ma.MaskedArray)
+        np.testing.assert_array_equal(second.mask, first.mask)
+        np.testing.assert_array_equal(second.filled(-1), first.filled(-1))
+        assert slices._shared.stats()['hits'] == 1
+
+    def test_lru_eviction(self):
+        # Room for ten rows without a mask
+        for t in range(10):
+            self.read(t)
+        slices._slices.clear()
+        self.read(0)
+        self.read(10)
+        slices._slices.clear()
+        self.read(0)
+        self.read(1)
+        assert self.reads == list(range(11)) + [1]
+        stats = slices._shared.stats()
+        assert stats['size'] <= stats['maxsize']
+        assert stats['evictions'] > 0
+
+    def test_invalidate(self):
+        self.read(0)
+        generations.advance(self.dataset)
+        slices.invalidate(self.dataset)
+        assert slices._shared.stats()['items'] == 0
+        self.read(0)
+        assert self.reads == [0, 0]
+
+    def test_not_writable(self):
+        # A file where the shared slices should be, as a read-only mount
+        path = os.path.join(self.root, 'readonly')
+        open(path, 'w').close()
+        slices._shared = slices.SharedSlices(path, 10 * 8 * 100, 0)
+        assert slices._shared.failed
+        self.read(0)
+        slices._slices.clear()
+        self.read(0)
+        assert self.reads == [0, 0]
+        assert slices._shared.stats()['hits'] == 0
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+
+from wms import spatial_index
+
+
+class TestHilbert(unittest.TestCase):
+
+    def test_curve_is_continuous(self):
+        i, j = np.meshgrid(np.arange(16), np.arange(16))
+        keys = spatial_index.hilbert_keys(i.ravel() + 0.5, j.ravel() + 0.5, (0, 0, 16, 16), bits=4)
+        assert sorted(keys) == list(range(256))
+        # Consecutive cells along the curve are neighbours
+        cells = np.column_stack((i.ravel(), j.ravel()))[np.argsort(keys)]
+        assert (np.abs(np.diff(cells, axis=0)).sum(axis=1) == 1).all()
+
+    def test_nan_sorts_last(self):
+        keys = spatial_index.hilbert_keys([np.nan, 1., 5.], [0., 1., 5.], (0, 0, 10, 10))
+        assert keys.argmax() == 0
+
+
+class TestPackedTree(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(1)
+        self.nodes = rs.rand(3000, 2) * [40, 20] - [70, 10]
+        self.faces = rs.randint(0, 3000, size=(5000, 3))
+        # Keep the faces small
+        self.faces[:, 1] = np.clip(self.faces[:, 0] + rs.randint(-3, 3, 5000), 0, 2999)
+        self.faces[:, 2] = np.clip(self.faces[:, 0] + rs.randint(-3, 3, 5000), 0, 2999)
+        self.nodes[7] = np.nan
+        self.boxes = spatial_index.face_boxes(self.nodes, self.faces)
+        self.order, self.tree = spatial_index.build(self.boxes)
+
+    def brute_force(self, bbox):
+        minx, miny, maxx, maxy = bbox
+        b = self.boxes
+        with np.errstate(invalid='ignore'):
+            return np.where((b[:, 0] <= maxx) & (b[:, 2] >= minx) & (b[:, 1] <= maxy) & (b[:, 3] >= miny))[0]
+
+    def test_layout(self):
+        assert sorted(self.order) == list(range(5000))
+        assert self.order.dtype == np.int32
+        assert self.tree.shape == (sum(spatial_index.level_sizes(5000)), 4)
+
+    def test_query_matches_brute_force(self):
+        for bbox in [(-60, -5, -50, 5), (-70, -10, -30, 10), (-45.1, 0.2, -45., 0.3), (0, 0, 10, 10)]:
+            np.testing.assert_array_equal(spatial_index.query(self.order, self.tree, bbox), self.brute_force(bbox))
+
+    def test_scan(self):
+        for bbox in [(-60, -5, -50, 5), (0, 0, 10, 10)]:
+            np.testing.assert_array_equal(spatial_index.scan(self.boxes, bbox), spatial_index.query(self.order, self.tree, bbox))
+
+    def test_faces_with_nan_nodes_are_never_found(self):
+        found = spatial_index.query(self.order, self.tree, (-1000, -1000, 1000, 1000))
+        assert not np.isin(found, np.where((self.faces == 7).any(axis=1))[0]).any()
+
+    def test_small_trees(self):
+        bbox = (-70, -10, -30, 10)
+        expected = self.brute_force(bbox)
+        for n in [0, 1, 16, 17]:
+            order, tree = spatial_index.build(self.boxes[:n])
+            np.testing.assert_array_equal(spatial_index.query(order, tree, bbox), expected[expected < n])
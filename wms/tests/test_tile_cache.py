@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from copy import copy
+from datetime import datetime
+from unittest import mock
+
+from django.test import TestCase
+
+from wms.utils import DotDict
+from wms.tests import add_server, add_group, add_user, add_dataset
+from wms.models import Dataset
+from wms import generations
+from wms import tile_cache
+
+from wms import logger  # noqa
+
+
+class StandInDataset(object):
+    """ Resolves times from its time cache only """
+    safe_filename = 'tile_key_testing'
+    name = 'tile_key_testing'
+
+    def cached_nearest_time(self, layer, time):
+        return 0
+
+    def nearest_time(self, layer, time):
+        raise AssertionError('The dataset was opened')
+
+
+class VirtualLayer(DotDict):
+    pass
+
+
+class TestTileKey(unittest.TestCase):
+
+    def request(self):
+        return DotDict(GET=dict(
+            bbox=DotDict(minx=0., miny=0., maxx=1., maxy=1.),
+            width=256,
+            height=256,
+            image_type='pcolor',
+            colormap='cubehelix',
+            crs=DotDict(srs='EPSG:3857'),
+            time=datetime(2000, 1, 1),
+            elevation=0,
+            colorscalerange=DotDict(min=None, max=None),
+            logscale=False,
+            numcontours=20,
+            vectorscale=None,
+            vectorstep=None,
+            renderer='matplotlib',
+            shading='flat',
+            png_options={}
+        ))
+
+    def test_vector_layer(self):
+        dataset = StandInDataset()
+        plain = tile_cache.tile_key(dataset, DotDict(var_name='u'), self.request())
+        vector = tile_cache.tile_key(dataset, VirtualLayer(var_name='u,v'), self.request())
+        # A vector layer is not the layer of its first component
+        assert plain != vector
+        assert tile_cache.tile_key(dataset, VirtualLayer(var_name='u,v'), self.request()) == vector
+
+
+class TestTileCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        add_server()
+        add_group()
+        add_user()
+        add_dataset("tile_cache_testing", "ugrid", "selfe_ugrid.nc")
+
+    @classmethod
+    def tearDownClass(cls):
+        d = Dataset.objects.get(slug="tile_cache_testing")
+        d.delete()
+
+    def setUp(self):
+        self.dataset_slug = 'tile_cache_testing'
+        self.url_params = dict(
+            service     = 'WMS',
+            request     = 'GetMap',
+            version     = '1.1.1',
+            layers      = 'surface_salt',
+            format      = 'image/png',
+            transparent = 'true',
+            height      = 256,
+            width       = 256,
+            srs         = 'EPSG:3857',
+            styles      = 'pcolor_cubehelix',
+            bbox        = '-13756219.106426599,5811660.1345785195,-13736651.227185594,5831228.013819524'
+        )
+
+    def getmap(self, params):
+        response = self.client.get('/wms/datasets/{}'.format(self.dataset_slug), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_repeated_getmap_hits(self):
+        first = self.getmap(self.url_params)
+        before = tile_cache.stats()
+        second = self.getmap(self.url_params)
+        after = tile_cache.stats()
+        assert after['hits'] == before['hits'] + 1
+        assert first.content == second.content
+
+    def test_bbox_noise_hits(self):
+        self.getmap(self.url_params)
+        params = copy(self.url_params)
+        params['bbox'] = '-13756219.1064266,5811660.13457852,-13736651.2271856,5831228.01381952'
+        before = tile_cache.stats()
+        self.getmap(params)
+        assert tile_cache.stats()['hits'] == before['hits'] + 1
+
+    def test_hit_does_not_open_dataset(self):
+        self.getmap(self.url_params)
+        before = tile_cache.stats()
+        with mock.patch('wms.handles.dataset', side_effect=AssertionError('The dataset was opened')):
+            self.getmap(self.url_params)
+        assert tile_cache.stats()['hits'] == before['hits'] + 1
+
+    def test_invalidate_misses(self):
+        self.getmap(self.url_params)
+        generations.advance(Dataset.objects.get(slug=self.dataset_slug))
+        before = tile_cache.stats()
+        self.getmap(self.url_params)
+        assert tile_cache.stats()['misses'] == before['misses'] + 1
+
+    def test_missing_generation(self):
+        dataset = Dataset.objects.get(slug=self.dataset_slug)
+        if os.path.isfile(generations.marker(dataset)):
+            os.remove(generations.marker(dataset))
+        generations._current.clear()
+        # Reading does not start a generation
+        self.getmap(self.url_params)
+        assert generations.current(dataset) == generations.INITIAL_GENERATION
+        assert not os.path.exists(generations.marker(dataset))
+
+    def test_xyz_metatile_hits(self):
+        url = '/wms/datasets/{}/tiles/surface_salt/pcolor_cubehelix/11/{}/{}.png'
+        response = self.client.get(url.format(self.dataset_slug, 321, 726))
+        self.assertEqual(response.status_code, 200)
+        # Another tile of the same metatile
+        before = tile_cache.stats()
+        response = self.client.get(url.format(self.dataset_slug, 322, 727))
+        self.assertEqual(response.status_code, 200)
+        assert tile_cache.stats()['hits'] == before['hits'] + 1
+        # The WMS GetMap of the same tile
+        before = tile_cache.stats()
+        self.getmap(self.url_params)
+        assert tile_cache.stats()['hits'] == before['hits'] + 1
+
+    def test_metatile_locks_dropped(self):
+        with tile_cache._metatile_lock('metatile'):
+            assert tile_cache._metatile_locks['metatile'][0].locked()
+        assert 'metatile' not in tile_cache._metatile_locks
+
+    def test_xyz_out_of_range(self):
+        response = self.client.get('/wms/datasets/{}/tiles/surface_salt/default/2/4/0.png'.format(self.dataset_slug))
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from pyugrid import UGrid
+from django.test.utils import override_settings
+
+from wms.utils import DotDict
+from wms import topology
+
+
+class TestUgridArrays(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(TOPOLOGY_PATH=self.root)
+        self.settings.enable()
+        topology._ugrids.clear()
+
+        nodes = np.array([[0., 0.], [1., 0.], [1., 1.], [0., 1.], [2., 0.]])
+        faces = np.ma.masked_array([[0, 1, 2, 3], [1, 4, 2, 0]], mask=[[0, 0, 0, 0], [0, 0, 0, 1]])
+        self.ug = UGrid(nodes=nodes, faces=faces, mesh_name='mesh')
+        self.ug.build_face_coordinates()
+
+        safe = 'topology_testing'
+        self.dataset = DotDict(
+            name=safe,
+            safe_filename=safe,
+            topology_file=os.path.join(self.root, '{}.nc'.format(safe)),
+            topology_array_file=lambda name: os.path.join(self.root, '{}.{}.npy'.format(safe, name)),
+            ugrid_metadata_file=lambda mesh: os.path.join(self.root, '{}.{}.ugrid.json'.format(safe, mesh))
+        )
+        self.ug.save_as_netcdf(self.dataset.topology_file)
+
+    def tearDown(self):
+        topology._ugrids.clear()
+        self.settings.disable()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_memory_mapped(self):
+        # Read from the topology file until the grid cache update writes the arrays
+        ug = topology.ugrid(self.dataset, 'mesh')
+        assert not os.path.isfile(self.dataset.ugrid_metadata_file('mesh'))
+        assert not isinstance(ug.nodes, np.memmap)
+        np.testing.assert_array_equal(ug.nodes, self.ug.nodes)
+        np.testing.assert_array_equal(ug.faces.mask, self.ug.faces.mask)
+        assert topology.ugrid(self.dataset, 'mesh') is ug
+
+        topology.save_ugrid(self.dataset, self.ug)
+        ug = topology.ugrid(self.dataset, 'mesh')
+        assert isinstance(ug.nodes, np.memmap)
+        np.testing.assert_array_equal(ug.nodes, self.ug.nodes)
+        np.testing.assert_array_equal(ug.face_coordinates, self.ug.face_coordinates)
+        assert ug.edge_coordinates is None
+
+        # Faces are int32, their missing nodes -1 under the mask
+        assert ug.faces.dtype == np.int32
+        assert isinstance(np.ma.getdata(ug.faces), np.memmap)
+        np.testing.assert_array_equal(ug.faces.mask, self.ug.faces.mask)
+        assert ug.faces.data[1, 3] == -1
+        assert not ug.faces.flags.writeable
+
+        assert topology.ugrid(self.dataset, 'mesh') is ug
+
+    def test_face_index(self):
+        bbox = (0.5, 0.5, 1.5, 0.9)
+        # Faces are scanned until the grid cache update writes the index
+        assert topology.face_index(self.dataset, 'mesh') is None
+        scanned = topology.query_faces(self.dataset, 'mesh', bbox)
+        assert not os.path.isfile(self.dataset.topology_array_file('mesh.face_tree'))
+        topology.save_face_index(self.dataset, 'mesh')
+        assert topology.face_index(self.dataset, 'mesh') is not None
+        np.testing.assert_array_equal(topology.query_faces(self.dataset, 'mesh', bbox), scanned)
+        np.testing.assert_array_equal(scanned, [0, 1])
+
+    @override_settings(UGRID_LOD_PIXELS=4)
+    def test_lod_levels(self):
+        self.dataset.lod_metadata_file = lambda mesh: os.path.join(self.root, 'topology_testing.{}.lod.json'.format(mesh))
+        # Tiles use the full mesh until the grid cache update writes the levels
+        assert topology.lod_levels(self.dataset, 'mesh') == []
+        assert topology.lod_faces(self.dataset, 'mesh', (0, 0, 2, 1), 1.) is None
+        assert not os.path.isfile(self.dataset.lod_metadata_file('mesh'))
+
+    def test_reloaded_on_update(self):
+        topology.save_ugrid(self.dataset, self.ug)
+        ug = topology.ugrid(self.dataset, 'mesh')
+        self.ug.nodes = self.ug.nodes + 10
+        self.ug.save_as_netcdf(self.dataset.topology_file)
+        topology.save_ugrid(self.dataset, self.ug)
+        os.utime(self.dataset.ugrid_metadata_file('mesh'), ns=(0, os.stat(self.dataset.topology_file).st_mtime_ns + 1))
+        updated = topology.ugrid(self.dataset, 'mesh')
+        assert updated is not ug
+        np.testing.assert_array_equal(updated.nodes, self.ug.nodes)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+import io
+import struct
 from copy import copy
 
+from django.conf import settings
 from django.test import TestCase
 
+import numpy as np
 import pandas as pd
+from PIL import Image
 
 from wms.tests import add_server, add_group, add_user, add_dataset, image_path
 from wms.models import Dataset, UGridDataset
@@ -110,6 +115,16 @@ class TestUgrid(TestCase):
         params.update(styles='pcolor_cubehelix', logscale=True)
         self.do_test(params)
 
+    def test_ugrid_pcolor_numpy(self):
+        params = copy(self.url_params)
+        params.update(styles='pcolor_cubehelix', renderer='numpy')
+        self.do_test(params)
+
+    def test_ugrid_pcolor_numpy_gouraud(self):
+        params = copy(self.url_params)
+        params.update(styles='pcolor_cubehelix', renderer='numpy', shading='gouraud')
+        self.do_test(params)
+
     @xfail(reason="facets is not yet implemeted for UGRID datasets")
     def test_ugrid_facets(self):
         params = copy(self.url_params)
@@ -126,6 +141,30 @@ class TestUgrid(TestCase):
         params.update(styles='contours_cubehelix', numcontours=50)
         self.do_test(params)
 
+    def test_ugrid_getmap_animation(self):
+        d = Dataset.objects.get(name=self.dataset_slug)
+        layer = d.layer_set.get(var_name='surface_salt')
+        times = d.times(layer)
+        step = int(np.ceil(len(times) / settings.ANIMATION_MAX_FRAMES))
+        expected = len(times[::step])
+
+        params = copy(self.url_params)
+        params.update(styles='pcolor_cubehelix', time='1900-01-01T00:00:00Z/2100-01-01T00:00:00Z')
+        params['format'] = 'image/apng'
+        response = self.client.get('/wms/datasets/{}'.format(self.dataset_slug), params)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        # acTL: number of frames, then number of plays
+        actl = content.index(b'acTL')
+        assert struct.unpack('>I', content[actl + 4:actl + 8])[0] == expected
+        assert content.count(b'fcTL') == expected
+
+        params['format'] = 'image/gif'
+        response = self.client.get('/wms/datasets/{}'.format(self.dataset_slug), params)
+        self.assertEqual(response.status_code, 200)
+        gif = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+        assert gif.n_frames == expected
+
     def test_ugrid_gfi_single_variable_csv(self):
         params = copy(self.gfi_params)
         r = self.do_test(params, fmt='csv')
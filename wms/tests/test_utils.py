@@ -7,7 +7,8 @@ import unittest
 import numpy as np
 
 from ..utils import (adjacent_array_value_differences, calc_safety_factor,
-                     calc_lon_lat_padding)
+                     calc_lon_lat_padding, compose_slices, index_ranges,
+                     LRUCache)
 
 
 class TestAdjacentArrayValueDifferences(unittest.TestCase):
@@ -27,6 +28,38 @@ class TestAdjacentArrayValueDifferences(unittest.TestCase):
         np.testing.assert_almost_equal(result, expected_array, decimal=2)
 
 
+class TestComposeSlices(unittest.TestCase):
+
+    def test_compose_slices(self):
+        data = np.arange(20)
+        for outer, inner in [(slice(1, -1), slice(2, 5)),
+                             (slice(None), slice(0, 3)),
+                             (slice(1, None), slice(10, 40)),
+                             (slice(2, -2, 2), slice(1, 3))]:
+            composed = compose_slices(outer, data.size, inner)
+            np.testing.assert_array_equal(data[composed], data[outer][inner])
+
+
+class TestIndexRanges(unittest.TestCase):
+
+    def test_contiguous(self):
+        self.assertEqual(index_ranges([3, 4, 5, 9, 10, 20], 10),
+                         [slice(3, 6), slice(9, 11), slice(20, 21)])
+
+    def test_smallest_gaps_are_bridged(self):
+        self.assertEqual(index_ranges([3, 4, 5, 9, 10, 20], 2),
+                         [slice(3, 11), slice(20, 21)])
+        self.assertEqual(index_ranges([3, 4, 5, 9, 10, 20], 1), [slice(3, 21)])
+
+    def test_covers_indexes(self):
+        indexes = np.unique(np.random.RandomState(0).randint(0, 1000, 200))
+        ranges = index_ranges(indexes, 8)
+        self.assertLessEqual(len(ranges), 8)
+        covered = np.concatenate([np.arange(s.start, s.stop) for s in ranges])
+        self.assertTrue(np.isin(indexes, covered).all())
+        self.assertEqual(index_ranges([], 8), [])
+
+
 class TestCalcSafetyFactor(unittest.TestCase):
 
     def setUp(self):
@@ -69,3 +102,34 @@ class TestCalcLonLatPadding(unittest.TestCase):
         result = calc_lon_lat_padding(self.lon_array, self.lat_array_large)
         expected = 11
         self.assertAlmostEqual(result, expected, 3)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction_order(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_size_bound(self):
+        cache = LRUCache(maxsize=10, sizeof=len)
+        cache.set('a', b'12345')
+        cache.set('b', b'123456')
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 6)
+        cache.set('c', b'12345678901')
+        self.assertNotIn('c', cache)
+
+    def test_stats(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
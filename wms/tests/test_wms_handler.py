@@ -10,7 +10,7 @@ import pyproj
 from django.test import TestCase
 from django.test.client import RequestFactory
 
-from ..wms_handler import get_time, get_projection
+from ..wms_handler import get_time, get_projection, get_animation
 
 
 class TestGetTime(TestCase):
@@ -42,6 +42,22 @@ class TestGetTime(TestCase):
         self.assertEqual(result_time, expected_dt)
         self.assertIsNone(result_time_tz)
 
+    def test_get_time_range(self):
+        request = self.factory.get('/dataset?time=2015-01-01T17%3A00%3A00Z/2015-01-02T17%3A00%3A00Z')
+        self.assertEqual(get_time(request), datetime.datetime(2015, 1, 1, 17, 0, 0))
+
+
+class TestGetAnimation(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_get_animation(self):
+        self.assertEqual(get_animation(self.factory.get('/dataset?format=image/apng')), 'apng')
+        self.assertEqual(get_animation(self.factory.get('/dataset?format=image/GIF')), 'gif')
+        self.assertIsNone(get_animation(self.factory.get('/dataset?format=image/png')))
+        self.assertIsNone(get_animation(self.factory.get('/dataset')))
+
 
 class TestGetProjection(TestCase):
 
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Rendered GetMap tile cache.
+
+PNG bytes are kept in an in-process LRU and in a disk store under
+TOPOLOGY_PATH/tiles/<dataset>/<generation>/, keyed by the cache generation
+of the dataset (see wms.generations), so updating its time or grid cache
+invalidates the tiles of all workers at once.
+
+Tiles of the XYZ endpoint are rendered as metatiles of METATILE_SIZE x
+METATILE_SIZE tiles sharing one data read and one render, which are then
+sliced and all stored.
+"""
+import os
+import re
+import copy
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from wms.utils import DotDict, LRUCache
+from wms.data_handler import blank_response, image_response
+from wms import projections
+from wms import generations
+
+from wms import logger
+
+
+TILE_SIZE = 256
+
+_memory = LRUCache(maxsize=settings.TILE_CACHE_MEMORY_BYTES, sizeof=len)
+_disk_hits = 0
+
+# One lock per metatile being rendered, so concurrent requests for its tiles
+# render it once: metatile key -> [lock, number of requests holding or waiting for it]
+_metatile_locks = {}
+_metatile_locks_lock = threading.Lock()
+
+
+def tile_root(dataset):
+    return os.path.join(settings.TOPOLOGY_PATH, 'tiles', dataset.safe_filename)
+
+
+def invalidate(dataset):
+    """ Remove the tiles on disk of the generations of a dataset other than the current one """
+    gen = generations.current(dataset)
+    root = tile_root(dataset)
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name != gen and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+    logger.info("Invalidated tile cache for {}".format(dataset.name))
+
+
+def remove(dataset):
+    """ Remove every cached tile of a dataset """
+    shutil.rmtree(tile_root(dataset), ignore_errors=True)
+
+
+def _snap(value, resolution):
+    return int(round(value / resolution))
+
+
+def _time_key(dataset, layer, time):
+    """ The time index of a request, from the time cache of the dataset when it has one """
+    try:
+        time_index = dataset.cached_nearest_time(layer, time)
+    except NotImplementedError:
+        time_index = None
+    if time_index is not None:
+        return time_index
+
+    time_index, time_value = dataset.nearest_time(layer, time)
+    if time_index is None and time_value is not None:
+        return time_value.isoformat()
+    return time_index
+
+
+def tile_key(dataset, layer, request):
+    """
+    Build a cache key from the normalized GetMap parameters of an enhanced
+    request.  The bbox is snapped to the pixel grid of the request so floating
+    point noise from web map clients does not produce different keys.  Cache
+    hits do not open the dataset.
+    """
+    bbox = request.GET['bbox']
+    width = int(request.GET['width'])
+    height = int(request.GET['height'])
+    xres = (bbox.maxx - bbox.minx) / width or 1
+    yres = (bbox.maxy - bbox.miny) / height or 1
+
+    # The variable whose times a layer has, the first component of vector layers,
+    # without the query of VirtualLayer.access_name
+    time_layer = DotDict(access_name=re.findall(r"[^*,]+", layer.var_name)[0])
+
+    colorscalerange = request.GET['colorscalerange']
+    parts = (
+        type(layer).__name__,
+        layer.var_name,
+        request.GET['image_type'],
+        request.GET['colormap'],
+        (_snap(bbox.minx, xres), _snap(bbox.miny, yres), _snap(bbox.maxx, xres), _snap(bbox.maxy, yres)),
+        (width, height),
+        request.GET['crs'].srs,
+        _time_key(dataset, time_layer, request.GET['time']),
+        # As requested, as resolving its depth index would open the dataset
+        request.GET['elevation'],
+        (colorscalerange.min, colorscalerange.max),
+        request.GET['logscale'],
+        request.GET['numcontours'],
+        request.GET['vectorscale'],
+        request.GET['vectorstep'],
+        request.GET['renderer'],
+        request.GET['shading'],
+        repr(request.GET['png_options']),
+    )
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _tile_path(dataset, gen, key):
+    return os.path.join(tile_root(dataset), gen, key[:2], '{}.png'.format(key))
+
+
+def lookup(dataset, key):
+    """ Return the cached PNG bytes for a key, or None """
+    global _disk_hits
+
+    gen = generations.current(dataset)
+    memkey = (dataset.safe_filename, gen, key)
+    content = _memory.get(memkey)
+    if content is not None:
+        return content
+
+    if settings.TILE_CACHE_DISK is True:
+        try:
+            with open(_tile_path(dataset, gen, key), 'rb') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None
+        _disk_hits += 1
+        _memory.set(memkey, content)
+        return content
+
+
+def store(dataset, key, content):
+    gen = generations.current(dataset)
+    _memory.set((dataset.safe_filename, gen, key), content)
+
+    if settings.TILE_CACHE_DISK is True:
+        path = _tile_path(dataset, gen, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Atomic write
+            tmphandle, tmpsave = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                os.write(tmphandle, content)
+            finally:
+                os.close(tmphandle)
+            os.replace(tmpsave, path)
+        except (IOError, OSError):
+            # The generation was invalidated while we were rendering
+            logger.debug("Could not write tile {} to disk".format(key))
+
+
+def getmap(dataset, layer, request):
+    """
+    Return the GetMap response for an enhanced request from the tile cache,
+    rendering and storing it on a miss.
+    """
+    if settings.TILE_CACHE_ENABLED is not True:
+        return dataset.getmap(layer, request)
+
+    key = tile_key(dataset, layer, request)
+    content = lookup(dataset, key)
+    if content is not None:
+        return HttpResponse(content, content_type='image/png')
+
+    response = dataset.getmap(layer, request)
+    if response.status_code == 200 and response['Content-Type'] == 'image/png':
+        store(dataset, key, response.content)
+    return response
+
+
+def seed(dataset, layer, request):
+    """
+    Render and store the tile of an enhanced GetMap request unless it is
+    already cached.  Returns True if a tile was rendered.
+    """
+    key = tile_key(dataset, layer, request)
+    if lookup(dataset, key) is not None:
+        return False
+
+    response = dataset.getmap(layer, request)
+    if response.status_code == 200 and response['Content-Type'] == 'image/png':
+        store(dataset, key, response.content)
+    return True
+
+
+def metatile(z, x, y, size):
+    """
+    Return the (x, y, columns, rows) of the metatile of at most `size` x
+    `size` tiles holding XYZ tile (z, x, y)
+    """
+    n = 2 ** z
+    mx = x - x % size
+    my = y - y % size
+    return mx, my, min(size, n - mx), min(size, n - my)
+
+
+def metatile_bounds(z, meta):
+    """ EPSG:3857 bbox of a metatile """
+    mx, my, columns, rows = meta
+    minx, miny, _, _ = projections.tile_bounds(z, mx, my + rows - 1)
+    _, _, maxx, maxy = projections.tile_bounds(z, mx + columns - 1, my)
+    return minx, miny, maxx, maxy
+
+
+def _tile_request(request, z, x, y):
+    """ The enhanced GetMap request of a single tile of a metatile request """
+    tile_request = copy.copy(request)
+    tile_request.GET = request.GET.copy()
+    minx, miny, maxx, maxy = projections.tile_bounds(z, x, y)
+    bbox = copy.copy(request.GET['bbox'])
+    bbox.minx, bbox.miny, bbox.maxx, bbox.maxy = minx, miny, maxx, maxy
+    tile_request.GET.update(dict(bbox=bbox, width=TILE_SIZE, height=TILE_SIZE, keep_rgba=False))
+    return tile_request
+
+
+@contextmanager
+def _metatile_lock(key):
+    """ Hold the lock of a metatile, dropped once no request holds or waits for it """
+    with _metatile_locks_lock:
+        entry = _metatile_locks.get(key)
+        if entry is None:
+            entry = _metatile_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _metatile_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _metatile_locks[key]
+
+
+def getmap_tile(dataset, layer, request, z, x, y, meta):
+    """
+    Return XYZ tile (z, x, y) for an enhanced GetMap request covering the
+    metatile `meta` (see metatile).  On a miss the whole metatile is rendered
+    and every tile of it is stored.
+    """
+    tile_request = _tile_request(request, z, x, y)
+    if settings.TILE_CACHE_ENABLED is not True:
+        return dataset.getmap(layer, tile_request)
+
+    key = tile_key(dataset, layer, tile_request)
+    content = lookup(dataset, key)
+    if content is not None:
+        return HttpResponse(content, content_type='image/png')
+
+    mx, my, columns, rows = meta
+    with _metatile_lock((dataset.safe_filename, tile_key(dataset, layer, request))):
+        # Rendered by another thread while we waited
+        content = lookup(dataset, key)
+        if content is not None:
+            return HttpResponse(content, content_type='image/png')
+
+        request.GET['keep_rgba'] = True
+        response = dataset.getmap(layer, request)
+        if response.status_code != 200:
+            # An error
+            return response
+        if not hasattr(response, 'rgba'):
+            # Not a rendered image that can be sliced, render the tile alone
+            return getmap(dataset, layer, tile_request)
+
+        for ty in range(my, my + rows):
+            for tx in range(mx, mx + columns):
+                other_request = _tile_request(request, z, tx, ty)
+                if response.rgba is None:
+                    tile = blank_response(other_request)
+                else:
+                    row = (ty - my) * TILE_SIZE
+                    column = (tx - mx) * TILE_SIZE
+                    tile = image_response(response.rgba[row:row + TILE_SIZE, column:column + TILE_SIZE], other_request)
+                store(dataset, tile_key(dataset, layer, other_request), tile.content)
+                if (tx, ty) == (x, y):
+                    content = tile.content
+
+    return HttpResponse(content, content_type='image/png')
+
+
+def stats():
+    s = _memory.stats()
+    s['memory_hits'] = s['hits']
+    s['disk_hits'] = _disk_hits
+    s['hits'] = s['memory_hits'] + _disk_hits
+    s['misses'] = s['misses'] - _disk_hits
+    return s
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+Per-worker caches of the parsed topology files in TOPOLOGY_PATH.
+
+Entries are validated against the modification time of the file they were
+read from, so a grid cache update is picked up by every worker on its next
+request.
+"""
+import os
+import json
+import tempfile
+
+import numpy as np
+from pyugrid import UGrid
+from pysgrid import load_grid
+
+from django.conf import settings
+
+from wms.utils import DotDict, LRUCache, nbytes
+from wms import spatial_index
+from wms import lod
+
+from wms import logger
+
+
+# Smallest side of the coarsest SGRID overview
+OVERVIEW_MIN_CELLS = 32
+
+_ugrids = LRUCache(maxsize=settings.TOPOLOGY_CACHE_BYTES, sizeof=nbytes)
+_sgrids = LRUCache(maxsize=settings.TOPOLOGY_CACHE_BYTES, sizeof=nbytes)
+_face_indexes = LRUCache(maxsize=settings.TOPOLOGY_CACHE_BYTES, sizeof=nbytes)
+_lods = LRUCache(maxsize=settings.TOPOLOGY_CACHE_BYTES, sizeof=nbytes)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _readonly(arr):
+    if arr is not None:
+        arr = np.asanyarray(arr)
+        arr.flags.writeable = False
+    return arr
+
+
+def _filled(arr):
+    """ Masked entries of an array as NaN, or its fill value unless floating point """
+    if np.ma.isMaskedArray(arr):
+        arr = arr.filled(np.nan) if arr.dtype.kind == 'f' else arr.filled()
+    return arr
+
+
+def save_array(path, arr):
+    """ Atomically write an array to a .npy file """
+    arr = _filled(arr)
+    tmphandle, tmpsave = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy')
+    try:
+        with os.fdopen(tmphandle, 'wb') as f:
+            np.save(f, np.asanyarray(arr))
+        os.replace(tmpsave, path)
+    finally:
+        if os.path.isfile(tmpsave):
+            os.remove(tmpsave)
+
+
+def load_array(path):
+    """ Open a .npy file as a read-only memory map, shared with every other process """
+    return np.load(path, mmap_mode='r')
+
+
+def save_json(path, obj):
+    """ Atomically write a json metadata file """
+    tmphandle, tmpsave = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.json')
+    try:
+        with os.fdopen(tmphandle, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmpsave, path)
+    finally:
+        if os.path.isfile(tmpsave):
+            os.remove(tmpsave)
+
+
+def _encode_slicing(slicing):
+    encoded = []
+    for s in slicing:
+        if isinstance(s, slice):
+            encoded.append([s.start, s.stop, s.step])
+        elif s is Ellipsis:
+            encoded.append('...')
+        else:
+            encoded.append(int(s))
+    return encoded
+
+
+def _decode_slicing(encoded):
+    slicing = []
+    for s in encoded:
+        if isinstance(s, list):
+            slicing.append(slice(*s))
+        elif s == '...':
+            slicing.append(Ellipsis)
+        else:
+            slicing.append(s)
+    return tuple(slicing)
+
+
+def _sgrid_arrays(sg):
+    """
+    Return the arrays (name -> array) and the metadata of an SGRID as written
+    by save_sgrid
+    """
+    lon_name, lat_name = sg.face_coordinates
+    lon = sg.center_lon[getattr(sg, lon_name).center_slicing]
+    lat = sg.center_lat[getattr(sg, lat_name).center_slicing]
+    arrays = dict(center_lon=lon, center_lat=lat)
+
+    # Strided overviews of the centers, every other center of the previous one
+    overviews = []
+    stride = 2
+    while min(lon.shape) // stride >= OVERVIEW_MIN_CELLS:
+        arrays['center_lon.o{}'.format(stride)] = lon[::stride, ::stride]
+        arrays['center_lat.o{}'.format(stride)] = lat[::stride, ::stride]
+        overviews.append(stride)
+        stride *= 2
+    if sg.angles is not None:
+        arrays['angles'] = sg.angles[getattr(sg, lon_name).center_slicing]
+
+    variables = {}
+    for name, var in vars(sg).items():
+        if hasattr(var, 'center_slicing'):
+            center_axis = getattr(var, 'center_axis', None)
+            variables[name] = dict(
+                center_slicing=_encode_slicing(var.center_slicing),
+                center_axis=int(center_axis) if center_axis is not None else None,
+                vector_axis=getattr(var, 'vector_axis', None),
+                location=getattr(var, 'location', None)
+            )
+
+    meta = dict(
+        face_coordinates=[lon_name, lat_name],
+        grid_variables=list(sg.grid_variables or []),
+        variables=variables,
+        bounds=[float(np.nanmin(lon)), float(np.nanmin(lat)), float(np.nanmax(lon)), float(np.nanmax(lat))],
+        has_angles=sg.angles is not None,
+        overviews=overviews
+    )
+    return arrays, meta
+
+
+def save_sgrid(dataset, sg):
+    """
+    Write the trimmed cell center coordinates and angles of an SGRID to .npy
+    files next to the topology cache, along with the slicing metadata of each
+    variable.  The metadata file is written last and marks the set as complete.
+    """
+    arrays, meta = _sgrid_arrays(sg)
+    for name, arr in arrays.items():
+        save_array(dataset.topology_array_file(name), arr)
+    save_json(dataset.sgrid_metadata_file, meta)
+
+
+def _sgrid_grid(meta, mtime, array):
+    """ The DotDict returned by sgrid() from its metadata and a function returning its arrays by name """
+    variables = {}
+    for name, var in meta['variables'].items():
+        variables[name] = DotDict(
+            center_slicing=_decode_slicing(var['center_slicing']),
+            center_axis=var['center_axis'],
+            vector_axis=var['vector_axis'],
+            location=var['location']
+        )
+
+    overviews = {}
+    for stride in meta.get('overviews', []):
+        overviews[stride] = DotDict(
+            lon=array('center_lon.o{}'.format(stride)),
+            lat=array('center_lat.o{}'.format(stride))
+        )
+
+    minx, miny, maxx, maxy = meta['bounds']
+    return DotDict(
+        mtime=mtime,
+        lon=array('center_lon'),
+        lat=array('center_lat'),
+        angles=array('angles') if meta['has_angles'] else None,
+        face_coordinates=tuple(meta['face_coordinates']),
+        grid_variables=meta['grid_variables'],
+        variables=variables,
+        overviews=overviews,
+        bounds=DotDict(minx=minx, miny=miny, maxx=maxx, maxy=maxy, bbox=(minx, miny, maxx, maxy))
+    )
+
+
+def sgrid(dataset):
+    """
+    Return the cell centers (lon, lat), angles and variable slicing metadata
+    of an SGRID dataset.  The coordinate arrays are read-only memory maps,
+    or in memory arrays read from the topology file until the grid cache
+    update writes them.
+    """
+    mtime = _mtime(dataset.sgrid_metadata_file)
+    topology_mtime = _mtime(dataset.topology_file) or 0
+    if mtime is None or mtime < topology_mtime:
+        # Topology cache was created before the coordinates were written out,
+        # or is being updated.  Only update_grid_cache writes them.
+        key = (dataset.safe_filename, 'topology_file')
+        grid = _sgrids.get(key)
+        if grid is None or grid.mtime != topology_mtime:
+            logger.info("Reading SGRID coordinates of {} from its topology file".format(dataset.name))
+            arrays, meta = _sgrid_arrays(load_grid(dataset.topology_file))
+            # Round trip the metadata like save_sgrid does
+            meta = json.loads(json.dumps(meta))
+            grid = _sgrid_grid(meta, topology_mtime, lambda name: _readonly(arrays[name]))
+            _sgrids.set(key, grid)
+        return grid
+
+    grid = _sgrids.get(dataset.safe_filename)
+    if grid is not None and grid.mtime == mtime:
+        return grid
+
+    with open(dataset.sgrid_metadata_file) as f:
+        meta = json.load(f)
+    grid = _sgrid_grid(meta, mtime, lambda name: load_array(dataset.topology_array_file(name)))
+    _sgrids.set(dataset.safe_filename, grid)
+    return grid
+
+
+def sgrid_overview(grid, stride):
+    """
+    Return the (lon, lat) cell centers of an SGRID taking every `stride`th
+    row and column, `stride` being 1 or one of grid.overviews
+    """
+    if stride == 1:
+        return grid.lon, grid.lat
+    overview = grid.overviews[stride]
+    return overview.lon, overview.lat
+
+
+# Topology arrays of a UGRID mesh, written as .npy files by save_ugrid
+UGRID_ARRAYS = ('nodes', 'faces', 'face_coordinates', 'edge_coordinates', 'boundaries')
+
+
+def _index_array(arr):
+    """ Connectivity array as int32 when its indexes fit, missing (masked) entries as -1 """
+    arr = np.ma.filled(arr, -1)
+    if arr.size and np.iinfo(np.int32).min <= arr.min() and arr.max() <= np.iinfo(np.int32).max:
+        return arr.astype(np.int32)
+    return arr.astype(np.int64)
+
+
+def _ugrid_arrays(ug):
+    """
+    Return the arrays (name -> array) and the metadata of a UGRID mesh as
+    written by save_ugrid
+    """
+    arrays = {}
+    meta = {}
+    for name in UGRID_ARRAYS:
+        arr = getattr(ug, name)
+        if arr is None:
+            continue
+        masked = bool(np.ma.is_masked(arr))
+        if name in ('faces', 'boundaries'):
+            arr = _index_array(arr)
+        arrays[name] = _filled(arr)
+        meta[name] = dict(masked=masked)
+    return arrays, meta
+
+
+def save_ugrid(dataset, ug):
+    """
+    Write the topology arrays of a UGRID mesh to .npy files next to the
+    topology cache so workers can memory map them rather than parse the
+    topology file.  The metadata file is written last and marks the set as
+    complete.
+    """
+    arrays, meta = _ugrid_arrays(ug)
+    for name, arr in arrays.items():
+        save_array(dataset.topology_array_file('{}.{}'.format(ug.mesh_name, name)), arr)
+    save_json(dataset.ugrid_metadata_file(ug.mesh_name), dict(mesh_name=ug.mesh_name, arrays=meta))
+
+
+def _ugrid_topology(mesh_name, meta, mtime, array):
+    """ The DotDict returned by ugrid() from its metadata and a function returning its arrays by name """
+    topology = DotDict(mesh_name=mesh_name, mtime=mtime)
+    for name in UGRID_ARRAYS:
+        if name not in meta:
+            setattr(topology, name, None)
+            continue
+        arr = array(name)
+        if meta[name]['masked']:
+            # Only the mask is held in memory, the data stays mapped
+            arr = np.ma.masked_less(arr, 0) if arr.dtype.kind == 'i' else np.ma.masked_invalid(arr)
+        setattr(topology, name, _readonly(arr))
+    return topology
+
+
+def ugrid(dataset, mesh_name):
+    """
+    Return the cached UGRID topology of a dataset's mesh as a DotDict of
+    read-only memory maps (nodes, faces, face_coordinates, edge_coordinates,
+    boundaries), or of in memory arrays read from the topology file until
+    the grid cache update writes them.  Masked faces and boundaries are -1
+    under their mask.
+    """
+    path = dataset.ugrid_metadata_file(mesh_name)
+    mtime = _mtime(path)
+    topology_mtime = _mtime(dataset.topology_file) or 0
+    if mtime is None or mtime < topology_mtime:
+        # Topology cache was created before the arrays were written out,
+        # or is being updated.  Only update_grid_cache writes them.
+        key = (dataset.safe_filename, mesh_name, 'topology_file')
+        topology = _ugrids.get(key)
+        if topology is None or topology.mtime != topology_mtime:
+            logger.info("Reading UGRID topology of {} ({}) from its topology file".format(dataset.name, mesh_name))
+            arrays, meta = _ugrid_arrays(UGrid.from_ncfile(dataset.topology_file, mesh_name=mesh_name))
+            topology = _ugrid_topology(mesh_name, meta, topology_mtime, lambda name: arrays[name])
+            _ugrids.set(key, topology)
+        return topology
+
+    key = (dataset.safe_filename, mesh_name)
+    topology = _ugrids.get(key)
+    if topology is not None and topology.mtime == mtime:
+        return topology
+
+    logger.debug("Loading UGRID topology for {} ({})".format(dataset.name, mesh_name))
+    with open(path) as f:
+        meta = json.load(f)
+    topology = _ugrid_topology(
+        mesh_name, meta['arrays'], mtime,
+        lambda name: load_array(dataset.topology_array_file('{}.{}'.format(mesh_name, name)))
+    )
+    _ugrids.set(key, topology)
+    return topology
+
+
+def _save_tree(dataset, name, nodes, faces):
+    order, tree = spatial_index.build(spatial_index.face_boxes(nodes, faces))
+    save_array(dataset.topology_array_file('{}.face_order'.format(name)), order)
+    save_array(dataset.topology_array_file('{}.face_tree'.format(name)), tree)
+
+
+def save_face_index(dataset, mesh_name):
+    """
+    Write the packed R-tree of the face bounding boxes of a UGRID mesh (see
+    wms.spatial_index) next to the topology cache.  The tree file is written
+    last and marks the index as complete.
+    """
+    ug = ugrid(dataset, mesh_name)
+    _save_tree(dataset, mesh_name, ug.nodes, ug.faces)
+
+
+def face_index(dataset, mesh_name):
+    """
+    Return the packed face R-tree of a UGRID mesh as a DotDict of read-only
+    memory maps (order, tree), or None until update_grid_cache writes it.
+    """
+    tree_file = dataset.topology_array_file('{}.face_tree'.format(mesh_name))
+    mtime = _mtime(tree_file)
+    if mtime is None or mtime < (_mtime(dataset.topology_file) or 0):
+        return None
+
+    key = (dataset.safe_filename, mesh_name)
+    index = _face_indexes.get(key)
+    if index is not None and index.mtime == mtime:
+        return index
+
+    index = DotDict(
+        mtime=mtime,
+        order=load_array(dataset.topology_array_file('{}.face_order'.format(mesh_name))),
+        tree=load_array(tree_file)
+    )
+    _face_indexes.set(key, index)
+    return index
+
+
+def query_faces(dataset, mesh_name, bbox):
+    """ Return the sorted indexes of the faces of a mesh intersecting a WGS84 bbox """
+    index = face_index(dataset, mesh_name)
+    if index is None:
+        # Not written yet, test every face
+        ug = ugrid(dataset, mesh_name)
+        return spatial_index.scan(spatial_index.face_boxes(ug.nodes, ug.faces), bbox)
+    return spatial_index.query(index.order, index.tree, bbox)
+
+
+def save_lod(dataset, mesh_name):
+    """
+    Write the level of detail pyramid of a UGRID mesh (see wms.lod): the
+    triangles of every level, indexing the nodes of the full mesh, and their
+    face index.  The metadata file is written last and marks the set as
+    complete.
+    """
+    ug = ugrid(dataset, mesh_name)
+    levels = []
+    for i, (cell_size, faces) in enumerate(lod.build_levels(ug.nodes, ug.faces, settings.UGRID_LOD_MIN_FACES)):
+        name = '{}.lod{}'.format(mesh_name, i)
+        save_array(dataset.topology_array_file('{}.faces'.format(name)), faces.astype(ug.faces.dtype))
+        _save_tree(dataset, name, ug.nodes, faces)
+        levels.append(dict(name=name, cell_size=cell_size, faces=int(faces.shape[0])))
+    save_json(dataset.lod_metadata_file(mesh_name), dict(levels=levels))
+
+
+def lod_levels(dataset, mesh_name):
+    """
+    Return the levels of detail of a UGRID mesh, coarser levels last, as
+    DotDicts of read-only memory maps (faces, order, tree) with their
+    cell_size in degrees.  There are none until update_grid_cache writes
+    them.
+    """
+    path = dataset.lod_metadata_file(mesh_name)
+    mtime = _mtime(path)
+    if mtime is None or mtime < (_mtime(dataset.topology_file) or 0):
+        return []
+
+    key = (dataset.safe_filename, mesh_name)
+    levels = _lods.get(key)
+    if levels is not None and levels[0] == mtime:
+        return levels[1]
+
+    with open(path) as f:
+        meta = json.load(f)
+    levels = [
+        DotDict(
+            cell_size=level['cell_size'],
+            faces=load_array(dataset.topology_array_file('{}.faces'.format(level['name']))),
+            order=load_array(dataset.topology_array_file('{}.face_order'.format(level['name']))),
+            tree=load_array(dataset.topology_array_file('{}.face_tree'.format(level['name'])))
+        )
+        for level in meta['levels']
+    ]
+    _lods.set(key, (mtime, levels))
+    return levels
+
+
+def lod_faces(dataset, mesh_name, bbox, pixel_size):
+    """
+    Return the triangles of the coarsest level of detail of a mesh fitting
+    a tile with pixels of `pixel_size` degrees (see UGRID_LOD_PIXELS) that
+    intersect a WGS84 bbox, or None if the tile needs the full mesh.
+    """
+    if not settings.UGRID_LOD_PIXELS:
+        return None
+    levels = lod_levels(dataset, mesh_name)
+    i = lod.pick_level([level.cell_size for level in levels], pixel_size, settings.UGRID_LOD_PIXELS)
+    if i is None:
+        return None
+    level = levels[i]
+    return level.faces[spatial_index.query(level.order, level.tree, bbox)]
+
+
+def stats():
+    return dict(ugrid=_ugrids.stats(), sgrid=_sgrids.stats(), face_index=_face_indexes.stats(), lod=_lods.stats())
@@ -2,6 +2,7 @@
 from django.conf.urls import url
 
 from wms.views import (
+    CacheStatsView,
     DatasetDeleteCacheView,
     DatasetGridUpdateView,
     DatasetLayersUpdateView,
@@ -13,12 +14,14 @@ from wms.views import (
     groups,
     index,
     LogsView,
+    TileView,
     WmsView,
 )
 
 urlpatterns = [
     url(r'^$', index, name='wms-index'),
     # Datasets
+    url(r'^datasets/(?P<dataset>.*)/tiles/(?P<layer>[^/]+)/(?P<style>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$', TileView.as_view(), name="tiles"),
     url(r'^datasets/(?P<dataset>.*)/show', DatasetShowView.as_view(), name="show_dataset"),
     url(r'^datasets/(?P<dataset>.*)/update$', DatasetUpdateView.as_view(), name="update_dataset"),
     url(r'^datasets/(?P<dataset>.*)/update_time$', DatasetTimeUpdateView.as_view(), name="update_time"),
@@ -29,6 +32,7 @@ urlpatterns = [
     # Clients
     url(r'^demo', demo, name='demo'),
     url(r'^defaults$', DefaultsView.as_view(), name='defaults'),
+    url(r'^cache/stats$', CacheStatsView.as_view(), name='cache_stats'),
     url(r'^groups/(?P<group>.*)/', groups),
     url(r'^logs$', LogsView.as_view(), name='logs')
 ]
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
 import time
+import sqlite3
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from dateutil.tz import tzutc
@@ -129,6 +134,234 @@ class DotDict(object):
         return pprint.pformat(vars(self), indent=2)
 
 
+class LRUCache(object):
+    """
+    A thread-safe, in-process least-recently-used cache.
+
+    The cache is bounded by the total `sizeof` of its values (the number of
+    items when no `sizeof` function is given).  Hit, miss and eviction counters
+    are kept so they can be reported.
+    """
+
+    def __init__(self, maxsize=128, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof or (lambda v: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self.pop(key)
+            if size > self.maxsize:
+                # Would evict everything else and still not fit
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.maxsize:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(
+            items=len(self._data),
+            size=self.size,
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions
+        )
+
+
+class FileIndex(object):
+    """
+    SQLite index of the files of an on-disk cache shared by processes:
+    their dataset, generation, size, last use and an integer `flags` of the
+    cache.  Adding a file evicts the least recently used ones past `maxsize`
+    bytes; the caller removes the evicted files.  The directory of the index
+    is made by `create`.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.evictions = 0
+        # One connection per thread (and process)
+        self._local = threading.local()
+
+    def create(self):
+        """ Make the directory of the index, False if it can not be written to """
+        root = os.path.dirname(self.path)
+        try:
+            os.makedirs(root, exist_ok=True)
+        except OSError:
+            return False
+        return os.access(root, os.W_OK)
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, dataset TEXT, generation TEXT, '
+                         'path TEXT, flags INTEGER, bytes INTEGER, used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS files_used ON files (used)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        """ Return the flags of an indexed file and mark it used, None if not indexed """
+        row = self.db.execute('SELECT flags FROM files WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.db.execute('UPDATE files SET used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def add(self, key, dataset, generation, path, flags, size):
+        """ Index a file and return the [(path, flags)] of the files evicted to make room for it """
+        evicted = []
+        conn = self.db
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (key, dataset, generation, path, flags, size, time.time()))
+            total = conn.execute('SELECT SUM(bytes) FROM files').fetchone()[0]
+            if total > self.maxsize:
+                for old_key, old_path, old_flags, old_size in conn.execute('SELECT key, path, flags, bytes FROM files ORDER BY used'):
+                    if total <= self.maxsize:
+                        break
+                    evicted.append((old_key, old_path, old_flags))
+                    total -= old_size
+                conn.executemany('DELETE FROM files WHERE key = ?', [(e[0],) for e in evicted])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.evictions += len(evicted)
+        return [(p, f) for _, p, f in evicted]
+
+    def invalidate(self, dataset, generation):
+        """ Forget the files of the generations of a dataset other than `generation` """
+        self.db.execute('DELETE FROM files WHERE dataset = ? AND generation != ?', (dataset, generation))
+
+    def stats(self):
+        try:
+            items, size = self.db.execute('SELECT COUNT(*), SUM(bytes) FROM files').fetchone()
+        except (OSError, sqlite3.Error):
+            items, size = None, None
+        return dict(
+            items=items,
+            size=size or 0,
+            maxsize=self.maxsize,
+            evictions=self.evictions
+        )
+
+
+def compose_slices(outer, length, inner):
+    """
+    Return the slice equivalent to applying `inner` to the result of slicing a
+    dimension of `length` with `outer`
+    """
+    r = range(length)[outer][inner]
+    return slice(r.start, r.stop, r.step)
+
+
+def index_ranges(indexes, max_ranges):
+    """
+    Group sorted unique indexes into at most `max_ranges` contiguous slices
+    covering all of them, bridging the smallest gaps first.
+    """
+    indexes = np.asarray(indexes)
+    if indexes.size == 0:
+        return []
+    gaps = np.diff(indexes)
+    breaks = np.where(gaps > 1)[0]
+    if breaks.size >= max_ranges:
+        if max_ranges > 1:
+            largest = np.argsort(gaps[breaks], kind='mergesort')[-(max_ranges - 1):]
+            breaks = np.sort(breaks[largest])
+        else:
+            breaks = breaks[:0]
+    starts = np.concatenate(([indexes[0]], indexes[breaks + 1]))
+    stops = np.concatenate((indexes[breaks] + 1, [indexes[-1] + 1]))
+    return [slice(int(a), int(b)) for a, b in zip(starts, stops)]
+
+
+def green_threads():
+    """
+    Whether threads are green threads sharing one OS thread, as in the
+    eventlet workers of gunicorn which monkey patch threading.  Blocking
+    netCDF reads on other threads then hold up the requests of the worker
+    instead of overlapping them.
+    """
+    if 'eventlet' not in sys.modules:
+        return False
+    from eventlet import patcher
+    return patcher.is_monkey_patched('thread')
+
+
+def nbytes(obj):
+    """
+    Approximate the memory held by a (possibly nested) value, used to bound
+    the size of LRUCache objects holding arrays.
+    """
+    if isinstance(obj, np.memmap):
+        # Pages are shared with the OS page cache
+        return 0
+    elif isinstance(obj, np.ndarray):
+        data = np.ma.getdata(obj)
+        return (0 if isinstance(data, np.memmap) else data.nbytes) + np.ma.getmask(obj).nbytes
+    elif isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    elif isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    elif isinstance(obj, DotDict):
+        return nbytes(vars(obj))
+    return 0
+
+
 def calculate_time_windows(times):
 
     if times.size == 0:
@@ -18,6 +18,12 @@ from wms.utils import get_layer_from_request
 from wms.tasks import update_dataset, update_layers, update_time_cache, update_grid_cache
 from wms import gfi_handler
 from wms import wms_handler
+from wms import tile_cache
+from wms import slices
+from wms import handles
+from wms import mirror
+from wms import topology
+from wms import projections
 from wms import logger
 
 
@@ -115,7 +121,12 @@ def enhance_getmap_request(dataset, layer, request):
         logscale=wms_handler.get_logscale(request, defaults.logscale),
         vectorscale=wms_handler.get_vectorscale(request),
         vectorstep=wms_handler.get_vectorstep(request),
-        numcontours=wms_handler.get_num_contours(request, default=defaults.numcontours)
+        numcontours=wms_handler.get_num_contours(request, default=defaults.numcontours),
+        renderer=wms_handler.get_renderer(request, default=settings.PCOLOR_RENDERER),
+        shading=wms_handler.get_shading(request),
+        animation=wms_handler.get_animation(request),
+        framerate=wms_handler.get_framerate(request),
+        png_options=dataset.png_options
     )
     gettemp.update(newgets)
     request.GET = gettemp
@@ -211,6 +222,14 @@ class LogsView(View):
         return TemplateResponse(request, 'wms/logs.html', dict(lines=lines))
 
 
+class CacheStatsView(View):
+
+    @method_decorator(login_required)
+    def get(self, request):
+        stats = dict(tiles=tile_cache.stats(), slices=slices.stats(), handles=handles.stats(), mirror=mirror.stats(), topology=topology.stats(), projections=projections.stats())
+        return HttpResponse(json.dumps(stats), content_type='application/json')
+
+
 class DefaultsView(View):
 
     def get(self, request):
@@ -289,6 +308,9 @@ class WmsView(View):
                     raise ValueError('Could not find a layer named "{}"'.format(request.GET.get('layers')))
                 if reqtype.lower() == 'getmap':
                     request = enhance_getmap_request(dataset, layer, request)
+                    if request.GET['animation'] is not None:
+                        return dataset.getmap_animation(layer, request)
+                    return tile_cache.getmap(dataset, layer, request)
                 elif reqtype.lower() == 'getlegendgraphic':
                     request = enhance_getlegendgraphic_request(dataset, layer, request)
                 elif reqtype.lower() == 'getfeatureinfo':
@@ -304,3 +326,47 @@ class WmsView(View):
         except BaseException as e:
             logger.exception('Returning a 500:')
             return HttpResponse(str(e), status=500, reason="Could not process inputs", content_type="application/json")
+
+
+class TileView(View):
+    """
+    XYZ (slippy map) web mercator tiles of a layer and style.  Other GetMap
+    parameters (TIME, ELEVATION, COLORSCALERANGE, ...) are accepted in the
+    query string.
+    """
+
+    def get(self, request, dataset, layer, style, z, x, y):
+        dataset = get_object_or_404(Dataset, slug=dataset)
+        z, x, y = int(z), int(x), int(y)
+        if x >= 2 ** z or y >= 2 ** z:
+            return HttpResponse('Tile {}/{}/{} does not exist'.format(z, x, y), status=404)
+
+        size = settings.METATILE_SIZE if settings.TILE_CACHE_ENABLED is True else 1
+        meta = tile_cache.metatile(z, x, y, size)
+        request = normalize_get_params(request)
+        params = dict(
+            service='WMS',
+            request='GetMap',
+            version='1.1.1',
+            layers=layer,
+            format='image/png',
+            transparent='true',
+            srs='EPSG:3857',
+            bbox=','.join(str(v) for v in tile_cache.metatile_bounds(z, meta)),
+            width=meta[2] * tile_cache.TILE_SIZE,
+            height=meta[3] * tile_cache.TILE_SIZE
+        )
+        if style != 'default':
+            params['styles'] = style
+        request.GET.update(params)
+
+        try:
+            layer = get_layer_from_request(dataset, request)
+            request = enhance_getmap_request(dataset, layer, request)
+            return tile_cache.getmap_tile(dataset, layer, request, z, x, y, meta)
+        except NotImplementedError:
+            logger.exception('Returning a 500:')
+            return HttpResponse('"GetMap" is not implemented for a {}'.format(dataset.__class__.__name__), status=500, reason="Could not process inputs", content_type="application/json")
+        except BaseException as e:
+            logger.exception('Returning a 500:')
+            return HttpResponse(str(e), status=500, reason="Could not process inputs", content_type="application/json")
@@ -3,9 +3,9 @@ from datetime import datetime, date
 
 from dateutil.parser import parse
 from dateutil.tz import tzutc
-import pyproj
 
 from wms.utils import DotDict, split, tz_aware_to_native
+from wms import projections
 
 from wms import logger
 
@@ -24,12 +24,12 @@ def get_wgs84_bbox(request):
     Return the [lonmin, latmin, lonmax, lonmax] - [lower (x,y), upper(x,y)]
     in WGS84
     """
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
     crs = get_projection(request)
     bbox = get_bbox(request)
 
-    wgs84_minx, wgs84_miny = pyproj.transform(crs, EPSG4326, bbox.minx, bbox.miny)
-    wgs84_maxx, wgs84_maxy = pyproj.transform(crs, EPSG4326, bbox.maxx, bbox.maxy)
+    transformer = projections.get_transformer(crs, 'EPSG:4326')
+    wgs84_minx, wgs84_miny = map(float, transformer.transform(bbox.minx, bbox.miny))
+    wgs84_maxx, wgs84_maxy = map(float, transformer.transform(bbox.maxx, bbox.maxy))
 
     return DotDict(minx=wgs84_minx, miny=wgs84_miny, maxx=wgs84_maxx, maxy=wgs84_maxy, bbox=(wgs84_minx, wgs84_miny, wgs84_maxx, wgs84_maxy))
 
@@ -77,6 +77,56 @@ def get_logscale(request, default_logscale):
         return default_logscale
 
 
+def get_renderer(request, default=None):
+    """
+    Return the RENDERER for GetMap requests ('matplotlib' or 'numpy')
+    """
+    default = default or 'matplotlib'
+    try:
+        renderer = request.GET['renderer'].lower()
+        assert renderer in ['matplotlib', 'numpy']
+        return renderer
+    except (KeyError, AssertionError):
+        return default
+
+
+def get_shading(request):
+    """
+    Return the SHADING for GetMap requests ('flat' or 'gouraud')
+    """
+    try:
+        shading = request.GET['shading'].lower()
+        assert shading in ['flat', 'gouraud']
+        return shading
+    except (KeyError, AssertionError):
+        return 'flat'
+
+
+def get_animation(request):
+    """
+    Return the animation format of a GetMap request, 'apng' or 'gif', or None
+    for single images
+    """
+    return {
+        'image/apng': 'apng',
+        'image/vnd.mozilla.apng': 'apng',
+        'image/gif': 'gif',
+    }.get(request.GET.get('format', '').lower())
+
+
+def get_framerate(request, default=None):
+    """
+    Return the FRAMERATE (frames per second) of animated GetMap requests
+    """
+    default = default or 4.
+    try:
+        framerate = float(request.GET['framerate'])
+        assert 0 < framerate <= 100
+        return framerate
+    except (KeyError, ValueError, AssertionError):
+        return default
+
+
 def get_horizontal(request):
     """
     Return the horizontal for GetLegendGraphic requests
@@ -132,7 +182,7 @@ def get_projection(request):
         projstr = "EPSG:3857"
         logger.debug("SRS or CRS no available in requst, defaulting to EPSG:3857 (mercator)")
 
-    return pyproj.Proj(init=projstr)
+    return projections.get_proj(projstr)
 
 
 def get_xy(request):
@@ -171,7 +221,8 @@ def get_time(request):
     if time is None:
         return datetime.utcnow()
     else:
-        dt = parse(time)
+        # The start of a time range (animations)
+        dt = parse(time.split('/')[0])
         if dt.tzinfo is not None:
             utc_dt = dt.astimezone(tzutc())  # convert UTC if tzinfo is available
             utc_tz_naive = utc_dt.replace(tzinfo=None)
@@ -255,14 +306,11 @@ def get_dimensions(request, default_width=None, default_height=None):
 
 def get_gfi_positions(xy, bbox, crs, dims):
     """ Returns the latitude and longitude the GFI should be performed at"""
-    EPSG4326 = pyproj.Proj(init='EPSG:4326')
-    lon, lat = pyproj.transform(
-        crs,
-        EPSG4326,
+    lon, lat = projections.get_transformer(crs, 'EPSG:4326').transform(
         bbox.minx + ((bbox.maxx - bbox.minx) * (xy.x / dims.width)),
         bbox.maxy - ((bbox.maxy - bbox.miny) * (xy.y / dims.height))
     )
-    return DotDict(latitude=lat, longitude=lon)
+    return DotDict(latitude=float(lat), longitude=float(lon))
 
 
 def get_item(request):